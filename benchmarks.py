@@ -0,0 +1,519 @@
+"""
+Benchmarks for the connector's storage and parsing hot paths
+
+Usage:
+    python benchmarks.py              # run all benchmarks
+    python benchmarks.py codec        # run one benchmark by name
+    python benchmarks.py mapping_index 1000000 5000000   # with arguments
+
+Each benchmark builds synthetic data shaped like real QB/Bitrix24 traffic and
+prints its results; nothing touches the configured database or the network.
+"""
+
+import json
+import random
+import sys
+import time
+
+
+def _timed(func, *args, repeat=3):
+    """Best-of-N wall time for func(*args), plus its last result"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def _sample_queue_payloads(count):
+    """Queue payloads like bitrix_contact_to_qb_customer() produces"""
+    rng = random.Random(42)
+    first_names = ['Anna', 'Ben', 'Carla', 'Dmitri', 'Elena', 'Frank', 'Grace', 'Hugo']
+    last_names = ['Smith', 'Jones', 'Garcia', 'Ivanov', 'Chen', 'Müller', 'Brown']
+    payloads = []
+    for i in range(count):
+        first = rng.choice(first_names)
+        last = rng.choice(last_names)
+        payloads.append(json.dumps({
+            'name': f"{first} {last} {i}",
+            'first_name': first,
+            'last_name': last,
+            'company_name': f"{last} Contracting LLC",
+            'email': f"{first.lower()}.{last.lower()}{i}@example.com",
+            'phone': f"+1 555 {rng.randint(1000000, 9999999)}",
+            'address': {'addr1': f"{rng.randint(1, 9999)} Main St", 'addr2': '',
+                        'city': 'Springfield', 'state': 'IL',
+                        'postal_code': f"{rng.randint(10000, 99999)}", 'country': 'US'},
+        }))
+    return payloads
+
+
+def _sample_log_messages(count):
+    """sync_log messages: tracebacks and HTTP error bodies"""
+    rng = random.Random(7)
+    messages = []
+    for i in range(count):
+        if i % 2:
+            messages.append(
+                'Traceback (most recent call last):\n'
+                '  File "C:\\Users\\max\\qb-bitrix-connector\\sync_manager.py", line 262, in _sync_to_bitrix24\n'
+                '    self._sync_single_record_to_bitrix24(entity_type, record)\n'
+                '  File "C:\\Users\\max\\qb-bitrix-connector\\bitrix24_client.py", line 37, in _call\n'
+                '    response.raise_for_status()\n'
+                f"requests.exceptions.HTTPError: 503 Server Error: Service Unavailable for url: "
+                f"https://hartzell.app/rest/1/xxxx/crm.contact.update (attempt {rng.randint(1, 9)})"
+            )
+        else:
+            messages.append(
+                f"HTTPSConnectionPool(host='hartzell.app', port=443): Max retries exceeded with url: "
+                f"/rest/1/xxxx/crm.deal.add (Caused by ReadTimeoutError(\"Read timed out. "
+                f"(read timeout=30)\")) id={rng.randint(1, 10 ** 6)}"
+            )
+    return messages
+
+
+def bench_codec():
+    """Size and throughput of payload_codec on queue payloads and log messages"""
+    import zlib
+    from payload_codec import encode_text, decode_text
+
+    print("payload_codec (zlib + preset dictionary)")
+    for label, values in (('queue payloads', _sample_queue_payloads(20000)),
+                          ('log messages', _sample_log_messages(20000))):
+        raw_bytes = sum(len(v.encode('utf-8')) for v in values)
+
+        encode_time, encoded = _timed(lambda: [encode_text(v) for v in values])
+        stored_bytes = sum(len(e.encode('utf-8')) if isinstance(e, str) else len(e) for e in encoded)
+        decode_time, decoded = _timed(lambda: [decode_text(e) for e in encoded])
+        assert decoded == values
+
+        # Same level without the preset dictionary, for comparison
+        plain_bytes = sum(len(zlib.compress(v.encode('utf-8'), 6)) for v in values)
+
+        mb = raw_bytes / 1e6
+        print(f"  {label:15} {len(values)} rows, {raw_bytes / len(values):.0f} B/row avg")
+        print(f"    size:    {raw_bytes:>10,} -> {stored_bytes:>10,} bytes "
+              f"({stored_bytes / raw_bytes:.1%} of raw; plain zlib {plain_bytes / raw_bytes:.1%})")
+        print(f"    encode:  {mb / encode_time:8.1f} MB/s   decode: {mb / decode_time:8.1f} MB/s")
+
+
+def _sample_mappings(count):
+    """Sorted (ListID, Bitrix ID, payload hash) rows shaped like real id_mappings"""
+    import hashlib
+    rows = []
+    for i in range(count):
+        list_id = f"{0x80000001 + i:X}-{1262304000 + i * 7}"
+        rows.append((list_id, str(100000 + i), hashlib.sha256(list_id.encode()).hexdigest()))
+    rows.sort()
+    return rows
+
+
+def _dict_bytes(mapping):
+    """Deep size of a {ListID: (bitrix_id, hash)} dict"""
+    total = sys.getsizeof(mapping)
+    for key, value in mapping.items():
+        total += sys.getsizeof(key) + sys.getsizeof(value) + sum(sys.getsizeof(v) for v in value)
+    return total
+
+
+def bench_mapping_index(*sizes):
+    """Memory and lookup speed of mapping_index vs a dict of strings"""
+    from mapping_index import CompactMappingTable
+
+    sizes = [int(size) for size in sizes] or [1000000, 5000000]
+    # A 5M-entry dict of strings needs ~2 GB; measure a sample and scale
+    dict_sample = min(min(sizes), 1000000)
+
+    print("mapping_index (packed sorted arrays + Bloom filter)")
+    rows = _sample_mappings(dict_sample)
+    as_dict = {list_id: (bitrix_id, content_hash) for list_id, bitrix_id, content_hash in rows}
+    dict_per_row = _dict_bytes(as_dict) / dict_sample
+    del as_dict, rows
+
+    for size in sizes:
+        rows = _sample_mappings(size)
+        build_time, table = _timed(lambda: CompactMappingTable(rows), repeat=1)
+        hits = [row[0] for row in rows[::max(1, size // 100000)]]
+        misses = [f"{list_id}X" for list_id in hits]
+        del rows
+
+        hit_time, _ = _timed(lambda: [table.get(k) for k in hits])
+        miss_time, _ = _timed(lambda: [table.get(k) for k in misses])
+
+        print(f"  {size:,} mappings")
+        print(f"    dict:    {dict_per_row * size / 2 ** 20:10,.0f} MiB ({dict_per_row:.0f} B/row"
+              f"{'' if size <= dict_sample else ', scaled from ' + format(dict_sample, ',')})")
+        print(f"    compact: {table.nbytes / 2 ** 20:10,.0f} MiB ({table.nbytes / size:.0f} B/row, "
+              f"Bloom filter {table.bloom.nbytes / 2 ** 20:.1f} MiB), built in {build_time:.1f}s")
+        print(f"    lookup:  {len(hits) / hit_time:10,.0f}/s hit   {len(misses) / miss_time:10,.0f}/s miss")
+        del table
+
+
+def _sample_invoice_response(count, lines_per_invoice=4):
+    """InvoiceQueryRs envelope shaped like a QB Desktop response with line items"""
+    rng = random.Random(11)
+    parts = ['<?xml version="1.0" ?><QBXML><QBXMLMsgsRs>'
+             '<InvoiceQueryRs requestID="1" statusCode="0" statusSeverity="Info" statusMessage="Status OK">']
+    for i in range(count):
+        txn_id = f"{0x1000 + i:X}-{1262304000 + i}"
+        lines = []
+        for n in range(lines_per_invoice):
+            qty = rng.randint(1, 20)
+            rate = rng.randint(100, 50000) / 100
+            lines.append(
+                f"<InvoiceLineRet><TxnLineID>{txn_id}-{n}</TxnLineID>"
+                f"<ItemRef><ListID>{0x80000000 + rng.randint(1, 5000):X}-1262304000</ListID>"
+                f"<FullName>Item {rng.randint(1, 5000)}</FullName></ItemRef>"
+                f"<Desc>Line {n} of invoice {i}</Desc><Quantity>{qty}</Quantity>"
+                f"<Rate>{rate:.2f}</Rate><Amount>{qty * rate:.2f}</Amount>"
+                f"<SalesTaxCodeRef><ListID>80000002-1262304000</ListID><FullName>Tax</FullName></SalesTaxCodeRef>"
+                f"</InvoiceLineRet>"
+            )
+        parts.append(
+            f"<InvoiceRet><TxnID>{txn_id}</TxnID>"
+            f"<TimeCreated>2024-01-02T10:00:00-05:00</TimeCreated>"
+            f"<TimeModified>2024-03-0{1 + i % 9}T12:30:00-05:00</TimeModified>"
+            f"<EditSequence>{1262304000 + i}</EditSequence><TxnNumber>{i + 1}</TxnNumber>"
+            f"<CustomerRef><ListID>{0x80000000 + rng.randint(1, 20000):X}-1262304000</ListID>"
+            f"<FullName>Customer {i % 20000}</FullName></CustomerRef>"
+            f"<ClassRef><ListID>80000003-1262304000</ListID><FullName>Residential</FullName></ClassRef>"
+            f"<ARAccountRef><ListID>80000004-1262304000</ListID><FullName>Accounts Receivable</FullName></ARAccountRef>"
+            f"<TemplateRef><ListID>80000005-1262304000</ListID><FullName>Intuit Service Invoice</FullName></TemplateRef>"
+            f"<TxnDate>2024-01-02</TxnDate><RefNumber>{10000 + i}</RefNumber>"
+            f"<BillAddress><Addr1>{i} Main St</Addr1><City>Springfield</City><State>IL</State>"
+            f"<PostalCode>62701</PostalCode><Country>US</Country></BillAddress>"
+            f"<IsPending>false</IsPending><IsFinanceCharge>false</IsFinanceCharge>"
+            f"<TermsRef><ListID>80000006-1262304000</ListID><FullName>Net 30</FullName></TermsRef>"
+            f"<DueDate>2024-02-01</DueDate><ShipDate>2024-01-02</ShipDate>"
+            f"<Subtotal>{rng.randint(100, 900000) / 100:.2f}</Subtotal>"
+            f"<ItemSalesTaxRef><ListID>80000007-1262304000</ListID><FullName>IL Tax</FullName></ItemSalesTaxRef>"
+            f"<SalesTaxPercentage>6.25</SalesTaxPercentage><SalesTaxTotal>12.50</SalesTaxTotal>"
+            f"<AppliedAmount>0.00</AppliedAmount><BalanceRemaining>{rng.randint(0, 90000) / 100:.2f}</BalanceRemaining>"
+            f"<Memo>Invoice {i}</Memo><IsPaid>{'true' if i % 3 == 0 else 'false'}</IsPaid>"
+            f"<IsToBePrinted>false</IsToBePrinted><IsToBeEmailed>true</IsToBeEmailed>"
+            + ''.join(lines) +
+            "</InvoiceRet>"
+        )
+    parts.append('</InvoiceQueryRs></QBXMLMsgsRs></QBXML>')
+    return ''.join(parts)
+
+
+def _sample_customer_response(count):
+    """CustomerQueryRs envelope with the fields QB Desktop typically returns"""
+    rng = random.Random(12)
+    parts = ['<?xml version="1.0" ?><QBXML><QBXMLMsgsRs>'
+             '<CustomerQueryRs requestID="1" statusCode="0" statusSeverity="Info" statusMessage="Status OK">']
+    for i in range(count):
+        company = f"<CompanyName>Company {i}</CompanyName>" if i % 2 else ''
+        parts.append(
+            f"<CustomerRet><ListID>{0x80000000 + i:X}-1262304000</ListID>"
+            f"<TimeCreated>2024-01-02T10:00:00-05:00</TimeCreated>"
+            f"<TimeModified>2024-03-0{1 + i % 9}T12:30:00-05:00</TimeModified>"
+            f"<EditSequence>{1262304000 + i}</EditSequence><Name>Customer {i}</Name>"
+            f"<FullName>Customer {i}</FullName><IsActive>true</IsActive><Sublevel>0</Sublevel>"
+            f"{company}<FirstName>First{i}</FirstName><LastName>Last{i}</LastName>"
+            f"<BillAddress><Addr1>{i} Main St</Addr1><City>Springfield</City><State>IL</State>"
+            f"<PostalCode>62701</PostalCode><Country>US</Country></BillAddress>"
+            f"<BillAddressBlock><Addr1>{i} Main St</Addr1><Addr2>Springfield, IL 62701</Addr2></BillAddressBlock>"
+            f"<Phone>555-{rng.randint(1000, 9999)}</Phone><Email>customer{i}@example.com</Email>"
+            f"<CustomerTypeRef><ListID>80000010-1262304000</ListID><FullName>Residential</FullName></CustomerTypeRef>"
+            f"<TermsRef><ListID>80000006-1262304000</ListID><FullName>Net 30</FullName></TermsRef>"
+            f"<Balance>{rng.randint(0, 90000) / 100:.2f}</Balance>"
+            f"<TotalBalance>{rng.randint(0, 90000) / 100:.2f}</TotalBalance>"
+            f"<SalesTaxCodeRef><ListID>80000002-1262304000</ListID><FullName>Tax</FullName></SalesTaxCodeRef>"
+            f"<JobStatus>None</JobStatus><PreferredDeliveryMethod>None</PreferredDeliveryMethod>"
+            f"</CustomerRet>"
+        )
+    parts.append('</CustomerQueryRs></QBXMLMsgsRs></QBXML>')
+    return ''.join(parts)
+
+
+def _sample_item_response(count):
+    """ItemQueryRs mixing service, inventory and non-inventory items with a few of the other types"""
+    rng = random.Random(13)
+    parts = ['<?xml version="1.0" ?><QBXML><QBXMLMsgsRs>'
+             '<ItemQueryRs requestID="1" statusCode="0" statusSeverity="Info" statusMessage="Status OK">']
+    for i in range(count):
+        head = (f"<ListID>{0x80000000 + i:X}-1262304000</ListID>"
+                f"<TimeCreated>2024-01-02T10:00:00-05:00</TimeCreated>"
+                f"<TimeModified>2024-03-0{1 + i % 9}T12:30:00-05:00</TimeModified>"
+                f"<EditSequence>{1262304000 + i}</EditSequence><Name>Item {i}</Name>"
+                f"<FullName>Item {i}</FullName><IsActive>true</IsActive>")
+        price = f"{rng.randint(100, 99999) / 100:.2f}"
+        kind = i % 10
+        if kind < 4:
+            parts.append(f"<ItemServiceRet>{head}<SalesOrPurchase><Desc>Service {i}</Desc><Price>{price}</Price>"
+                         f"<AccountRef><FullName>Services</FullName></AccountRef></SalesOrPurchase></ItemServiceRet>")
+        elif kind < 7:
+            parts.append(f"<ItemInventoryRet>{head}<SalesDesc>Part {i}</SalesDesc><SalesPrice>{price}</SalesPrice>"
+                         f"<IncomeAccountRef><FullName>Sales</FullName></IncomeAccountRef>"
+                         f"<QuantityOnHand>{rng.randint(0, 500)}</QuantityOnHand><AverageCost>{price}</AverageCost>"
+                         f"</ItemInventoryRet>")
+        elif kind < 9:
+            parts.append(f"<ItemNonInventoryRet>{head}<SalesOrPurchase><Desc>Supply {i}</Desc><Price>{price}</Price>"
+                         f"</SalesOrPurchase></ItemNonInventoryRet>")
+        else:
+            tag = ('ItemDiscountRet', 'ItemSubtotalRet', 'ItemSalesTaxRet')[i // 10 % 3]
+            parts.append(f"<{tag}>{head}<ItemDesc>Other {i}</ItemDesc></{tag}>")
+    parts.append('</ItemQueryRs></QBXMLMsgsRs></QBXML>')
+    return ''.join(parts)
+
+
+def bench_items(count=50000):
+    """parse_items in one pass vs one findall scan per item type"""
+    from qbxml_parser import ITEM_TYPES, item_record, parse_items, parse_xml
+
+    count = int(count)
+    response = parse_xml(_sample_item_response(count)).find('.//ItemQueryRs')
+
+    def per_type_scans():
+        return [item_record(ret, item_type) for item_type in ITEM_TYPES
+                for ret in response.findall(f'.//{item_type}Ret')]
+
+    print(f"ItemQueryRs with {count:,} items of {len(ITEM_TYPES)} possible types")
+    for name, func in (('findall per type', per_type_scans), ('one pass', lambda: parse_items(response))):
+        elapsed, items = _timed(func)
+        print(f"  {name:18} {elapsed * 1000:8.1f} ms  ({len(items):,} items)")
+
+
+def bench_extractors(count=20000):
+    """Schema-compiled extractors against the hand-written record parsers"""
+    from lxml import etree
+    import qbxml_parser
+
+    count = int(count)
+    # The hand-written parsers' fields, as schema field paths
+    line_fields = ['TxnLineID', 'Desc', 'Quantity', 'Rate', 'Amount', 'ItemRef']
+    cases = [
+        ('customers', _sample_customer_response(count), qbxml_parser.parse_customers,
+         {'Customer': list(qbxml_parser.CUSTOMER_FIELDS)
+                      + [f"BillAddress.{tag}" for tag in qbxml_parser.ADDRESS_FIELDS]}),
+        ('invoices', _sample_invoice_response(count), qbxml_parser.parse_invoices,
+         {'Invoice': list(qbxml_parser.INVOICE_FIELDS) + ['CustomerRef']
+                     + [f"InvoiceLineRet.{tag}" for tag in line_fields]}),
+    ]
+
+    print(f"Record extraction from a parsed tree ({count:,} records each)")
+    for name, response, hand_written, fields in cases:
+        response_elem = etree.fromstring(response.encode('utf-8'))[0][0]
+        hand_time, _ = _timed(hand_written, response_elem)
+        subset_time, _ = _timed(qbxml_parser.parse_schema_records, response_elem, fields)
+        full_time, _ = _timed(qbxml_parser.parse_schema_records, response_elem)
+        print(f"  {name:10} hand-written {hand_time:6.3f}s   "
+              f"schema (same fields) {subset_time:6.3f}s ({hand_time / subset_time:.2f}x)   "
+              f"schema (all fields) {full_time:6.3f}s")
+
+
+def _sample_repeated_children_response(children):
+    """UnitOfMeasureSetQueryRs whose one set has `children` RelatedUnit entries"""
+    units = ''.join(
+        f"<RelatedUnit><Name>Unit {i}</Name><Abbreviation>u{i}</Abbreviation>"
+        f"<ConversionRatio>{i + 1}</ConversionRatio></RelatedUnit>"
+        for i in range(children)
+    )
+    return ('<?xml version="1.0" ?><QBXML><QBXMLMsgsRs>'
+            '<UnitOfMeasureSetQueryRs requestID="1" statusCode="0" statusMessage="Status OK">'
+            '<UnitOfMeasureSetRet><ListID>80000001-1262304000</ListID><Name>Count</Name>'
+            '<IsActive>true</IsActive><UnitOfMeasureType>Count</UnitOfMeasureType>'
+            '<BaseUnit><Name>Each</Name><Abbreviation>ea</Abbreviation></BaseUnit>'
+            f'{units}</UnitOfMeasureSetRet></UnitOfMeasureSetQueryRs></QBXMLMsgsRs></QBXML>')
+
+
+def bench_generic(*sizes):
+    """element_to_dict on elements with thousands of children"""
+    from lxml import etree
+    from qbxml_parser import element_to_dict, parse_generic
+
+    sizes = [int(size) for size in sizes] or [1000, 4000, 16000]
+    print("parse_generic on a UnitOfMeasureSetRet with N RelatedUnit children")
+    for size in sizes:
+        response_elem = etree.fromstring(_sample_repeated_children_response(size).encode('utf-8'))[0][0]
+        elapsed, records = _timed(parse_generic, response_elem)
+        assert len(records[0]['RelatedUnit']) == size
+        print(f"  {size:>8,} children: {elapsed * 1000:8.1f} ms   {elapsed / size * 1e6:6.2f} us/child")
+
+    # Each nested child with a tag of its own: the worst case for a per-child sibling scan
+    print("element_to_dict on an element with N distinct nested children")
+    for size in sizes:
+        elem = etree.fromstring('<DataExtRet>' + ''.join(
+            f"<Field{i}><Value>{i}</Value></Field{i}>" for i in range(size)) + '</DataExtRet>')
+        elapsed, _ = _timed(element_to_dict, elem)
+        print(f"  {size:>8,} children: {elapsed * 1000:8.1f} ms   {elapsed / size * 1e6:6.2f} us/child")
+
+
+def bench_parse_overhead(count=20000):
+    """Per-response cost of getting a small response into a tree"""
+    from lxml import etree
+    from qbxml_parser import parse_xml, parse_qbxml_response
+
+    count = int(count)
+    text = ('<?xml version="1.0" ?><QBXML><QBXMLMsgsRs>'
+            '<HostQueryRs requestID="1" statusCode="0" statusSeverity="Info" statusMessage="Status OK">'
+            '<HostRet><ProductName>QuickBooks Enterprise Solutions 23.0</ProductName>'
+            '<MajorVersion>33</MajorVersion><MinorVersion>0</MinorVersion><Country>US</Country>'
+            '<SupportedQBXMLVersion>16.0</SupportedQBXMLVersion><IsAutomaticLogin>false</IsAutomaticLogin>'
+            '<QBFileMode>SingleUser</QBFileMode></HostRet></HostQueryRs></QBXMLMsgsRs></QBXML>\n')
+    data = text.encode('utf-8')
+    cases = [
+        ('encode + default parser', lambda: etree.fromstring(text.encode('utf-8'))),
+        ('parse_xml(str)', lambda: parse_xml(text)),
+        ('parse_xml(bytes)', lambda: parse_xml(data)),
+        ('parse_xml(memoryview)', lambda: parse_xml(memoryview(data))),
+        ('parse_qbxml_response(bytes)', lambda: parse_qbxml_response(data)),
+    ]
+
+    def run(func):
+        for _ in range(count):
+            func()
+
+    print(f"Parsing a {len(data)}-byte HostQueryRs {count:,} times")
+    for name, func in cases:
+        elapsed, _ = _timed(run, func)
+        print(f"  {name:30} {elapsed / count * 1e6:7.2f} us/response")
+
+
+def bench_records(count=20000):
+    """Memory per parsed record: slotted Record classes vs the equivalent dicts"""
+    import tracemalloc
+    from qbxml_parser import parse_qbxml_response
+
+    count = int(count)
+    cases = [
+        ('customers', _sample_customer_response(count)),
+        ('invoices (4 lines)', _sample_invoice_response(count)),
+    ]
+
+    def retained(build):
+        tracemalloc.start()
+        records = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del records
+        return size
+
+    print(f"Memory retained per parsed record, field strings included ({count:,} records)")
+    for name, text in cases:
+        as_dicts = retained(lambda: [record.to_dict() for record in parse_qbxml_response(text)['data']])
+        as_records = retained(lambda: parse_qbxml_response(text)['data'])
+        elapsed, _ = _timed(parse_qbxml_response, text)
+        print(f"  {name:20} dict {as_dicts / count:7.0f} B   record {as_records / count:7.0f} B   "
+              f"parse {elapsed:.2f}s")
+
+
+def bench_parallel(count=50000, workers=4):
+    """parse_qbxml_response in one process vs split across worker processes"""
+    import os
+    import pickle
+    import qbxml_parser
+    from qbxml_parser import parse_qbxml_response
+
+    count, workers = int(count), int(workers)
+    text = _sample_invoice_response(count)
+    print(f"InvoiceQueryRs with {count:,} invoices ({len(text) / 2 ** 20:.0f} MiB), "
+          f"{workers} workers on {os.cpu_count()} CPUs")
+
+    qbxml_parser.PARALLEL_PARSE_WORKERS = 0
+    single, expected = _timed(parse_qbxml_response, text, repeat=1)
+    print(f"  one process      {single:6.2f}s")
+
+    # The parent still unpickles every record; that bounds the speedup on any number of CPUs
+    received = pickle.dumps(expected['data'], protocol=pickle.HIGHEST_PROTOCOL)
+    unpickle, _ = _timed(pickle.loads, received, repeat=1)
+    print(f"  parent's share   {unpickle:6.2f}s  (speedup bound {single / unpickle:.1f}x)")
+
+    # Run the requested pool size even on fewer CPUs, where it can only be slower
+    qbxml_parser.PARALLEL_PARSE_WORKERS = workers
+    qbxml_parser.PARALLEL_PARSE_MIN_BYTES = 0
+    qbxml_parser._parallel_workers = lambda: workers
+    parse_qbxml_response(text)  # start the pool
+    parallel, result = _timed(parse_qbxml_response, text, repeat=1)
+    print(f"  parallel         {parallel:6.2f}s  ({single / parallel:.1f}x, "
+          f"identical: {result == expected})")
+
+
+def bench_parse_cache(count=20000):
+    """A repeated response through ParseCache: first parse, repeat hit, and the hashing cost"""
+    from qbxml_parser import ParseCache, response_digest
+
+    count = int(count)
+    text = _sample_customer_response(count)
+    cache = ParseCache(2 * len(text))
+    print(f"CustomerQueryRs with {count:,} customers ({len(text) / 2 ** 20:.1f} MiB)")
+
+    miss, _ = _timed(cache.parse, text, repeat=1)
+    hit, _ = _timed(cache.parse, text)
+    digest, _ = _timed(response_digest, text)
+    print(f"  first parse      {miss * 1000:8.1f} ms")
+    print(f"  repeat (hit)     {hit * 1000:8.1f} ms")
+    print(f"  of which digest  {digest * 1000:8.1f} ms")
+
+
+def _peak_rss_mib():
+    """Peak resident memory of this process so far, or None where unavailable"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_parser(count=50000):
+    """parse_qbxml_response and QBXMLStream throughput and memory on a large InvoiceQueryRs"""
+    from qbxml_parser import parse_qbxml_response, QBXMLStream
+
+    count = int(count)
+    response = _sample_invoice_response(count)
+    print(f"qbxml_parser on InvoiceQueryRs ({count:,} invoices, {len(response) / 2 ** 20:.0f} MiB)")
+
+    def stream():
+        # Consume records one at a time, as the sync does
+        return sum(1 for _ in QBXMLStream(response))
+
+    # Streaming first: peak RSS only ever grows, so each delta is that pass's own
+    before = _peak_rss_mib()
+    elapsed, streamed = _timed(stream, repeat=1)
+    after_stream = _peak_rss_mib()
+    assert streamed == count
+    print(f"  stream:  {elapsed:8.2f}s   {count / elapsed:10,.0f} invoices/s")
+
+    elapsed, parsed = _timed(parse_qbxml_response, response, repeat=1)
+    after_parse = _peak_rss_mib()
+    assert parsed['success'] and len(parsed['data']) == count, parsed['status_message']
+    print(f"  parse:   {elapsed:8.2f}s   {count / elapsed:10,.0f} invoices/s")
+
+    if before is not None:
+        print(f"  peak memory added: stream {after_stream - before:,.0f} MiB, "
+              f"parse {after_parse - after_stream:,.0f} MiB (beyond the stream's peak)")
+
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'mapping_index': bench_mapping_index,
+    'parser': bench_parser,
+    'extractors': bench_extractors,
+    'generic': bench_generic,
+    'parse_overhead': bench_parse_overhead,
+    'records': bench_records,
+    'parallel': bench_parallel,
+    'parse_cache': bench_parse_cache,
+    'items': bench_items,
+}
+
+
+def main(argv):
+    if argv and argv[0] not in BENCHMARKS:
+        print(f"Unknown benchmark: {argv[0]} (available: {', '.join(BENCHMARKS)})")
+        return 1
+    # One named benchmark takes the remaining arguments
+    runs = [(argv[0], argv[1:])] if argv else [(name, []) for name in BENCHMARKS]
+    for name, args in runs:
+        BENCHMARKS[name](*args)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -7,11 +7,27 @@ Handles all communication with Bitrix24 on-premise at https://hartzell.app
 import requests
 import json
 import logging
-from typing import List, Dict, Any, Optional
-from config import BITRIX24_URL, BITRIX24_WEBHOOK
+import time
+from decimal import Decimal
+from typing import List, Dict, Any, Optional, Tuple
+from urllib.parse import quote
+from config import (
+    BITRIX24_URL, BITRIX24_WEBHOOK,
+    BITRIX24_MAX_RETRIES, BITRIX24_RETRY_BASE_SECONDS, BITRIX24_RETRY_MAX_SECONDS
+)
+from qbxml_parser import decode
 
 logger = logging.getLogger(__name__)
 
+# Records per page returned by Bitrix24 *.list methods
+LIST_PAGE_SIZE = 50
+
+# Most commands Bitrix24 accepts in one batch call
+BATCH_MAX_COMMANDS = 50
+
+# Error Bitrix24 returns (with HTTP 503) when the webhook's request rate is exceeded
+THROTTLED_ERROR = 'QUERY_LIMIT_EXCEEDED'
+
 
 class Bitrix24Client:
     """Client for Bitrix24 REST API"""
@@ -31,24 +47,74 @@ class Bitrix24Client:
         if not self.webhook_url.endswith('/'):
             self.webhook_url += '/'
 
-    def _call(self, method: str, params: Dict = None) -> Dict:
-        """Make an API call to Bitrix24"""
+    def _call(self, method: str, params: Dict = None, retry: bool = False) -> Dict:
+        """
+        Make an API call to Bitrix24.
+
+        Throttled calls were refused before running, so they are always
+        retried with exponential backoff (up to BITRIX24_MAX_RETRIES times).
+        retry=True, for read-only calls, also retries server errors and
+        failed connections.
+        """
         url = f"{self.webhook_url}{method}"
 
+        attempt = 0
+        while True:
+            result, retryable = self._post(url, params, retry)
+            if result.get('success') or not retryable or attempt >= BITRIX24_MAX_RETRIES:
+                break
+            delay = min(BITRIX24_RETRY_BASE_SECONDS * 2 ** attempt, BITRIX24_RETRY_MAX_SECONDS)
+            attempt += 1
+            logger.warning(f"Bitrix24 {method} failed ({result['error']}), retry {attempt} in {delay:g}s")
+            time.sleep(delay)
+
+        if not result.get('success'):
+            if 'error_description' in result:
+                logger.error(f"Bitrix24 API error: {result['error']} - {result.get('error_description') or ''}")
+            else:
+                logger.error(f"Bitrix24 request failed: {result['error']}")
+        return result
+
+    def _post(self, url: str, params: Optional[Dict], retry: bool) -> Tuple[Dict, bool]:
+        """One request; returns (result, whether a failure may be retried)"""
         try:
             response = requests.post(url, json=params or {}, timeout=30)
-            response.raise_for_status()
-            result = response.json()
+        except requests.exceptions.RequestException as e:
+            return {'success': False, 'error': str(e)}, retry
 
-            if 'error' in result:
-                logger.error(f"Bitrix24 API error: {result['error']} - {result.get('error_description', '')}")
-                return {'success': False, 'error': result['error'], 'error_description': result.get('error_description')}
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
 
-            return {'success': True, 'result': result.get('result'), 'total': result.get('total')}
+        if isinstance(body, dict) and 'error' in body:
+            retryable = body['error'] == THROTTLED_ERROR or (retry and response.status_code >= 500)
+            return ({'success': False, 'error': body['error'],
+                     'error_description': body.get('error_description')}, retryable)
 
+        try:
+            response.raise_for_status()
         except requests.exceptions.RequestException as e:
-            logger.error(f"Bitrix24 request failed: {e}")
-            return {'success': False, 'error': str(e)}
+            return {'success': False, 'error': str(e)}, response.status_code == 503 or retry
+        if not isinstance(body, dict):
+            return {'success': False, 'error': f"Invalid response from {url}"}, retry
+
+        return {'success': True, 'result': body.get('result'), 'total': body.get('total')}, False
+
+    def batch(self, commands: Dict[str, Tuple[str, Dict]], halt: bool = False, retry: bool = False) -> Dict:
+        """
+        Run up to BATCH_MAX_COMMANDS calls in one request.
+
+        commands maps a key to (method, params); a param value may refer to an
+        earlier command's result, e.g. '$result[p0][49][ID]'. Returns
+        {'success', 'result': {key: result}, 'errors': {key: error}}.
+        """
+        cmd = {key: f"{method}?{_query_string(params)}" for key, (method, params) in commands.items()}
+        result = self._call('batch', {'halt': int(halt), 'cmd': cmd}, retry=retry)
+        if not result.get('success'):
+            return result
+        body = result.get('result') or {}
+        return {'success': True, 'result': body.get('result') or {}, 'errors': body.get('result_error') or {}}
 
     # ============== CONTACTS (maps to QB Customers) ==============
 
@@ -199,6 +265,49 @@ class Bitrix24Client:
         """Add a new lead"""
         return self._call('crm.lead.add', {'fields': fields})
 
+    # ============== BULK LISTING ==============
+
+    def iter_list(self, method: str, select: List[str] = None, filter_params: Dict = None):
+        """
+        Yield every record from a *.list method (e.g. crm.contact.list).
+
+        Pages by ID (filter >ID, ordered by ID) with start=-1, which skips
+        Bitrix24's total count and offset scan, so each page costs the same
+        however deep into the table it is. Pages are fetched BATCH_MAX_COMMANDS
+        per request through batch(), each filtered on the last ID of the page
+        before it. Throttled and failed requests are retried with backoff;
+        raises RuntimeError if one still fails, so callers never mistake a
+        partial scan for a complete one.
+        """
+        params = {'order': {'ID': 'ASC'}, 'start': -1}
+        if select:
+            params['select'] = ['ID'] + [field for field in select if field != 'ID']
+
+        last_id = 0
+        while True:
+            commands = {}
+            for n in range(BATCH_MAX_COMMANDS):
+                after = last_id if n == 0 else f"$result[p{n - 1}][{LIST_PAGE_SIZE - 1}][ID]"
+                commands[f"p{n}"] = (method, {**params, 'filter': {**(filter_params or {}), '>ID': after}})
+
+            result = self.batch(commands, halt=True, retry=True)
+            if not result.get('success'):
+                raise RuntimeError(f"{method} failed after ID {last_id}: {result.get('error')}")
+
+            # Pages after a short one refer to a record that doesn't exist, so
+            # reading stops at the first short page
+            for n in range(BATCH_MAX_COMMANDS):
+                key = f"p{n}"
+                if key in result['errors']:
+                    raise RuntimeError(f"{method} failed after ID {last_id}: {result['errors'][key]}")
+                page = result['result'].get(key) or []
+                if page and int(page[0]['ID']) <= last_id:
+                    raise RuntimeError(f"{method} batch page {key} did not continue after ID {last_id}")
+                yield from page
+                if len(page) < LIST_PAGE_SIZE:
+                    return
+                last_id = int(page[-1]['ID'])
+
     # ============== UTILITY METHODS ==============
 
     def test_connection(self) -> Dict:
@@ -232,6 +341,25 @@ class Bitrix24Client:
         return self._call(method)
 
 
+def _query_string(params, prefix: str = None) -> str:
+    """
+    Params as a PHP-style query string (filter[>ID]=5&select[0]=ID) for a
+    batch command; '$result[...]' references are left unescaped.
+    """
+    parts = []
+    items = params.items() if isinstance(params, dict) else enumerate(params)
+    for key, value in items:
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        if isinstance(value, (dict, list, tuple)):
+            part = _query_string(value, name)
+        else:
+            text = str(value)
+            part = f"{quote(name, safe='[]')}={text if text.startswith('$result[') else quote(text, safe='')}"
+        if part:
+            parts.append(part)
+    return '&'.join(parts)
+
+
 # ============== MAPPING FUNCTIONS ==============
 
 def qb_customer_to_bitrix_contact(qb_customer: Dict) -> Dict:
@@ -311,12 +439,20 @@ def bitrix_contact_to_qb_customer(bitrix_contact: Dict) -> Dict:
     return qb_data
 
 
+def _json_amount(value) -> float:
+    """
+    Decimal amount as a JSON number. QB amounts have far fewer than 15
+    significant digits, so the float's repr is exactly the QB value.
+    """
+    return float(value) if value is not None else 0.0
+
+
 def qb_item_to_bitrix_product(qb_item: Dict) -> Dict:
     """Convert a QuickBooks item to Bitrix24 product fields"""
     fields = {
         'NAME': qb_item.get('Name') or qb_item.get('FullName', ''),
         'DESCRIPTION': qb_item.get('Description', ''),
-        'PRICE': float(qb_item.get('Price', 0) or 0),
+        'PRICE': _json_amount(decode(qb_item, 'Price')),
         'CURRENCY_ID': 'USD',
         'XML_ID': f"QB_{qb_item.get('ListID', '')}",
     }
@@ -328,15 +464,15 @@ def qb_invoice_to_bitrix_deal(qb_invoice: Dict) -> Dict:
     """Convert a QuickBooks invoice to Bitrix24 deal fields"""
     fields = {
         'TITLE': f"Invoice {qb_invoice.get('RefNumber', qb_invoice.get('TxnID', ''))}",
-        'OPPORTUNITY': float(qb_invoice.get('Subtotal', 0) or 0),
+        'OPPORTUNITY': _json_amount(decode(qb_invoice, 'Subtotal')),
         'CURRENCY_ID': 'USD',
         'COMMENTS': f"QB TxnID: {qb_invoice.get('TxnID', '')}\n{qb_invoice.get('Memo', '')}",
     }
 
     # Set stage based on payment status
-    if qb_invoice.get('IsPaid') == 'true':
+    if decode(qb_invoice, 'IsPaid'):
         fields['STAGE_ID'] = 'WON'
-    elif float(qb_invoice.get('BalanceRemaining', 0) or 0) > 0:
+    elif decode(qb_invoice, 'BalanceRemaining', Decimal(0)) > 0:
         fields['STAGE_ID'] = 'EXECUTING'
     else:
         fields['STAGE_ID'] = 'NEW'
@@ -1,213 +1,1298 @@
 """
 Database module for tracking sync state and ID mappings between QB and Bitrix24
+
+All state goes through a SyncStorage backend. The default is SQLiteStorage, a
+local file at DATABASE_PATH. Set DATABASE_BACKEND = "postgres" in config.py to
+share one store between several connector processes or hosts
+(see postgres_storage.py).
+
+The module-level functions below are the API the rest of the connector uses;
+they delegate to the configured backend.
 """
 
+import os
+import socket
 import sqlite3
-from datetime import datetime
-from config import DATABASE_PATH
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from payload_codec import encode_text, decode_text
+from config import (
+    DATABASE_PATH, DATABASE_BACKEND, DATABASE_URL, DATABASE_POOL_SIZE,
+    QUEUE_CLAIM_TIMEOUT_SECONDS, ARCHIVE_DATABASE_PATH, ARCHIVE_QUEUE_AFTER_DAYS,
+    ARCHIVE_BATCH_SIZE, STATUS_RECOUNT_SECONDS, MAPPING_INDEX_ENABLED,
+    QUEUE_MAX_ATTEMPTS, QUEUE_RETRY_BASE_SECONDS, QUEUE_RETRY_MAX_SECONDS,
+    SQLITE_SINGLE_WRITER, DATABASE_WRITE_QUEUE_SIZE, DATABASE_GROUP_COMMIT_MAX,
+    MAINTENANCE_BUDGET_SECONDS, MAINTENANCE_VACUUM_PAGES
+)
 
+# Queue statuses of items not yet settled with QuickBooks
+OUTSTANDING_QUEUE_STATUSES = ('pending', 'processing')
 
-def init_db():
-    """Initialize the sync state database"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-
-    # Table to track last sync times for each entity type
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sync_state (
-            entity_type TEXT PRIMARY KEY,
-            last_sync_qb_to_bitrix TIMESTAMP,
-            last_sync_bitrix_to_qb TIMESTAMP
-        )
-    ''')
-
-    # Table to map QuickBooks IDs to Bitrix24 IDs
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS id_mappings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            entity_type TEXT NOT NULL,
-            qb_id TEXT,
-            qb_list_id TEXT,
-            bitrix_id TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(entity_type, qb_list_id)
-        )
-    ''')
-
-    # Table to queue changes from Bitrix24 to be sent to QB
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS bitrix_to_qb_queue (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            entity_type TEXT NOT NULL,
-            bitrix_id TEXT NOT NULL,
-            action TEXT NOT NULL,
-            data TEXT,
-            status TEXT DEFAULT 'pending',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            processed_at TIMESTAMP,
-            error_message TEXT
-        )
-    ''')
-
-    # Table to log sync operations
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sync_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            direction TEXT NOT NULL,
-            entity_type TEXT NOT NULL,
-            qb_id TEXT,
-            bitrix_id TEXT,
-            action TEXT NOT NULL,
-            status TEXT NOT NULL,
-            message TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    conn.commit()
-    conn.close()
-    print(f"Database initialized at {DATABASE_PATH}")
+# Queue statuses that are final and can be moved to the archive table
+# ('failed' only on rows from before retries existed)
+ARCHIVED_QUEUE_STATUSES = ('completed', 'failed')
 
+# Dead-letter status: gave up after QUEUE_MAX_ATTEMPTS. Kept in the live table
+# until requeued by hand (requeue_dead_queue_item), never archived
+DEAD_QUEUE_STATUS = 'dead'
 
-def get_last_sync_time(entity_type, direction):
-    """Get the last sync time for an entity type and direction"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+# How bulk_save_id_mappings() treats rows whose (entity_type, qb_list_id) exists
+MAPPING_CONFLICT_POLICIES = ('skip', 'overwrite', 'fail')
 
-    column = 'last_sync_qb_to_bitrix' if direction == 'qb_to_bitrix' else 'last_sync_bitrix_to_qb'
-    cursor.execute(f'SELECT {column} FROM sync_state WHERE entity_type = ?', (entity_type,))
-    row = cursor.fetchone()
-    conn.close()
+# Columns copied verbatim from bitrix_to_qb_queue into the archive
+QUEUE_COLUMNS = ('id, entity_type, bitrix_id, action, data, status, created_at, '
+                 'processed_at, error_message, claimed_by, claimed_at, attempts, next_attempt_at')
 
-    return row[0] if row else None
 
+class SyncStorage:
+    """
+    Interface for the connector's persistent state.
 
-def update_last_sync_time(entity_type, direction):
-    """Update the last sync time for an entity type and direction"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    Covers four areas:
+    - sync state: per-entity watermarks for each direction
+    - ID mappings: QB ListID/TxnID <-> Bitrix24 ID, plus the last pushed payload hash
+    - queue: Bitrix24 -> QB changes waiting for the next Web Connector session
+    - log: one row per sync operation
+    """
 
-    column = 'last_sync_qb_to_bitrix' if direction == 'qb_to_bitrix' else 'last_sync_bitrix_to_qb'
-    now = datetime.now().isoformat()
+    def init_schema(self):
+        raise NotImplementedError
 
-    cursor.execute(f'''
-        INSERT INTO sync_state (entity_type, {column})
-        VALUES (?, ?)
-        ON CONFLICT(entity_type) DO UPDATE SET {column} = ?
-    ''', (entity_type, now, now))
+    # ============== SYNC STATE ==============
 
-    conn.commit()
-    conn.close()
+    def get_last_sync_time(self, entity_type, direction):
+        raise NotImplementedError
 
+    def update_last_sync_time(self, entity_type, direction, sync_time=None):
+        raise NotImplementedError
 
-def get_bitrix_id(entity_type, qb_list_id):
-    """Get Bitrix24 ID for a QuickBooks entity"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    # ============== ID MAPPINGS ==============
+
+    def get_bitrix_id(self, entity_type, qb_list_id):
+        raise NotImplementedError
+
+    def get_qb_list_id(self, entity_type, bitrix_id):
+        raise NotImplementedError
+
+    def get_id_mapping(self, entity_type, qb_list_id):
+        raise NotImplementedError
+
+    def save_id_mapping(self, entity_type, qb_list_id, bitrix_id, content_hash=None):
+        raise NotImplementedError
+
+    def iter_id_mappings(self, entity_type=None, batch_size=10000):
+        raise NotImplementedError
+
+    def bulk_save_id_mappings(self, rows, on_conflict='skip'):
+        raise NotImplementedError
+
+    # ============== QUEUE ==============
+
+    def add_to_qb_queue(self, entity_type, bitrix_id, action, data):
+        raise NotImplementedError
+
+    def get_pending_qb_queue(self):
+        raise NotImplementedError
+
+    def claim_pending_qb_queue(self, claimed_by, limit=None):
+        raise NotImplementedError
+
+    def mark_queue_item_processed(self, item_id, status='completed', error_message=None):
+        raise NotImplementedError
+
+    def get_dead_qb_queue(self):
+        raise NotImplementedError
+
+    def requeue_dead_queue_item(self, item_id):
+        raise NotImplementedError
+
+    def archive_queue(self, older_than, batch_size=500, max_batches=None):
+        raise NotImplementedError
+
+    def copy_queue_to_archive(self, older_than, batch_size=500):
+        raise NotImplementedError
+
+    def delete_archived_queue_rows(self, ids):
+        raise NotImplementedError
+
+    def query_queue_archive(self, entity_type=None, bitrix_id=None, status=None,
+                            since=None, limit=100):
+        raise NotImplementedError
+
+    # ============== LOG ==============
+
+    def log_sync(self, direction, entity_type, qb_id, bitrix_id, action, status, message=None):
+        raise NotImplementedError
+
+    def get_status_counts(self, exact=False):
+        raise NotImplementedError
+
+    # ============== MAINTENANCE ==============
+
+    def run_maintenance(self, budget_seconds=30):
+        raise NotImplementedError
+
+
+class MappingConflictError(ValueError):
+    """Bulk mapping import hit an existing mapping with on_conflict='fail'"""
+
+
+class StatusCounters:
+    """
+    In-memory /status counters, seeded by an exact recount and then kept
+    up to date by the write paths.
+
+    Increments only see this process's writes (and may include writes that
+    were later rolled back), so the counters are re-seeded from the database
+    once they are older than the consistency window.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = None
+        self._loaded_at = None
+
+    def is_fresh(self, max_age_seconds):
+        with self._lock:
+            return (self._counts is not None and
+                    time.monotonic() - self._loaded_at < max_age_seconds)
+
+    def load(self, counts):
+        with self._lock:
+            self._counts = dict(counts)
+            self._loaded_at = time.monotonic()
+
+    def add(self, name, amount=1):
+        if not amount:
+            return
+        with self._lock:
+            if self._counts is not None:
+                self._counts[name] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def invalidate(self):
+        """Force a recount on next use (after writes the counters can't track)"""
+        with self._lock:
+            self._counts = None
+
+
+class SQLStorage(SyncStorage):
+    """
+    SyncStorage over a DB-API connection, shared by the SQLite and server backends.
+
+    Statements use '?' placeholders and SQL understood by both SQLite and
+    PostgreSQL. Subclasses provide connections, the schema and the row-locking
+    clause used when claiming queue items.
+    """
+
+    # Appended to the queue claim subquery (e.g. FOR UPDATE SKIP LOCKED)
+    claim_lock_clause = ''
+
+    # Compress queue payloads and sync_log messages (see payload_codec.py)
+    compress_text = False
+
+    # Where archived queue rows live (SQLite may point this at an attached database)
+    archive_table = 'bitrix_to_qb_queue_archive'
+
+    def __init__(self):
+        self._local = threading.local()
+        self.counters = StatusCounters()
+        # Optional in-memory MappingIndex (see mapping_index.py)
+        self.mapping_index = None
+
+    @contextmanager
+    def _connection(self):
+        """Yield a connection; subclasses open or borrow one"""
+        raise NotImplementedError
+
+    def _begin(self, cursor):
+        """Start a write transaction"""
+
+    def _lock_queue_key(self, cursor, entity_type, bitrix_id):
+        """Serialize concurrent writers for one queue key (no-op if _begin already does)"""
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the enclosed writes in one transaction and yield its cursor.
+
+        Nested calls in the same thread join the outer transaction.
+        """
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is not None:
+            yield cursor
+            return
+
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            self._begin(cursor)
+            self._local.cursor = cursor
+            self._local.index_updates = []
+            try:
+                yield cursor
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            else:
+                # Only committed mappings become visible through the index
+                for update in self._local.index_updates:
+                    if update is None:
+                        self.mapping_index.clear()
+                    else:
+                        self.mapping_index.put(*update)
+            finally:
+                self._local.cursor = None
+                self._local.index_updates = []
+
+    def apply_writes(self, ops):
+        """Run a list of (method name, args) writes in one transaction (all or nothing)"""
+        with self.transaction():
+            for method, args in ops:
+                getattr(self, method)(*args)
+
+    def run_write_batch(self, calls):
+        """
+        Run independent (method name, args) writes in one transaction, each
+        under its own savepoint, so a failing call is rolled back alone.
+
+        Returns one (ok, result or exception) pair per call. Used by the
+        single-writer thread (db_writer.py) to group-commit callers' writes.
+        """
+        outcomes = []
+        with self.transaction() as cursor:
+            for method, args in calls:
+                index_updates = len(self._local.index_updates)
+                cursor.execute('SAVEPOINT write_call')
+                try:
+                    result = getattr(self, method)(*args)
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO write_call')
+                    cursor.execute('RELEASE write_call')
+                    del self._local.index_updates[index_updates:]
+                    outcomes.append((False, e))
+                else:
+                    cursor.execute('RELEASE write_call')
+                    outcomes.append((True, result))
+        return outcomes
+
+    def _encode(self, value):
+        return encode_text(value) if self.compress_text else value
+
+    def _fetchone(self, sql, params=()):
+        rows = self._fetchall(sql, params)
+        return rows[0] if rows else None
+
+    def _fetchall(self, sql, params=()):
+        # Inside a transaction, read through it so callers see their own writes
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is not None:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    # ============== SYNC STATE ==============
+
+    def get_last_sync_time(self, entity_type, direction):
+        column = 'last_sync_qb_to_bitrix' if direction == 'qb_to_bitrix' else 'last_sync_bitrix_to_qb'
+        row = self._fetchone(f'SELECT {column} FROM sync_state WHERE entity_type = ?', (entity_type,))
+        return row[0] if row else None
+
+    def update_last_sync_time(self, entity_type, direction, sync_time=None):
+        column = 'last_sync_qb_to_bitrix' if direction == 'qb_to_bitrix' else 'last_sync_bitrix_to_qb'
+        value = sync_time or datetime.now().isoformat()
+
+        with self.transaction() as cursor:
+            cursor.execute(f'''
+                INSERT INTO sync_state (entity_type, {column})
+                VALUES (?, ?)
+                ON CONFLICT(entity_type) DO UPDATE SET {column} = excluded.{column}
+            ''', (entity_type, value))
+
+    # ============== ID MAPPINGS ==============
+
+    def get_bitrix_id(self, entity_type, qb_list_id):
+        if self.mapping_index is not None:
+            mapping = self.mapping_index.get(entity_type, qb_list_id)
+            return mapping['bitrix_id'] if mapping else None
+
+        row = self._fetchone('''
+            SELECT bitrix_id FROM id_mappings
+            WHERE entity_type = ? AND qb_list_id = ?
+        ''', (entity_type, qb_list_id))
+        return row[0] if row else None
+
+    def get_qb_list_id(self, entity_type, bitrix_id):
+        row = self._fetchone('''
+            SELECT qb_list_id FROM id_mappings
+            WHERE entity_type = ? AND bitrix_id = ?
+        ''', (entity_type, bitrix_id))
+        return row[0] if row else None
+
+    def get_id_mapping(self, entity_type, qb_list_id):
+        if self.mapping_index is not None:
+            return self.mapping_index.get(entity_type, qb_list_id)
+
+        row = self._fetchone('''
+            SELECT bitrix_id, content_hash FROM id_mappings
+            WHERE entity_type = ? AND qb_list_id = ?
+        ''', (entity_type, qb_list_id))
+        return {'bitrix_id': row[0], 'content_hash': row[1]} if row else None
+
+    def save_id_mapping(self, entity_type, qb_list_id, bitrix_id, content_hash=None):
+        now = datetime.now().isoformat()
+        with self.transaction() as cursor:
+            if self.mapping_index is not None:
+                self._local.index_updates.append((entity_type, qb_list_id, bitrix_id, content_hash))
+
+            # Insert and update are separate statements so we know whether the
+            # mapping count changed
+            cursor.execute('''
+                INSERT INTO id_mappings (entity_type, qb_list_id, bitrix_id, content_hash, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(entity_type, qb_list_id) DO NOTHING
+            ''', (entity_type, qb_list_id, bitrix_id, content_hash, now))
+            if cursor.rowcount:
+                self.counters.add('id_mappings')
+                return
+
+            cursor.execute('''
+                UPDATE id_mappings
+                SET bitrix_id = ?, content_hash = COALESCE(?, content_hash), updated_at = ?
+                WHERE entity_type = ? AND qb_list_id = ?
+            ''', (bitrix_id, content_hash, now, entity_type, qb_list_id))
+
+    def iter_id_mappings(self, entity_type=None, batch_size=10000):
+        """
+        Yield (entity_type, qb_list_id, bitrix_id, content_hash) ordered by type and ListID.
+
+        Pages with keyset pagination, so memory stays flat however large the table is.
+        """
+        after = ('', '') if entity_type is None else (entity_type, '')
+        while True:
+            if entity_type is None:
+                rows = self._fetchall('''
+                    SELECT entity_type, qb_list_id, bitrix_id, content_hash FROM id_mappings
+                    WHERE (entity_type, qb_list_id) > (?, ?)
+                    ORDER BY entity_type, qb_list_id
+                    LIMIT ?
+                ''', (after[0], after[1], batch_size))
+            else:
+                rows = self._fetchall('''
+                    SELECT entity_type, qb_list_id, bitrix_id, content_hash FROM id_mappings
+                    WHERE entity_type = ? AND qb_list_id > ?
+                    ORDER BY qb_list_id
+                    LIMIT ?
+                ''', (entity_type, after[1], batch_size))
+            if not rows:
+                return
+            yield from rows
+            after = (rows[-1][0], rows[-1][1])
+
+    def bulk_save_id_mappings(self, rows, on_conflict='skip'):
+        """
+        Write a batch of (entity_type, qb_list_id, bitrix_id, content_hash) rows in one transaction.
+
+        on_conflict: 'skip' keeps existing mappings, 'overwrite' replaces them,
+        'fail' raises MappingConflictError and rolls the batch back.
+        Returns the number of rows inserted or overwritten.
+        """
+        if on_conflict not in MAPPING_CONFLICT_POLICIES:
+            raise ValueError(f"on_conflict must be one of {MAPPING_CONFLICT_POLICIES}")
+        if not rows:
+            return 0
+
+        if on_conflict == 'overwrite':
+            resolution = '''DO UPDATE SET bitrix_id = excluded.bitrix_id,
+                content_hash = excluded.content_hash, updated_at = excluded.updated_at'''
+        else:
+            resolution = 'DO NOTHING'
+
+        now = datetime.now().isoformat()
+        with self.transaction() as cursor:
+            cursor.executemany(f'''
+                INSERT INTO id_mappings (entity_type, qb_list_id, bitrix_id, content_hash, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(entity_type, qb_list_id) {resolution}
+            ''', [(entity_type, qb_list_id, bitrix_id, content_hash, now)
+                  for entity_type, qb_list_id, bitrix_id, content_hash in rows])
+            written = cursor.rowcount
+
+            if on_conflict == 'fail' and written < len(rows):
+                raise MappingConflictError(
+                    f"{len(rows) - written} of {len(rows)} mappings in the batch already exist")
+
+            # Bypasses save_id_mapping(), so reload the index from the table once committed
+            if self.mapping_index is not None:
+                self._local.index_updates.append(None)
+
+        self.counters.invalidate()
+        return written
+
+    # ============== QUEUE ==============
+
+    def add_to_qb_queue(self, entity_type, bitrix_id, action, data):
+        data = self._encode(data)
+        with self.transaction() as cursor:
+            self._lock_queue_key(cursor, entity_type, bitrix_id)
+            cursor.execute('''
+                SELECT id, action FROM bitrix_to_qb_queue
+                WHERE entity_type = ? AND bitrix_id = ? AND status = 'pending'
+                ORDER BY id DESC
+                LIMIT 1
+            ''', (entity_type, bitrix_id))
+            row = cursor.fetchone()
+
+            if row is None:
+                cursor.execute('''
+                    INSERT INTO bitrix_to_qb_queue (entity_type, bitrix_id, action, data)
+                    VALUES (?, ?, ?, ?)
+                    RETURNING id
+                ''', (entity_type, bitrix_id, action, data))
+                self.counters.add('pending_queue')
+                return cursor.fetchone()[0]
+
+            item_id, pending_action = row
+            merged_action = coalesce_queue_actions(pending_action, action)
+
+            if merged_action is None:
+                cursor.execute('DELETE FROM bitrix_to_qb_queue WHERE id = ?', (item_id,))
+                self.counters.add('pending_queue', -1)
+                return None
+
+            cursor.execute('''
+                UPDATE bitrix_to_qb_queue SET action = ?, data = ?
+                WHERE id = ?
+            ''', (merged_action, data, item_id))
+            return item_id
+
+    def get_pending_qb_queue(self):
+        rows = self._fetchall('''
+            SELECT id, entity_type, bitrix_id, action, data
+            FROM bitrix_to_qb_queue
+            WHERE status = 'pending'
+              AND (next_attempt_at IS NULL OR next_attempt_at <= ?)
+            ORDER BY created_at, id
+        ''', (datetime.now().isoformat(),))
+        return [_queue_row_to_dict(r) for r in rows]
+
+    def claim_pending_qb_queue(self, claimed_by, limit=None):
+        now = datetime.now()
+        stale_before = (now - timedelta(seconds=QUEUE_CLAIM_TIMEOUT_SECONDS)).isoformat()
+        limit_sql = 'LIMIT ?' if limit else ''
+        params = ((claimed_by, now.isoformat(), now.isoformat(), stale_before)
+                  + ((limit,) if limit else ()))
+
+        with self.transaction() as cursor:
+            cursor.execute(f'''
+                UPDATE bitrix_to_qb_queue
+                SET status = 'processing', claimed_by = ?, claimed_at = ?
+                WHERE id IN (
+                    SELECT id FROM bitrix_to_qb_queue
+                    WHERE (status = 'pending'
+                           AND (next_attempt_at IS NULL OR next_attempt_at <= ?))
+                       OR (status = 'processing' AND claimed_at < ?)
+                    ORDER BY created_at, id
+                    {limit_sql}
+                    {self.claim_lock_clause}
+                )
+                RETURNING id, entity_type, bitrix_id, action, data, created_at
+            ''', params)
+            rows = cursor.fetchall()
+
+        rows.sort(key=lambda r: (str(r[5]), r[0]))
+        return [_queue_row_to_dict(r) for r in rows]
+
+    def mark_queue_item_processed(self, item_id, status='completed', error_message=None):
+        if status == 'failed':
+            self._record_queue_failure(item_id, error_message)
+            return
+
+        with self.transaction() as cursor:
+            cursor.execute(f'''
+                UPDATE bitrix_to_qb_queue
+                SET status = ?, processed_at = ?, error_message = ?
+                WHERE id = ? AND status IN ({', '.join('?' * len(OUTSTANDING_QUEUE_STATUSES))})
+            ''', (status, datetime.now().isoformat(), error_message, item_id) + OUTSTANDING_QUEUE_STATUSES)
+            if status not in OUTSTANDING_QUEUE_STATUSES:
+                self.counters.add('pending_queue', -cursor.rowcount)
+            if status == DEAD_QUEUE_STATUS:
+                self.counters.add('dead_queue', cursor.rowcount)
+
+    def _record_queue_failure(self, item_id, error_message):
+        """Count a failed attempt: schedule a retry with backoff, or dead-letter the item"""
+        now = datetime.now()
+        with self.transaction() as cursor:
+            # Bump the counter first; in PostgreSQL this also locks the row
+            cursor.execute(f'''
+                UPDATE bitrix_to_qb_queue
+                SET attempts = COALESCE(attempts, 0) + 1, processed_at = ?, error_message = ?,
+                    claimed_by = NULL, claimed_at = NULL
+                WHERE id = ? AND status IN ({', '.join('?' * len(OUTSTANDING_QUEUE_STATUSES))})
+                RETURNING attempts
+            ''', (now.isoformat(), error_message, item_id) + OUTSTANDING_QUEUE_STATUSES)
+            row = cursor.fetchone()
+            if row is None:
+                return
+
+            attempts = row[0]
+            if attempts >= QUEUE_MAX_ATTEMPTS:
+                cursor.execute('''
+                    UPDATE bitrix_to_qb_queue SET status = ?, next_attempt_at = NULL
+                    WHERE id = ?
+                ''', (DEAD_QUEUE_STATUS, item_id))
+                self.counters.add('pending_queue', -1)
+                self.counters.add('dead_queue')
+            else:
+                next_attempt = now + timedelta(seconds=retry_delay_seconds(attempts))
+                cursor.execute('''
+                    UPDATE bitrix_to_qb_queue SET status = 'pending', next_attempt_at = ?
+                    WHERE id = ?
+                ''', (next_attempt.isoformat(), item_id))
+
+    def get_dead_qb_queue(self):
+        rows = self._fetchall(f'''
+            SELECT {QUEUE_COLUMNS} FROM bitrix_to_qb_queue
+            WHERE status = ?
+            ORDER BY id
+        ''', (DEAD_QUEUE_STATUS,))
+        columns = [c.strip() for c in QUEUE_COLUMNS.split(',')]
+        return [dict(zip(columns, row), data=decode_text(row[4])) for row in rows]
+
+    def requeue_dead_queue_item(self, item_id):
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE bitrix_to_qb_queue
+                SET status = 'pending', attempts = 0, next_attempt_at = NULL,
+                    claimed_by = NULL, claimed_at = NULL
+                WHERE id = ? AND status = ?
+            ''', (item_id, DEAD_QUEUE_STATUS))
+            requeued = cursor.rowcount
+        self.counters.add('pending_queue', requeued)
+        self.counters.add('dead_queue', -requeued)
+        return bool(requeued)
+
+    def archive_queue(self, older_than, batch_size=500, max_batches=None):
+        """
+        Move completed/failed queue rows processed before older_than into the archive.
+
+        Each batch is copied and committed to the archive first, then deleted
+        from the queue in a second short transaction, so webhook writers are
+        never blocked for long. Two commits also keep an archive in a separate
+        attached SQLite file safe: SQLite doesn't commit atomically across
+        attached databases in WAL mode, so the delete only removes rows whose
+        copy already committed. A crash in between leaves rows in both tables;
+        the next run re-copies them as a no-op and deletes them.
+        Returns the number of rows moved.
+        """
+        moved = 0
+        batches = 0
+
+        while max_batches is None or batches < max_batches:
+            ids = self.copy_queue_to_archive(older_than, batch_size)
+            if ids:
+                moved += self.delete_archived_queue_rows(ids)
+            batches += 1
+            if len(ids) < batch_size:
+                break
+
+        return moved
+
+    def copy_queue_to_archive(self, older_than, batch_size=500):
+        """Copy up to batch_size finished rows into the archive; returns their ids"""
+        with self.transaction() as cursor:
+            cursor.execute(f'''
+                SELECT id FROM bitrix_to_qb_queue
+                WHERE status IN ({', '.join('?' * len(ARCHIVED_QUEUE_STATUSES))})
+                  AND processed_at < ?
+                ORDER BY id
+                LIMIT ?
+            ''', ARCHIVED_QUEUE_STATUSES + (older_than.isoformat(), batch_size))
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                return []
+
+            cursor.execute(f'''
+                INSERT INTO {self.archive_table}
+                    ({QUEUE_COLUMNS}, archived_at)
+                SELECT {QUEUE_COLUMNS}, ?
+                FROM bitrix_to_qb_queue
+                WHERE id IN ({', '.join('?' * len(ids))})
+                ON CONFLICT(id) DO NOTHING
+            ''', [datetime.now().isoformat()] + ids)
+        return ids
+
+    def delete_archived_queue_rows(self, ids):
+        """Delete queue rows among ids that are present in the archive; returns how many"""
+        id_list = ', '.join('?' * len(ids))
+        with self.transaction() as cursor:
+            cursor.execute(f'''
+                DELETE FROM bitrix_to_qb_queue
+                WHERE id IN ({id_list})
+                  AND id IN (SELECT id FROM {self.archive_table} WHERE id IN ({id_list}))
+            ''', ids + ids)
+            return cursor.rowcount
+
+    def query_queue_archive(self, entity_type=None, bitrix_id=None, status=None,
+                            since=None, limit=100):
+        """Look up archived queue rows for audits, newest first"""
+        conditions = []
+        params = []
+        for column, value in (('entity_type', entity_type), ('bitrix_id', bitrix_id),
+                              ('status', status)):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                params.append(value)
+        if since is not None:
+            conditions.append('processed_at >= ?')
+            params.append(since.isoformat())
 
-    cursor.execute('''
-        SELECT bitrix_id FROM id_mappings
-        WHERE entity_type = ? AND qb_list_id = ?
-    ''', (entity_type, qb_list_id))
-    row = cursor.fetchone()
-    conn.close()
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        rows = self._fetchall(f'''
+            SELECT {QUEUE_COLUMNS}, archived_at
+            FROM {self.archive_table}
+            {where}
+            ORDER BY id DESC
+            LIMIT ?
+        ''', params + [limit])
 
-    return row[0] if row else None
+        columns = [c.strip() for c in QUEUE_COLUMNS.split(',')] + ['archived_at']
+        results = []
+        for row in rows:
+            item = dict(zip(columns, row))
+            item['data'] = decode_text(item['data'])
+            results.append(item)
+        return results
+
+    # ============== LOG ==============
+
+    def log_sync(self, direction, entity_type, qb_id, bitrix_id, action, status, message=None):
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO sync_log (direction, entity_type, qb_id, bitrix_id, action, status, message)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (direction, entity_type, qb_id, bitrix_id, action, status, self._encode(message)))
+        self.counters.add('syncs_last_24h')
+
+    def get_status_counts(self, exact=False):
+        """
+        Counts for /status, served from memory.
+
+        A full recount runs when exact is set or the counters are older than
+        STATUS_RECOUNT_SECONDS (which also ages old syncs out of the 24h window).
+        """
+        if not exact and self.counters.is_fresh(STATUS_RECOUNT_SECONDS):
+            return self.counters.snapshot()
+
+        counts = self.count_status_rows()
+        self.counters.load(counts)
+        return counts
+
+    def count_status_rows(self):
+        """Exact COUNT(*) of the /status numbers"""
+        # created_at defaults to CURRENT_TIMESTAMP, which is UTC
+        cutoff = (datetime.utcnow() - timedelta(hours=24)).strftime('%Y-%m-%d %H:%M:%S')
+        return {
+            'id_mappings': self._fetchone('SELECT COUNT(*) FROM id_mappings')[0],
+            'syncs_last_24h': self._fetchone(
+                'SELECT COUNT(*) FROM sync_log WHERE created_at > ?', (cutoff,))[0],
+            'pending_queue': self._fetchone(f'''
+                SELECT COUNT(*) FROM bitrix_to_qb_queue
+                WHERE status IN ({', '.join('?' * len(OUTSTANDING_QUEUE_STATUSES))})
+            ''', OUTSTANDING_QUEUE_STATUSES)[0],
+            'dead_queue': self._fetchone(
+                'SELECT COUNT(*) FROM bitrix_to_qb_queue WHERE status = ?', (DEAD_QUEUE_STATUS,))[0],
+        }
+
+
+class SQLiteStorage(SQLStorage):
+    """Default backend: a local SQLite file, one connection per operation"""
+
+    compress_text = True
+
+    def __init__(self, path, archive_path=None, mapping_index=False):
+        super().__init__()
+        self.path = path
+        self.archive_path = archive_path
+        # Cold rows can go to a separate file attached to every connection
+        self.archive_schema = 'archive.' if archive_path else ''
+        self.archive_table = f'{self.archive_schema}bitrix_to_qb_queue_archive'
+
+        if mapping_index:
+            from mapping_index import MappingIndex
+            self.mapping_index = MappingIndex(
+                lambda entity_type: (row[1:] for row in self.iter_id_mappings(entity_type)))
+
+    @contextmanager
+    def _connection(self):
+        # Autocommit mode; transaction() issues BEGIN IMMEDIATE itself so the
+        # write lock is taken up front instead of on the first write
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        if self.archive_path:
+            conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _begin(self, cursor):
+        cursor.execute('BEGIN IMMEDIATE')
+
+    def _schemas(self):
+        return ['main', 'archive'] if self.archive_path else ['main']
+
+    def init_schema(self):
+        with self._connection() as conn:
+            for schema in self._schemas():
+                # Only takes effect on a new, empty file; older files need one
+                # full VACUUM (python database.py vacuum) to switch
+                conn.execute(f'PRAGMA {schema}.auto_vacuum=INCREMENTAL')
+                # WAL lets readers run alongside the writer (persistent; can't be set inside a transaction)
+                conn.execute(f'PRAGMA {schema}.journal_mode=WAL')
+
+        with self.transaction() as cursor:
+            # Table to track last sync times for each entity type
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    entity_type TEXT PRIMARY KEY,
+                    last_sync_qb_to_bitrix TIMESTAMP,
+                    last_sync_bitrix_to_qb TIMESTAMP
+                )
+            ''')
+
+            # Table to map QuickBooks IDs to Bitrix24 IDs
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS id_mappings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    entity_type TEXT NOT NULL,
+                    qb_id TEXT,
+                    qb_list_id TEXT,
+                    bitrix_id TEXT,
+                    content_hash TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE(entity_type, qb_list_id)
+                )
+            ''')
+            _ensure_column(cursor, 'id_mappings', 'content_hash', 'TEXT')
+
+            # Table to queue changes from Bitrix24 to be sent to QB
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bitrix_to_qb_queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    entity_type TEXT NOT NULL,
+                    bitrix_id TEXT NOT NULL,
+                    action TEXT NOT NULL,
+                    data TEXT,
+                    status TEXT DEFAULT 'pending',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    processed_at TIMESTAMP,
+                    error_message TEXT,
+                    claimed_by TEXT,
+                    claimed_at TIMESTAMP,
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at TIMESTAMP
+                )
+            ''')
+            _ensure_column(cursor, 'bitrix_to_qb_queue', 'claimed_by', 'TEXT')
+            _ensure_column(cursor, 'bitrix_to_qb_queue', 'claimed_at', 'TIMESTAMP')
+            _ensure_column(cursor, 'bitrix_to_qb_queue', 'attempts', 'INTEGER DEFAULT 0')
+            _ensure_column(cursor, 'bitrix_to_qb_queue', 'next_attempt_at', 'TIMESTAMP')
+
+            # Pending lookups (queue scan and coalescing on insert)
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_queue_pending
+                ON bitrix_to_qb_queue (status, entity_type, bitrix_id)
+            ''')
+
+            # Cold storage for finished queue rows (see archive_queue)
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {self.archive_table} (
+                    id INTEGER PRIMARY KEY,
+                    entity_type TEXT NOT NULL,
+                    bitrix_id TEXT NOT NULL,
+                    action TEXT NOT NULL,
+                    data TEXT,
+                    status TEXT,
+                    created_at TIMESTAMP,
+                    processed_at TIMESTAMP,
+                    error_message TEXT,
+                    claimed_by TEXT,
+                    claimed_at TIMESTAMP,
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at TIMESTAMP,
+                    archived_at TIMESTAMP
+                )
+            ''')
+            for column, declaration in (('attempts', 'INTEGER DEFAULT 0'), ('next_attempt_at', 'TIMESTAMP')):
+                _ensure_column(cursor, 'bitrix_to_qb_queue_archive', column, declaration,
+                               schema=self.archive_schema)
+            cursor.execute(f'''
+                CREATE INDEX IF NOT EXISTS {self.archive_schema}idx_queue_archive_entity
+                ON bitrix_to_qb_queue_archive (entity_type, bitrix_id)
+            ''')
+
+            # Table to log sync operations
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sync_log (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    direction TEXT NOT NULL,
+                    entity_type TEXT NOT NULL,
+                    qb_id TEXT,
+                    bitrix_id TEXT,
+                    action TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    message TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+    def run_maintenance(self, budget_seconds=30):
+        """
+        Reclaim free pages, refresh planner statistics and checkpoint the WAL.
+
+        Work is done in small steps, each holding the write lock only briefly,
+        and stops once budget_seconds is used up. Returns a report dict with
+        bytes reclaimed and time taken.
+        """
+        start = time.monotonic()
+        deadline = start + budget_seconds
+        report = {'reclaimed_bytes': 0, 'steps': []}
+
+        with self._connection() as conn:
+            for schema in self._schemas():
+                page_size = conn.execute(f'PRAGMA {schema}.page_size').fetchone()[0]
+                pages_before = conn.execute(f'PRAGMA {schema}.page_count').fetchone()[0]
+
+                # Move committed WAL pages into the file without waiting on readers/writers
+                conn.execute(f'PRAGMA {schema}.wal_checkpoint(PASSIVE)').fetchall()
+
+                if conn.execute(f'PRAGMA {schema}.auto_vacuum').fetchone()[0] == 2:
+                    while time.monotonic() < deadline:
+                        if not conn.execute(f'PRAGMA {schema}.freelist_count').fetchone()[0]:
+                            break
+                        # fetchall(): each step of the statement frees one page
+                        conn.execute(f'PRAGMA {schema}.incremental_vacuum({MAINTENANCE_VACUUM_PAGES})').fetchall()
+                    report['steps'].append(f'{schema}: incremental_vacuum')
+                else:
+                    free = conn.execute(f'PRAGMA {schema}.freelist_count').fetchone()[0]
+                    if free:
+                        report['steps'].append(
+                            f'{schema}: {free} free pages need a full VACUUM (python database.py vacuum)')
+
+                if time.monotonic() < deadline:
+                    # Bounded ANALYZE of tables whose statistics are stale
+                    conn.execute('PRAGMA analysis_limit=400')
+                    conn.execute(f'PRAGMA {schema}.optimize').fetchall()
+                    report['steps'].append(f'{schema}: optimize')
+
+                if time.monotonic() < deadline:
+                    conn.execute(f'PRAGMA {schema}.wal_checkpoint(PASSIVE)').fetchall()
+                    report['steps'].append(f'{schema}: wal_checkpoint')
+
+                pages_after = conn.execute(f'PRAGMA {schema}.page_count').fetchone()[0]
+                report['reclaimed_bytes'] += (pages_before - pages_after) * page_size
+
+        report['seconds'] = round(time.monotonic() - start, 3)
+        return report
+
+    def vacuum(self):
+        """Full VACUUM (blocks all writers); also switches older files to incremental auto_vacuum"""
+        with self._connection() as conn:
+            for schema in self._schemas():
+                conn.execute(f'PRAGMA {schema}.auto_vacuum=INCREMENTAL')
+                conn.execute(f'VACUUM {schema}')
+
+    def __repr__(self):
+        if self.archive_path:
+            return f"SQLiteStorage({self.path!r}, archive_path={self.archive_path!r})"
+        return f"SQLiteStorage({self.path!r})"
+
+
+def _ensure_column(cursor, table, column, declaration, schema=''):
+    """Add a column to an existing SQLite table if an older database lacks it"""
+    cursor.execute(f'PRAGMA {schema}table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {schema}{table} ADD COLUMN {column} {declaration}')
+
+
+def _queue_row_to_dict(row):
+    return {'id': row[0], 'entity_type': row[1], 'bitrix_id': row[2],
+            'action': row[3], 'data': decode_text(row[4])}
+
+
+def retry_delay_seconds(attempts):
+    """Exponential backoff before retrying a queue item that has failed `attempts` times"""
+    return min(QUEUE_RETRY_BASE_SECONDS * 2 ** (attempts - 1), QUEUE_RETRY_MAX_SECONDS)
+
+
+def coalesce_queue_actions(pending_action, new_action):
+    """
+    Fold a new queue action into an already pending one.
+
+    Returns the resulting action, or None if the two cancel out.
+    """
+    if pending_action == 'add':
+        if new_action == 'delete':
+            return None
+        return 'add'
+    return new_action
+
+
+# ============== BACKEND SELECTION ==============
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def create_storage(backend=None):
+    """Build the storage backend named in config (or the given backend name)"""
+    backend = (backend or DATABASE_BACKEND or 'sqlite').lower()
+    if backend == 'sqlite':
+        storage = SQLiteStorage(DATABASE_PATH, archive_path=ARCHIVE_DATABASE_PATH or None,
+                                mapping_index=MAPPING_INDEX_ENABLED)
+        if SQLITE_SINGLE_WRITER:
+            from db_writer import SingleWriterStorage
+            storage = SingleWriterStorage(storage, DATABASE_WRITE_QUEUE_SIZE, DATABASE_GROUP_COMMIT_MAX)
+        return storage
+    if backend in ('postgres', 'postgresql'):
+        from postgres_storage import PostgresStorage
+        return PostgresStorage(DATABASE_URL, pool_size=DATABASE_POOL_SIZE)
+    raise ValueError(f"Unknown DATABASE_BACKEND: {backend}")
+
+
+def get_storage():
+    """Get the process-wide storage backend, creating it on first use"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage()
+    return _storage
+
+
+def set_storage(storage):
+    """Replace the process-wide storage backend (e.g. with a local stand-in)"""
+    global _storage
+    _storage = storage
+
+
+def worker_id():
+    """Identify this connector process in queue claims"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def submit_write(method, *args):
+    """
+    Start a storage write (e.g. submit_write('log_sync', ...)) and return a Future.
+
+    With the single-writer thread the write is queued for the next group
+    commit; otherwise it runs before this returns.
+    """
+    storage = get_storage()
+    if hasattr(storage, 'submit'):
+        return storage.submit(method, *args)
+
+    future = Future()
+    try:
+        future.set_result(getattr(storage, method)(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+# ============== UNIT OF WORK ==============
+
+class UnitOfWork:
+    """
+    Write-behind buffer for the sync state writes made while processing a response.
+
+    save_id_mapping, log_sync, mark_queue_item_processed and
+    update_last_sync_time calls made in this thread are queued and applied
+    together in one transaction on flush(). Nothing is held open between
+    flushes, so Bitrix24 calls made mid-chunk never sit inside a database
+    transaction. Mapping and watermark reads see the buffered writes.
+    The mapping of a newly created Bitrix24 entity flushes at once (see
+    save_id_mapping()).
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.ops = []
+        self.mappings = {}
+        self.sync_times = {}
+
+    def add(self, method, *args):
+        self.ops.append((method, args))
+        if method == 'save_id_mapping':
+            entity_type, qb_list_id, bitrix_id, content_hash = args
+            previous = self.mappings.get((entity_type, qb_list_id), {})
+            self.mappings[(entity_type, qb_list_id)] = {
+                'bitrix_id': bitrix_id,
+                'content_hash': content_hash or previous.get('content_hash'),
+            }
+        elif method == 'update_last_sync_time':
+            entity_type, direction, sync_time = args
+            self.sync_times[(entity_type, direction)] = sync_time or datetime.now().isoformat()
+
+    def flush(self):
+        """Apply all buffered writes in a single transaction"""
+        if not self.ops:
+            return
+        ops, self.ops = self.ops, []
+        self.storage.apply_writes(ops)
+        self.mappings.clear()
+        self.sync_times.clear()
+
+
+_uow_local = threading.local()
+
+
+@contextmanager
+def unit_of_work():
+    """
+    Group the sync state writes made in this thread into one transaction.
+
+    Call flush() on the yielded UnitOfWork to commit a chunk early. Writes
+    are flushed on exit even if the block raises: they record work already
+    done in Bitrix24/QB and must not be lost. Nested calls join the outer unit.
+    """
+    current = getattr(_uow_local, 'uow', None)
+    if current is not None:
+        yield current
+        return
+
+    uow = UnitOfWork(get_storage())
+    _uow_local.uow = uow
+    try:
+        yield uow
+    finally:
+        _uow_local.uow = None
+        uow.flush()
+
+
+def _write(method, *args):
+    """Run a storage write now, or buffer it if a unit of work is active"""
+    uow = getattr(_uow_local, 'uow', None)
+    if uow is not None:
+        uow.add(method, *args)
+    else:
+        getattr(get_storage(), method)(*args)
+
+
+def _buffered_mapping(entity_type, qb_list_id):
+    uow = getattr(_uow_local, 'uow', None)
+    return uow.mappings.get((entity_type, qb_list_id)) if uow is not None else None
+
+
+# ============== PUBLIC API ==============
+
+def init_db():
+    """Initialize the sync state database"""
+    storage = get_storage()
+    storage.init_schema()
+    print(f"Database initialized: {storage!r}")
+
+
+def get_last_sync_time(entity_type, direction):
+    """Get the last sync time for an entity type and direction"""
+    uow = getattr(_uow_local, 'uow', None)
+    if uow is not None and (entity_type, direction) in uow.sync_times:
+        return uow.sync_times[(entity_type, direction)]
+    return get_storage().get_last_sync_time(entity_type, direction)
+
+
+def update_last_sync_time(entity_type, direction, sync_time=None):
+    """
+    Update the last sync time for an entity type and direction.
+
+    sync_time is the watermark to store (e.g. the newest QB TimeModified
+    processed); it defaults to the current local time.
+    """
+    _write('update_last_sync_time', entity_type, direction, sync_time)
+
+
+def get_bitrix_id(entity_type, qb_list_id):
+    """Get Bitrix24 ID for a QuickBooks entity"""
+    buffered = _buffered_mapping(entity_type, qb_list_id)
+    if buffered is not None:
+        return buffered['bitrix_id']
+    return get_storage().get_bitrix_id(entity_type, qb_list_id)
 
 
 def get_qb_list_id(entity_type, bitrix_id):
     """Get QuickBooks ListID for a Bitrix24 entity"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    return get_storage().get_qb_list_id(entity_type, bitrix_id)
+
+
+def get_id_mapping(entity_type, qb_list_id):
+    """Get the Bitrix24 ID and last pushed payload hash for a QuickBooks entity"""
+    mapping = get_storage().get_id_mapping(entity_type, qb_list_id)
+    buffered = _buffered_mapping(entity_type, qb_list_id)
+    if buffered is None:
+        return mapping
+    return {
+        'bitrix_id': buffered['bitrix_id'],
+        'content_hash': buffered['content_hash'] or (mapping or {}).get('content_hash'),
+    }
 
-    cursor.execute('''
-        SELECT qb_list_id FROM id_mappings
-        WHERE entity_type = ? AND bitrix_id = ?
-    ''', (entity_type, bitrix_id))
-    row = cursor.fetchone()
-    conn.close()
 
-    return row[0] if row else None
+def save_id_mapping(entity_type, qb_list_id, bitrix_id, content_hash=None, created=False):
+    """
+    Save a mapping between QB and Bitrix24 IDs.
 
+    If content_hash is given it replaces the stored payload hash, otherwise
+    the existing hash is kept. created=True means the Bitrix24 entity was just
+    created: the mapping is committed now (with any writes buffered before
+    it) rather than with the rest of the chunk, so a crash can't leave the
+    entity unmapped to be created again by the next sync.
+    """
+    _write('save_id_mapping', entity_type, qb_list_id, bitrix_id, content_hash)
+    uow = getattr(_uow_local, 'uow', None)
+    if created and uow is not None:
+        uow.flush()
 
-def save_id_mapping(entity_type, qb_list_id, bitrix_id):
-    """Save a mapping between QB and Bitrix24 IDs"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
 
-    cursor.execute('''
-        INSERT INTO id_mappings (entity_type, qb_list_id, bitrix_id, updated_at)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(entity_type, qb_list_id) DO UPDATE SET
-            bitrix_id = ?, updated_at = ?
-    ''', (entity_type, qb_list_id, bitrix_id, datetime.now().isoformat(),
-          bitrix_id, datetime.now().isoformat()))
+def iter_id_mappings(entity_type=None, batch_size=10000):
+    """Stream (entity_type, qb_list_id, bitrix_id, content_hash) rows in a stable order"""
+    return get_storage().iter_id_mappings(entity_type, batch_size)
 
-    conn.commit()
-    conn.close()
+
+def bulk_save_id_mappings(rows, on_conflict='skip'):
+    """
+    Write a batch of mapping rows in one transaction (see mapping_tools.py).
+
+    on_conflict is 'skip', 'overwrite' or 'fail'. Returns the rows written.
+    """
+    return get_storage().bulk_save_id_mappings(rows, on_conflict)
 
 
 def add_to_qb_queue(entity_type, bitrix_id, action, data):
-    """Add an item to the queue for syncing to QuickBooks"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    """
+    Add an item to the queue for syncing to QuickBooks.
 
-    cursor.execute('''
-        INSERT INTO bitrix_to_qb_queue (entity_type, bitrix_id, action, data)
-        VALUES (?, ?, ?, ?)
-    ''', (entity_type, bitrix_id, action, data))
+    Pending items are coalesced per (entity_type, bitrix_id) so a QB session
+    only carries the net change:
+    - the latest payload always wins
+    - add followed by update stays an add (with the new payload)
+    - add followed by delete cancels out (the pending row is removed)
 
-    conn.commit()
-    conn.close()
+    Returns the queue row id, or None if the change cancelled a pending add.
+    """
+    return get_storage().add_to_qb_queue(entity_type, bitrix_id, action, data)
 
 
 def get_pending_qb_queue():
-    """Get all pending items to sync to QuickBooks"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    """Get all pending items to sync to QuickBooks whose retry time has arrived"""
+    return get_storage().get_pending_qb_queue()
+
 
-    cursor.execute('''
-        SELECT id, entity_type, bitrix_id, action, data
-        FROM bitrix_to_qb_queue
-        WHERE status = 'pending'
-        ORDER BY created_at
-    ''')
-    rows = cursor.fetchall()
-    conn.close()
+def claim_pending_qb_queue(claimed_by=None, limit=None):
+    """
+    Atomically claim pending queue items for this connector process.
 
-    return [{'id': r[0], 'entity_type': r[1], 'bitrix_id': r[2],
-             'action': r[3], 'data': r[4]} for r in rows]
+    Claimed items move to 'processing' so other connector nodes skip them.
+    Claims older than QUEUE_CLAIM_TIMEOUT_SECONDS (e.g. from a session that
+    died) are picked up again.
+    """
+    return get_storage().claim_pending_qb_queue(claimed_by or worker_id(), limit)
 
 
 def mark_queue_item_processed(item_id, status='completed', error_message=None):
-    """Mark a queue item as processed"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    """
+    Mark a queue item as processed.
 
-    cursor.execute('''
-        UPDATE bitrix_to_qb_queue
-        SET status = ?, processed_at = ?, error_message = ?
-        WHERE id = ?
-    ''', (status, datetime.now().isoformat(), error_message, item_id))
+    status='failed' is not final: the item goes back to pending with its
+    next attempt delayed by exponential backoff, and becomes 'dead' after
+    QUEUE_MAX_ATTEMPTS failures. Pass status='dead' to dead-letter it at once.
+    """
+    _write('mark_queue_item_processed', item_id, status, error_message)
 
-    conn.commit()
-    conn.close()
+
+def get_dead_qb_queue():
+    """Get dead-lettered queue items (with attempts and last error) for inspection"""
+    return get_storage().get_dead_qb_queue()
+
+
+def requeue_dead_queue_item(item_id):
+    """Put a dead-lettered item back in the queue with a fresh attempt count"""
+    return get_storage().requeue_dead_queue_item(item_id)
+
+
+def archive_queue(older_than_days=ARCHIVE_QUEUE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE,
+                  max_batches=None):
+    """
+    Move finished queue rows older than older_than_days into the archive table.
+
+    Keeps bitrix_to_qb_queue down to live rows so the pending scan stays cheap.
+    Returns the number of rows moved.
+    """
+    older_than = datetime.now() - timedelta(days=older_than_days)
+    return get_storage().archive_queue(older_than, batch_size, max_batches)
+
+
+def query_queue_archive(entity_type=None, bitrix_id=None, status=None, since=None, limit=100):
+    """Search archived queue rows (newest first), e.g. for audits"""
+    return get_storage().query_queue_archive(entity_type, bitrix_id, status, since, limit)
 
 
 def log_sync(direction, entity_type, qb_id, bitrix_id, action, status, message=None):
     """Log a sync operation"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    _write('log_sync', direction, entity_type, qb_id, bitrix_id, action, status, message)
+
+
+def get_status_counts(exact=False):
+    """
+    Get the mapping, recent sync and pending queue counts shown on /status.
 
-    cursor.execute('''
-        INSERT INTO sync_log (direction, entity_type, qb_id, bitrix_id, action, status, message)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (direction, entity_type, qb_id, bitrix_id, action, status, message))
+    Served from in-memory counters refreshed every STATUS_RECOUNT_SECONDS;
+    pass exact=True to force a recount.
+    """
+    return get_storage().get_status_counts(exact)
 
-    conn.commit()
-    conn.close()
+
+def run_maintenance(budget_seconds=MAINTENANCE_BUDGET_SECONDS):
+    """
+    Incremental vacuum, statistics refresh and WAL checkpoint within a time budget.
+
+    Returns {'reclaimed_bytes', 'seconds', 'steps'}.
+    """
+    return get_storage().run_maintenance(budget_seconds)
 
 
 if __name__ == "__main__":
-    init_db()
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'archive':
+        init_db()
+        print(f"Archived {archive_queue()} queue rows")
+    elif len(sys.argv) > 1 and sys.argv[1] == 'maintenance':
+        init_db()
+        report = run_maintenance()
+        print(f"Reclaimed {report['reclaimed_bytes']} bytes in {report['seconds']}s: "
+              f"{', '.join(report['steps'])}")
+    elif len(sys.argv) > 1 and sys.argv[1] == 'vacuum':
+        init_db()
+        get_storage().vacuum()
+        print("Vacuumed")
+    elif len(sys.argv) > 1 and sys.argv[1] == 'dead':
+        init_db()
+        for item in get_dead_qb_queue():
+            print(f"{item['id']}: {item['entity_type']}/{item['bitrix_id']} {item['action']} "
+                  f"after {item['attempts']} attempts: {item['error_message']}")
+    elif len(sys.argv) > 2 and sys.argv[1] == 'requeue':
+        init_db()
+        for item_id in sys.argv[2:]:
+            print(f"{item_id}: {'requeued' if requeue_dead_queue_item(int(item_id)) else 'not dead'}")
+    else:
+        init_db()
@@ -0,0 +1,137 @@
+"""
+Single-writer thread for the SQLite backend
+
+Flask runs threaded, so webhook posts (add_to_qb_queue) and SOAP response
+processing (save_id_mapping, log_sync, ...) would otherwise race for SQLite's
+one write lock and fail with "database is locked" under bursts. Instead, every
+write is handed to one writer thread through a bounded queue:
+
+- callers get a Future back (SingleWriterStorage.submit); the storage methods
+  themselves wait on it, so the module-level API in database.py is unchanged
+- the writer drains whatever is queued and commits it as one transaction
+  (group commit), with a savepoint per call so one failing write doesn't
+  take the others down
+- reads don't go through the writer; WAL mode keeps them concurrent
+
+Enabled by SQLITE_SINGLE_WRITER in config.py.
+"""
+
+import atexit
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+from database import SQLStorage
+
+logger = logging.getLogger(__name__)
+
+# SQLStorage methods that write; everything else is delegated directly
+WRITE_METHODS = frozenset({
+    'update_last_sync_time', 'save_id_mapping', 'bulk_save_id_mappings',
+    'add_to_qb_queue', 'claim_pending_qb_queue', 'mark_queue_item_processed',
+    'requeue_dead_queue_item', 'copy_queue_to_archive', 'delete_archived_queue_rows',
+    'log_sync', 'apply_writes',
+})
+
+_STOP = object()
+
+
+class SingleWriterStorage:
+    """
+    Storage wrapper that funnels write methods through one writer thread.
+
+    Reads, init_schema() and attributes (counters, mapping_index, ...) go
+    straight to the wrapped storage.
+    """
+
+    def __init__(self, storage, queue_size=1000, group_max=200):
+        self.storage = storage
+        self.group_max = group_max
+        self._requests = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, method, *args):
+        """
+        Queue a write and return a Future for its result.
+
+        Blocks while the queue is full, which pushes back on callers instead
+        of letting a burst grow memory without bound.
+        """
+        future = Future()
+        if threading.current_thread() is self._thread:
+            # A write issued from inside a write (e.g. apply_writes) joins its transaction
+            future.set_result(getattr(self.storage, method)(*args))
+            return future
+        if not self._thread.is_alive():
+            raise RuntimeError("Database writer thread is not running")
+        self._requests.put((future, method, args))
+        return future
+
+    def archive_queue(self, older_than, batch_size=500, max_batches=None):
+        """Archive finished queue rows, submitting each step of each batch as its own write"""
+        # Runs the batch loop here so the copy and the delete of every batch go
+        # through the writer and commit on their own, rather than one long transaction
+        return SQLStorage.archive_queue(self, older_than, batch_size, max_batches)
+
+    def __getattr__(self, name):
+        if name in WRITE_METHODS:
+            def write(*args):
+                return self.submit(name, *args).result()
+            write.__name__ = name
+            return write
+        return getattr(self.storage, name)
+
+    def _run(self):
+        while True:
+            request = self._requests.get()
+            if request is _STOP:
+                return
+
+            batch = [request]
+            stopping = False
+            while len(batch) < self.group_max:
+                try:
+                    request = self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is _STOP:
+                    stopping = True
+                    break
+                batch.append(request)
+
+            self._commit(batch)
+            if stopping:
+                return
+
+    def _commit(self, batch):
+        batch = [(future, method, args) for future, method, args in batch
+                 if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        try:
+            outcomes = self.storage.run_write_batch([(method, args) for _, method, args in batch])
+        except Exception as e:
+            # The commit itself failed: none of the batch was written
+            logger.error(f"Group commit of {len(batch)} writes failed: {e}")
+            for future, _, _ in batch:
+                future.set_exception(e)
+            return
+
+        for (future, _, _), (ok, value) in zip(batch, outcomes):
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def close(self, timeout=10):
+        """Finish queued writes and stop the writer thread"""
+        if self._thread.is_alive():
+            self._requests.put(_STOP)
+            self._thread.join(timeout)
+
+    def __repr__(self):
+        return f"SingleWriterStorage({self.storage!r})"
@@ -20,14 +20,14 @@ import os
 # Add the current directory to Python path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from flask import Flask, render_template_string
+from flask import Flask, render_template_string, request
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 from spyne import Application
 from spyne.protocol.soap import Soap11
 from spyne.server.wsgi import WsgiApplication
 
 from config import SOAP_HOST, SOAP_PORT, LOG_FILE, LOG_LEVEL, BITRIX24_WEBHOOK
-from database import init_db
+from database import init_db, get_status_counts
 from webconnector_service import QuickBooksWebConnectorService
 from bitrix24_webhook_handler import bitrix_webhook_bp
 
@@ -175,37 +175,35 @@ def create_app():
 
     @flask_app.route('/status')
     def status():
-        """Status API endpoint"""
-        import sqlite3
-        from config import DATABASE_PATH
+        """
+        Status API endpoint
+
+        Counts come from in-memory counters (at most STATUS_RECOUNT_SECONDS
+        stale); /status?exact=1 forces a recount.
+        """
+        exact = request.args.get('exact', '').lower() in ('1', 'true', 'yes')
 
         # Get some stats from database
         try:
-            conn = sqlite3.connect(DATABASE_PATH)
-            cursor = conn.cursor()
-
-            cursor.execute('SELECT COUNT(*) FROM id_mappings')
-            mappings_count = cursor.fetchone()[0]
-
-            cursor.execute('SELECT COUNT(*) FROM sync_log WHERE created_at > datetime("now", "-24 hours")')
-            recent_syncs = cursor.fetchone()[0]
-
-            cursor.execute('SELECT COUNT(*) FROM bitrix_to_qb_queue WHERE status = "pending"')
-            pending_queue = cursor.fetchone()[0]
+            counts = get_status_counts(exact=exact)
+        except Exception as e:
+            logger.warning(f"Could not read status counts: {e}")
+            counts = {'id_mappings': 0, 'syncs_last_24h': 0, 'pending_queue': 0, 'dead_queue': 0}
 
-            conn.close()
-        except:
-            mappings_count = 0
-            recent_syncs = 0
-            pending_queue = 0
+        sync_mgr = QuickBooksWebConnectorService.sync_manager
+        skipped_unchanged = dict(sync_mgr.skipped_unchanged) if sync_mgr else {}
+        skipped_responses = dict(sync_mgr.skipped_responses) if sync_mgr else {}
 
         return {
             'status': 'running',
             'version': '1.0.0',
             'active_sessions': len(QuickBooksWebConnectorService.sessions),
-            'id_mappings': mappings_count,
-            'syncs_last_24h': recent_syncs,
-            'pending_queue': pending_queue,
+            'id_mappings': counts['id_mappings'],
+            'syncs_last_24h': counts['syncs_last_24h'],
+            'pending_queue': counts['pending_queue'],
+            'dead_queue': counts['dead_queue'],
+            'skipped_unchanged': skipped_unchanged,
+            'skipped_responses': skipped_responses,
             'bitrix24_configured': bool(BITRIX24_WEBHOOK)
         }
 
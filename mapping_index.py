@@ -0,0 +1,291 @@
+"""
+Compact in-memory index of id_mappings
+
+A warmed cache of millions of QB ListID -> Bitrix24 ID mappings held as
+Python dicts of strings costs several hundred bytes per row, which does not
+fit in a 32-bit process. This index keeps each entity type's mappings packed:
+
+- ListIDs concatenated into one sorted bytes blob with an offsets array,
+  looked up by binary search
+- Bitrix24 IDs as 64-bit integers
+- payload hashes (sha256 hex) as 32 raw bytes each
+
+Values that don't fit the packed form (non-numeric Bitrix IDs, non-sha256
+hashes) go to a small side dict. Recent writes land in a delta dict that is
+merged into the packed arrays once it grows past a fraction of the table.
+
+A Bloom filter in front answers "definitely unmapped" (the common case for
+new QB records) without a binary search.
+
+The index is only correct while this process sees every write, so it is
+meant for the single-node SQLite backend (MAPPING_INDEX_ENABLED in config.py).
+"""
+
+import hashlib
+import math
+import threading
+from array import array
+
+# Sentinel in the packed Bitrix ID array: value lives in the side dict
+_UNPACKED = -1
+
+# 32 zero bytes: no payload hash stored
+_NO_HASH = bytes(32)
+
+# Delta dict is merged into the packed table past max(MERGE_MIN, size / MERGE_FRACTION)
+MERGE_MIN = 4096
+MERGE_FRACTION = 16
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over bytes keys (double hashing on blake2b)"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+
+def _pack_hash(content_hash):
+    """sha256 hex digest -> 32 bytes, or None if it isn't one"""
+    if content_hash is None:
+        return _NO_HASH
+    if len(content_hash) != 64:
+        return None
+    try:
+        return bytes.fromhex(content_hash)
+    except ValueError:
+        return None
+
+
+def _pack_bitrix_id(bitrix_id):
+    """Decimal Bitrix24 ID -> int, or None if it isn't one"""
+    if bitrix_id is None or not bitrix_id.isdigit() or bitrix_id != str(int(bitrix_id)):
+        return None
+    value = int(bitrix_id)
+    return value if value < 2 ** 63 else None
+
+
+class CompactMappingTable:
+    """Packed mappings for one entity type; see the module docstring"""
+
+    def __init__(self, rows=()):
+        """
+        rows: iterable of (qb_list_id, bitrix_id, content_hash), ideally sorted
+        by ListID. Rows without a qb_list_id can never be looked up and are dropped.
+        """
+        self._build(((key.encode('utf-8'), bitrix_id, content_hash)
+                     for key, bitrix_id, content_hash in rows if key is not None))
+
+    def _build(self, rows):
+        self.keys = bytearray()
+        self.offsets = array('I', [0])
+        self.bitrix_ids = array('q')
+        self.hashes = bytearray()
+        self.unpacked = {}
+        self.delta = {}
+
+        in_order = True
+        previous = None
+        for key, bitrix_id, content_hash in rows:
+            if previous is not None and key <= previous:
+                in_order = False
+            previous = key
+            self._append(key, bitrix_id, content_hash)
+
+        if not in_order:
+            self._sort()
+
+        self.keys = bytes(self.keys)
+        self.bloom = BloomFilter(max(2 * len(self), MERGE_MIN))
+        for i in range(len(self)):
+            self.bloom.add(self._key_at(i))
+
+    def _append(self, key, bitrix_id, content_hash):
+        index = len(self.bitrix_ids)
+        packed_id = _pack_bitrix_id(bitrix_id)
+        packed_hash = _pack_hash(content_hash)
+
+        self.keys += key
+        self.offsets.append(len(self.keys))
+        if packed_id is None or packed_hash is None:
+            self.bitrix_ids.append(_UNPACKED)
+            self.hashes += _NO_HASH
+            self.unpacked[index] = (bitrix_id, content_hash)
+        else:
+            self.bitrix_ids.append(packed_id)
+            self.hashes += packed_hash
+
+    def _sort(self):
+        """Re-sort rows that arrived out of ListID order, keeping the last of duplicates"""
+        latest = {}
+        for i in range(len(self.bitrix_ids)):
+            latest[self._key_at(i)] = i
+        order = sorted(latest)
+        old = (self.keys, self.offsets, self.bitrix_ids, self.hashes, self.unpacked)
+        rows = [(key, self._value_at(latest[key], old)) for key in order]
+
+        self.keys = bytearray()
+        self.offsets = array('I', [0])
+        self.bitrix_ids = array('q')
+        self.hashes = bytearray()
+        self.unpacked = {}
+        for key, (bitrix_id, content_hash) in rows:
+            self._append(key, bitrix_id, content_hash)
+
+    def __len__(self):
+        return len(self.bitrix_ids)
+
+    def _key_at(self, index):
+        return bytes(self.keys[self.offsets[index]:self.offsets[index + 1]])
+
+    def _value_at(self, index, arrays=None):
+        keys, offsets, bitrix_ids, hashes, unpacked = arrays or (
+            self.keys, self.offsets, self.bitrix_ids, self.hashes, self.unpacked)
+        packed_id = bitrix_ids[index]
+        if packed_id == _UNPACKED:
+            return unpacked[index]
+        packed_hash = bytes(hashes[index * 32:(index + 1) * 32])
+        return str(packed_id), (None if packed_hash == _NO_HASH else packed_hash.hex())
+
+    def _find(self, key):
+        """Binary search the packed keys; index or None"""
+        keys, offsets = self.keys, self.offsets
+        lo, hi = 0, len(self.bitrix_ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            probe = keys[offsets[mid]:offsets[mid + 1]]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def get(self, qb_list_id):
+        """(bitrix_id, content_hash) or None (always None for a None qb_list_id, as in SQL)"""
+        if qb_list_id is None:
+            return None
+        key = qb_list_id.encode('utf-8')
+        if key not in self.bloom:
+            return None
+        if key in self.delta:
+            return self.delta[key]
+        index = self._find(key)
+        return None if index is None else self._value_at(index)
+
+    def put(self, qb_list_id, bitrix_id, content_hash=None):
+        """Record a saved mapping; a None content_hash keeps the stored one, a None qb_list_id is ignored"""
+        if qb_list_id is None:
+            return
+        key = qb_list_id.encode('utf-8')
+        if content_hash is None:
+            current = self.get(qb_list_id)
+            content_hash = current[1] if current else None
+        self.delta[key] = (bitrix_id, content_hash)
+        self.bloom.add(key)
+
+        if len(self.delta) > max(MERGE_MIN, len(self) // MERGE_FRACTION):
+            self._merge()
+
+    def _merge(self):
+        """Fold the delta dict into the packed arrays"""
+        delta = self.delta
+        base = (self.keys, self.offsets, self.bitrix_ids, self.hashes, self.unpacked)
+        count = len(self)
+
+        def merged():
+            pending = sorted(delta)
+            j = 0
+            for i in range(count):
+                key = bytes(base[0][base[1][i]:base[1][i + 1]])
+                while j < len(pending) and pending[j] < key:
+                    yield (pending[j],) + delta[pending[j]]
+                    j += 1
+                if j < len(pending) and pending[j] == key:
+                    yield (key,) + delta[key]
+                    j += 1
+                else:
+                    yield (key,) + self._value_at(i, base)
+            for key in pending[j:]:
+                yield (key,) + delta[key]
+
+        self._build(merged())
+
+    def items(self):
+        """Yield (qb_list_id, bitrix_id, content_hash) in ListID order, delta included"""
+        if self.delta:
+            self._merge()
+        for i in range(len(self)):
+            yield (self._key_at(i).decode('utf-8'),) + self._value_at(i)
+
+    @property
+    def nbytes(self):
+        """Approximate memory held by the packed arrays and filter"""
+        return (len(self.keys) + self.offsets.itemsize * len(self.offsets)
+                + self.bitrix_ids.itemsize * len(self.bitrix_ids) + len(self.hashes)
+                + self.bloom.nbytes)
+
+
+class MappingIndex:
+    """
+    Per-entity-type CompactMappingTables, loaded on first lookup.
+
+    loader(entity_type) must yield (qb_list_id, bitrix_id, content_hash)
+    rows, preferably in ListID order.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def _table(self, entity_type):
+        table = self._tables.get(entity_type)
+        if table is None:
+            table = CompactMappingTable(self._loader(entity_type))
+            self._tables[entity_type] = table
+        return table
+
+    def get(self, entity_type, qb_list_id):
+        """{'bitrix_id', 'content_hash'} or None"""
+        if qb_list_id is None:
+            return None
+        with self._lock:
+            value = self._table(entity_type).get(qb_list_id)
+        return {'bitrix_id': value[0], 'content_hash': value[1]} if value else None
+
+    def put(self, entity_type, qb_list_id, bitrix_id, content_hash=None):
+        """Apply a committed mapping write (ignored until the entity type is loaded, or with no qb_list_id)"""
+        if qb_list_id is None:
+            return
+        with self._lock:
+            table = self._tables.get(entity_type)
+            if table is not None:
+                # Stored as TEXT, so reads from storage return strings too
+                bitrix_id = None if bitrix_id is None else str(bitrix_id)
+                table.put(qb_list_id, bitrix_id, content_hash)
+
+    def clear(self):
+        """Drop all loaded tables; they reload from storage on next use"""
+        with self._lock:
+            self._tables.clear()
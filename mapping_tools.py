@@ -0,0 +1,251 @@
+"""
+Bulk export and import of id_mappings
+
+Moves the QB <-> Bitrix24 ID mappings between connector installs (or
+backends) without replaying a full sync. Files are streamed in both
+directions, so memory stays flat however many mappings there are.
+
+If sync_state.db is lost, rebuild-from-bitrix recovers the mappings from the
+QB IDs the connector writes into every Bitrix24 record it creates, so the
+next sync updates those records instead of duplicating them.
+
+Usage:
+    python mapping_tools.py export mappings.csv [--entity-type customer]
+    python mapping_tools.py import mappings.jsonl [--on-conflict skip|overwrite|fail]
+    python mapping_tools.py rebuild-from-bitrix [--on-conflict skip|overwrite|fail]
+
+The format comes from the file extension (.csv, .jsonl/.ndjson) or --format.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import re
+import sys
+import time
+
+from database import (
+    get_storage, iter_id_mappings, bulk_save_id_mappings,
+    MAPPING_CONFLICT_POLICIES, MappingConflictError
+)
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('entity_type', 'qb_list_id', 'bitrix_id', 'content_hash')
+
+# Rows written per import transaction
+IMPORT_BATCH_SIZE = 50000
+
+FORMATS = ('csv', 'jsonl')
+
+# Where the connector records the QB ID on each Bitrix24 entity it creates
+# (see the mapping functions in bitrix24_client.py):
+# (list method, id_mappings entity_type, field, pattern capturing the QB ID)
+ORIGIN_MARKERS = (
+    ('crm.contact.list', 'customers', 'SOURCE_DESCRIPTION', re.compile(r'QB ListID:\s*([\w-]+)')),
+    ('crm.company.list', 'customers', 'COMMENTS', re.compile(r'QB ListID:\s*([\w-]+)')),
+    ('crm.deal.list', 'invoices', 'COMMENTS', re.compile(r'QB TxnID:\s*([\w-]+)')),
+    ('crm.product.list', 'items', 'XML_ID', re.compile(r'^QB_([\w-]+)$')),
+)
+
+
+def detect_format(path):
+    """Pick csv or jsonl from a file name"""
+    lower = path.lower()
+    if lower.endswith('.csv'):
+        return 'csv'
+    if lower.endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    raise ValueError(f"Can't tell the format of {path}; pass --format csv or --format jsonl")
+
+
+def _write_csv(rows, stream):
+    writer = csv.writer(stream)
+    writer.writerow(FIELDS)
+    count = 0
+    for row in rows:
+        writer.writerow(['' if value is None else value for value in row])
+        count += 1
+    return count
+
+
+def _write_jsonl(rows, stream):
+    count = 0
+    for row in rows:
+        stream.write(json.dumps(dict(zip(FIELDS, row))))
+        stream.write('\n')
+        count += 1
+    return count
+
+
+def _read_csv(stream):
+    for line, record in enumerate(csv.DictReader(stream), 2):
+        yield _to_row(record, line)
+
+
+def _read_jsonl(stream):
+    for line, text in enumerate(stream, 1):
+        if text.strip():
+            yield _to_row(json.loads(text), line)
+
+
+def _to_row(record, line):
+    """Validate one input record; empty optional values become None"""
+    entity_type = record.get('entity_type')
+    qb_list_id = record.get('qb_list_id')
+    if not entity_type or not qb_list_id:
+        raise ValueError(f"Line {line}: entity_type and qb_list_id are required")
+    bitrix_id = record.get('bitrix_id')
+    return (entity_type, qb_list_id,
+            None if bitrix_id in (None, '') else str(bitrix_id),
+            record.get('content_hash') or None)
+
+
+def export_mappings(stream, fmt='csv', entity_type=None):
+    """Write id_mappings (optionally one entity type) to a text stream; returns the row count"""
+    writer = _write_csv if fmt == 'csv' else _write_jsonl
+    return writer(iter_id_mappings(entity_type), stream)
+
+
+def import_mappings(stream, fmt='csv', on_conflict='skip', batch_size=IMPORT_BATCH_SIZE):
+    """
+    Load mappings from a text stream in batched transactions.
+
+    Returns (rows read, rows written). With on_conflict='fail' the first
+    conflicting batch is rolled back and MappingConflictError propagates;
+    earlier batches stay committed.
+    """
+    if on_conflict not in MAPPING_CONFLICT_POLICIES:
+        raise ValueError(f"on_conflict must be one of {MAPPING_CONFLICT_POLICIES}")
+
+    reader = _read_csv if fmt == 'csv' else _read_jsonl
+    return _bulk_load(reader(stream), on_conflict, batch_size)
+
+
+def _bulk_load(rows, on_conflict, batch_size):
+    """Write rows through bulk_save_id_mappings() in batches; returns (read, written)"""
+    read = written = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            written += bulk_save_id_mappings(batch, on_conflict)
+            read += len(batch)
+            batch = []
+    if batch:
+        written += bulk_save_id_mappings(batch, on_conflict)
+        read += len(batch)
+    return read, written
+
+
+def iter_origin_mappings(client, counts=None):
+    """
+    Yield (entity_type, qb_list_id, bitrix_id, None) for every Bitrix24
+    record carrying a QB origin marker.
+
+    counts, if given, is filled with {list method: (records scanned, markers found)}.
+    """
+    for method, entity_type, field, pattern in ORIGIN_MARKERS:
+        scanned = found = 0
+        for record in client.iter_list(method, select=['ID', field]):
+            scanned += 1
+            match = pattern.search(record.get(field) or '')
+            if match:
+                found += 1
+                # The payload hash is unknown, so the next sync pushes each record once
+                yield (entity_type, match.group(1), str(record['ID']), None)
+        logger.info(f"{method}: {found} QB markers in {scanned} records")
+        if counts is not None:
+            counts[method] = (scanned, found)
+
+
+def rebuild_from_bitrix(client, on_conflict='skip', batch_size=IMPORT_BATCH_SIZE, counts=None):
+    """
+    Recreate id_mappings from the QB origin markers on Bitrix24 records.
+
+    Returns (markers found, mappings written). With the default 'skip',
+    existing mappings win, and if one QB ID is marked on several Bitrix24
+    records the first one scanned (contacts before companies, then by ID) is kept.
+    """
+    return _bulk_load(iter_origin_mappings(client, counts), on_conflict, batch_size)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export or import QB <-> Bitrix24 ID mappings")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_cmd = commands.add_parser('export', help="write id_mappings to a file ('-' for stdout)")
+    export_cmd.add_argument('path')
+    export_cmd.add_argument('--format', choices=FORMATS)
+    export_cmd.add_argument('--entity-type')
+
+    import_cmd = commands.add_parser('import', help="load id_mappings from a file ('-' for stdin)")
+    import_cmd.add_argument('path')
+    import_cmd.add_argument('--format', choices=FORMATS)
+    import_cmd.add_argument('--on-conflict', choices=MAPPING_CONFLICT_POLICIES, default='skip')
+    import_cmd.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+
+    rebuild_cmd = commands.add_parser('rebuild-from-bitrix',
+                                      help="recover id_mappings from QB IDs stored in Bitrix24 records")
+    rebuild_cmd.add_argument('--on-conflict', choices=MAPPING_CONFLICT_POLICIES, default='skip')
+
+    args = parser.parse_args(argv)
+    if args.command == 'rebuild-from-bitrix':
+        return _rebuild_command(args)
+
+    try:
+        fmt = args.format or ('csv' if args.path == '-' else detect_format(args.path))
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Not init_db(): it prints to stdout, which may be the export target
+    get_storage().init_schema()
+    start = time.perf_counter()
+
+    if args.command == 'export':
+        if args.path == '-':
+            count = export_mappings(sys.stdout, fmt, args.entity_type)
+        else:
+            with open(args.path, 'w', encoding='utf-8', newline='') as f:
+                count = export_mappings(f, fmt, args.entity_type)
+        print(f"Exported {count} mappings in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+        return 0
+
+    try:
+        if args.path == '-':
+            read, written = import_mappings(sys.stdin, fmt, args.on_conflict, args.batch_size)
+        else:
+            with open(args.path, encoding='utf-8', newline='') as f:
+                read, written = import_mappings(f, fmt, args.on_conflict, args.batch_size)
+    except MappingConflictError as e:
+        print(f"Import stopped: {e}", file=sys.stderr)
+        return 1
+
+    print(f"Imported {written} of {read} mappings ({read - written} skipped) "
+          f"in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    return 0
+
+
+def _rebuild_command(args):
+    from bitrix24_client import Bitrix24Client
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    get_storage().init_schema()
+    start = time.perf_counter()
+    counts = {}
+    try:
+        found, written = rebuild_from_bitrix(Bitrix24Client(), args.on_conflict, counts=counts)
+    except (MappingConflictError, RuntimeError) as e:
+        print(f"Rebuild stopped: {e}", file=sys.stderr)
+        return 1
+
+    for method, (scanned, markers) in counts.items():
+        print(f"  {method:18} {scanned:>8} records, {markers:>8} with QB IDs", file=sys.stderr)
+    print(f"Rebuilt {written} of {found} mappings ({found - written} already mapped) "
+          f"in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+Compression codec for large text columns
+
+Queue payloads (bitrix_to_qb_queue.data) are small JSON documents that repeat
+the same keys, and sync_log messages repeat the same tracebacks and HTTP error
+bodies. Both compress well with zlib primed with a preset dictionary of those
+recurring strings.
+
+Encoded values are BLOBs starting with a short header; anything else (legacy
+TEXT rows, short values stored uncompressed) is passed through on decode, so
+compressed and uncompressed rows can live in the same column.
+"""
+
+import zlib
+
+# Values shorter than this are stored as plain text: the header and deflate
+# framing would outweigh the savings
+MIN_COMPRESS_BYTES = 96
+
+# Header: magic + dictionary version. Bump the version (and keep the old
+# dictionary in _DICTIONARIES) if PRESET_DICTIONARY ever changes.
+_MAGIC = b'\xffQZ'
+_DICTIONARY_VERSION = 1
+
+# Strings that recur in queue payloads and sync_log messages. zlib looks back
+# into the dictionary, so later entries (the most common ones) get the
+# shortest distances.
+PRESET_DICTIONARY = (
+    'Traceback (most recent call last):\n  File "'
+    '", line '
+    ', in '
+    'requests.exceptions.HTTPError: '
+    'requests.exceptions.ConnectionError: '
+    'requests.exceptions.ReadTimeout: '
+    'Read timed out. (read timeout=30)'
+    'Max retries exceeded with url: '
+    'Client Error: Bad Request for url: '
+    'Server Error: Internal Server Error for url: '
+    '{"error": "'
+    '", "error_description": "'
+    'QUERY_LIMIT_EXCEEDED'
+    'No data returned'
+    'The name "'
+    '" of the list element is already in use.'
+    'There is an invalid reference to QuickBooks '
+    'statusCode="'
+    '" statusSeverity="Error" statusMessage="'
+    '"address": {"addr1": "'
+    '", "addr2": "'
+    '", "city": "'
+    '", "state": "'
+    '", "postal_code": "'
+    '", "country": "'
+    '"phone": "'
+    '", "email": "'
+    '", "company_name": "'
+    '", "last_name": "'
+    '", "first_name": "'
+    '{"name": "'
+).encode('utf-8')
+
+_DICTIONARIES = {
+    _DICTIONARY_VERSION: PRESET_DICTIONARY,
+}
+
+
+def encode_text(value):
+    """
+    Compress a text value for storage.
+
+    Returns None, the original string (if short or incompressible), or bytes.
+    """
+    if value is None:
+        return None
+
+    raw = value.encode('utf-8')
+    if len(raw) < MIN_COMPRESS_BYTES:
+        return value
+
+    compressor = zlib.compressobj(level=6, wbits=-15, zdict=PRESET_DICTIONARY)
+    packed = compressor.compress(raw) + compressor.flush()
+    encoded = _MAGIC + bytes([_DICTIONARY_VERSION]) + packed
+
+    if len(encoded) >= len(raw):
+        return value
+    return encoded
+
+
+def decode_text(value):
+    """Reverse encode_text; plain text values are returned unchanged"""
+    if value is None or isinstance(value, str):
+        return value
+
+    value = bytes(value)
+    if not value.startswith(_MAGIC):
+        return value.decode('utf-8')
+
+    version = value[len(_MAGIC)]
+    decompressor = zlib.decompressobj(wbits=-15, zdict=_DICTIONARIES[version])
+    raw = decompressor.decompress(value[len(_MAGIC) + 1:]) + decompressor.flush()
+    return raw.decode('utf-8')
+
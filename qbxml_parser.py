@@ -4,13 +4,87 @@ qbXML Response Parser for QuickBooks Desktop
 This module parses qbXML responses from QuickBooks into Python dictionaries.
 """
 
+import hashlib
+import itertools
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
 from lxml import etree
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Union
+
+from config import PARALLEL_PARSE_MIN_BYTES, PARALLEL_PARSE_WORKERS
+from qb_schema_extractor import QB_SCHEMA
+
+logger = logging.getLogger(__name__)
+
+# A response as received: text, or raw bytes parsed in place
+XMLInput = Union[str, bytes, bytearray, memoryview]
+
+# Options for every parser here: large responses allowed, ignorable
+# whitespace, comments and processing instructions dropped at parse time,
+# and no network access or external entity expansion
+PARSER_OPTIONS = {
+    'huge_tree': True,
+    'remove_blank_text': True,
+    'remove_comments': True,
+    'remove_pis': True,
+    'no_network': True,
+    'resolve_entities': False,
+}
+
+# lxml parsers must not be shared between threads; keep one per thread
+_parsers = threading.local()
+
+
+def xml_parser() -> etree.XMLParser:
+    """This thread's reusable parser configured with PARSER_OPTIONS"""
+    parser = getattr(_parsers, 'parser', None)
+    if parser is None:
+        parser = _parsers.parser = etree.XMLParser(**PARSER_OPTIONS)
+    return parser
+
 
+def parse_xml(data: XMLInput):
+    """
+    Parse a whole document with the shared parser and return its root.
 
-def parse_qbxml_response(xml_string: str) -> Dict[str, Any]:
+    bytes, bytearray and memoryview are parsed in place; str is parsed from
+    Python's own buffer, unless it carries an encoding declaration, which
+    lxml only accepts on bytes (that case is encoded once).
     """
-    Parse a qbXML response string into a Python dictionary.
+    try:
+        return etree.fromstring(data, xml_parser())
+    except ValueError:
+        if not isinstance(data, str):
+            raise
+        return etree.fromstring(data.encode('utf-8'), xml_parser())
+
+
+def is_blank(data: Optional[XMLInput]) -> bool:
+    """True for None or an empty/whitespace-only response, without copying it"""
+    if data is None or not len(data):
+        return True
+    if isinstance(data, (memoryview, bytearray)):
+        # Only a view that starts with whitespace needs a full check
+        return bytes(data[:1]).isspace() and bytes(data).isspace()
+    return data.isspace()
+
+
+def parse_qbxml_response(xml_string: XMLInput) -> Dict[str, Any]:
+    """
+    Parse a qbXML response (str, bytes or memoryview) into a Python dictionary.
+
+    Only the first response element is read; see parse_qbxml_responses()
+    for envelopes answering several requests. Responses of
+    PARALLEL_PARSE_MIN_BYTES or more are parsed across worker processes.
 
     Returns a dict with:
     - 'success': bool
@@ -18,340 +92,701 @@ def parse_qbxml_response(xml_string: str) -> Dict[str, Any]:
     - 'status_message': str
     - 'data': list of parsed entities
     """
-    if not xml_string or not xml_string.strip():
+    if is_blank(xml_string):
         return {'success': False, 'status_code': '', 'status_message': 'Empty response', 'data': []}
 
-    try:
-        # Parse XML
-        root = etree.fromstring(xml_string.encode('utf-8'))
+    if _use_parallel_parse(xml_string):
+        result = _parse_parallel(xml_string)
+        if result is not None:
+            return result
 
-        # Find the response element (e.g., CustomerQueryRs, InvoiceQueryRs)
-        msgs_rs = root.find('.//QBXMLMsgsRs')
+    try:
+        msgs_rs = _messages_element(xml_string)
         if msgs_rs is None:
             return {'success': False, 'status_code': '', 'status_message': 'No QBXMLMsgsRs found', 'data': []}
 
-        # Get the first response element
-        response_elem = None
-        for child in msgs_rs:
-            if child.tag.endswith('Rs'):
-                response_elem = child
-                break
-
+        # Get the first response element (e.g., CustomerQueryRs, InvoiceQueryRs)
+        response_elem = next(_response_elements(msgs_rs), None)
         if response_elem is None:
             return {'success': False, 'status_code': '', 'status_message': 'No response element found', 'data': []}
 
-        # Get status
-        status_code = response_elem.get('statusCode', '')
-        status_message = response_elem.get('statusMessage', '')
-        success = status_code == '0'
-
-        # Parse data based on response type
-        data = []
-        response_type = response_elem.tag
-
-        if 'CustomerQuery' in response_type or 'CustomerAdd' in response_type or 'CustomerMod' in response_type:
-            data = parse_customers(response_elem)
-        elif 'VendorQuery' in response_type or 'VendorAdd' in response_type:
-            data = parse_vendors(response_elem)
-        elif 'InvoiceQuery' in response_type or 'InvoiceAdd' in response_type:
-            data = parse_invoices(response_elem)
-        elif 'ItemQuery' in response_type or 'ItemInventoryQuery' in response_type:
-            data = parse_items(response_elem)
-        elif 'EstimateQuery' in response_type or 'EstimateAdd' in response_type:
-            data = parse_estimates(response_elem)
-        elif 'AccountQuery' in response_type:
-            data = parse_accounts(response_elem)
-        elif 'ClassQuery' in response_type:
-            data = parse_classes(response_elem)
-        elif 'CompanyQuery' in response_type:
-            data = parse_company(response_elem)
-        elif 'HostQuery' in response_type:
-            data = parse_host(response_elem)
-        else:
-            # Generic parsing
-            data = parse_generic(response_elem)
-
-        return {
-            'success': success,
-            'status_code': status_code,
-            'status_message': status_message,
-            'data': data
-        }
+        return parse_response_element(response_elem)
 
     except Exception as e:
         return {'success': False, 'status_code': '', 'status_message': str(e), 'data': []}
 
 
+def response_digest(xml_string: XMLInput) -> str:
+    """
+    Content hash of a response (text hashed as UTF-8), the key of ParseCache.
+
+    Text is encoded one STREAM_CHUNK_SIZE slice at a time, so hashing never
+    holds a second full-size copy of the response.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(xml_string, str):
+        for chunk in _iter_chunks(xml_string, STREAM_CHUNK_SIZE):
+            digest.update(chunk.encode('utf-8'))
+    else:
+        digest.update(xml_string)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """
+    parse_qbxml_response() results of recently seen responses, keyed by
+    response_digest(), so a byte-identical response is never parsed twice.
+
+    max_bytes bounds the total size of the responses whose results are kept
+    (least recently used dropped first); a larger response is parsed but not
+    cached. Hits share the cached records, so treat them as read-only; each
+    hit gets its own result dict and data list.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # digest -> (response size, result)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def parse(self, xml_string: XMLInput, digest: str = None) -> Dict[str, Any]:
+        """parse_qbxml_response(xml_string), from the cache if seen before (digest if already known)"""
+        if digest is None:
+            digest = response_digest(xml_string)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                self._entries.move_to_end(digest)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if entry is None:
+            result = parse_qbxml_response(xml_string)
+            self._store(digest, len(xml_string), result)
+        else:
+            result = entry[1]
+        return dict(result, data=list(result['data']))
+
+    def _store(self, digest: str, size: int, result: Dict[str, Any]):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if digest in self._entries:
+                return
+            self._entries[digest] = (size, result)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (dropped, _) = self._entries.popitem(last=False)
+                self._size -= dropped
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+def parse_qbxml_responses(xml_string: XMLInput) -> Dict[str, Dict[str, Any]]:
+    """
+    Parse every response element of a qbXML envelope, keyed by requestID.
+
+    Each value has the keys of parse_qbxml_response()'s result plus
+    'request_id' and 'response_type' (the element tag). Responses without a
+    requestID, or repeating one already seen, are keyed by position ('#2').
+    Returns {} for an empty envelope; malformed XML raises etree.XMLSyntaxError.
+    """
+    if is_blank(xml_string):
+        return {}
+    msgs_rs = _messages_element(xml_string)
+    if msgs_rs is None:
+        return {}
+
+    results = {}
+    for position, response_elem in enumerate(_response_elements(msgs_rs)):
+        request_id = response_elem.get('requestID')
+        key = request_id if request_id is not None and request_id not in results else f"#{position}"
+        try:
+            result = parse_response_element(response_elem)
+        except Exception as e:
+            # One bad response shouldn't hide the others
+            result = {'success': False, 'status_code': response_elem.get('statusCode', ''),
+                      'status_message': str(e), 'data': []}
+        result['request_id'] = request_id
+        result['response_type'] = response_elem.tag
+        results[key] = result
+    return results
+
+
+def _messages_element(xml_string: XMLInput):
+    """The QBXMLMsgsRs element of a response, or None"""
+    return parse_xml(xml_string).find('.//QBXMLMsgsRs')
+
+
+def _response_elements(msgs_rs):
+    """The *Rs children of QBXMLMsgsRs, in order"""
+    for child in msgs_rs:
+        if isinstance(child.tag, str) and child.tag.endswith('Rs'):
+            yield child
+
+
+def parse_response_element(response_elem) -> Dict[str, Any]:
+    """Status and records of one response element (see parse_qbxml_response())"""
+    status_code = response_elem.get('statusCode', '')
+    parse = RESPONSE_PARSERS.get(response_elem.tag, parse_generic)
+    return {
+        'success': status_code == '0',
+        'status_code': status_code,
+        'status_message': response_elem.get('statusMessage', ''),
+        'data': parse(response_elem)
+    }
+
+
+def _list_field_tags() -> frozenset:
+    """Tags QB_SCHEMA documents as repeatable (LIST) and never as anything else"""
+    repeatable, single = set(), set()
+
+    def walk(fields):
+        for name, spec in fields.items():
+            (repeatable if spec['type'] == 'LIST' else single).add(name)
+            if 'nested' in spec:
+                walk(spec['nested'])
+
+    for schema in QB_SCHEMA.values():
+        walk(schema['fields'])
+    return frozenset(repeatable - single)
+
+
+# Always lists in element_to_dict(), even with one occurrence
+LIST_TAGS = _list_field_tags()
+
+
 def element_to_dict(elem) -> Dict[str, Any]:
-    """Convert an XML element and its children to a dictionary"""
+    """
+    Convert an XML element and its children to a dictionary.
+
+    Leaf children become their text and children with children of their own
+    become dicts. A tag that occurs more than once, or that QB_SCHEMA
+    documents as a repeatable list (LIST_TAGS), becomes a list of those
+    values in document order, so one record's line list doesn't turn into a
+    dict when it happens to have a single line. Linear in the number of
+    children.
+    """
     result = {}
+    lists = set()
     for child in elem:
         tag = child.tag
-        if len(child) > 0:
-            # Has children, recurse
-            if tag.endswith('Ret') or tag.endswith('Ref') or tag.endswith('Line') or tag.endswith('Address'):
-                value = element_to_dict(child)
-            elif any(sibling.tag == tag for sibling in elem if sibling != child):
-                # Multiple elements with same tag, make a list
-                if tag not in result:
-                    result[tag] = []
-                result[tag].append(element_to_dict(child))
-                continue
-            else:
-                value = element_to_dict(child)
+        if not isinstance(tag, str):
+            # Comments and processing instructions
+            continue
+        value = element_to_dict(child) if len(child) else child.text
+        if tag in lists:
+            result[tag].append(value)
+        elif tag in result:
+            result[tag] = [result[tag], value]
+            lists.add(tag)
+        elif tag in LIST_TAGS:
+            result[tag] = [value]
+            lists.add(tag)
         else:
-            value = child.text
-        result[tag] = value
+            result[tag] = value
     return result
 
 
+def _decimal(text: str) -> Optional[Decimal]:
+    try:
+        value = Decimal(text)
+    except InvalidOperation:
+        return None
+    return value if value.is_finite() else None
+
+
+def _or_none(parse):
+    """Wrap parse so text it rejects decodes to None instead of raising"""
+    def decode(text: str):
+        try:
+            return parse(text)
+        except ValueError:
+            return None
+    return decode
+
+
+# qbXML scalar types decoded by Record.typed(); money and quantities become
+# Decimal so no float rounding creeps into amounts. Unlisted types stay str.
+TYPE_DECODERS = {
+    'AMTTYPE': _decimal,
+    'PRICETYPE': _decimal,
+    'QUANTYPE': _decimal,
+    'PERCENTTYPE': _decimal,
+    'FLOATTYPE': _decimal,
+    'INTTYPE': _or_none(int),
+    'DATETIMETYPE': _or_none(datetime.fromisoformat),
+    'DATETYPE': _or_none(date.fromisoformat),
+    'BOOLTYPE': {'true': True, 'false': False}.get,
+}
+
+
+class Record(Mapping):
+    """
+    Compact parsed record: a read-only, dict-compatible mapping over __slots__.
+
+    A record with 16 string fields takes a fraction of the memory of the
+    equivalent dict, which dominates on large responses. Records support
+    everything the mapping functions use on dicts ([], get, in, iteration,
+    items(), equality with dicts); to_dict() gives a plain (deep) copy.
+
+    Optional keys (nested refs and addresses) are absent until set, like a
+    missing dict key; every other key reads None when the element was missing.
+
+    Values are the qbXML strings; typed() decodes them per their QB_SCHEMA
+    type on first use (decode() does the same for any mapping).
+    """
+
+    __slots__ = ()
+    _fields = ()
+    _field_set = frozenset()
+    _optional = frozenset()
+    _types = {}
+
+    @classmethod
+    def from_dict(cls, values: Dict[str, Any]) -> 'Record':
+        record = cls.__new__(cls)
+        for key, value in values.items():
+            setattr(record, key, value)
+        return record
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self._field_set:
+            return getattr(self, key, default)
+        return default
+
+    def typed(self, key, default=None):
+        """
+        Value of key decoded per its QB_SCHEMA type (Decimal, datetime, date,
+        int or bool), cached after the first call; keys without a decodable
+        type return the string. default if the key is missing, empty or
+        doesn't decode.
+        """
+        decoded = getattr(self, '_decoded', None)
+        if decoded is None:
+            decoded = self._decoded = {}
+        elif key in decoded:
+            value = decoded[key]
+            return default if value is None else value
+
+        value = self.get(key)
+        decode = self._types.get(key)
+        if value is not None and decode is not None:
+            value = decode(value)
+        decoded[key] = value
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return key in self._field_set and hasattr(self, key)
+
+    def __iter__(self):
+        for key in self._fields:
+            if key not in self._optional or hasattr(self, key):
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Plain dict copy, with nested records and lists of records converted too"""
+        return {key: _plain(value) for key, value in self.items()}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+def _plain(value):
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [_plain(item) for item in value]
+    return value
+
+
+def record_type(name: str, fields, optional=(), types: Dict[str, str] = None) -> type:
+    """
+    Generate a slotted Record subclass with these keys (optional ones absent
+    until set). types maps keys to qbXML type names for typed().
+    """
+    fields = tuple(dict.fromkeys(fields))
+    return type(name, (Record,), {
+        '__slots__': fields + ('_decoded',),
+        '__module__': __name__,
+        '_fields': fields,
+        '_field_set': frozenset(fields),
+        '_optional': frozenset(optional),
+        '_types': {key: TYPE_DECODERS[kind] for key, kind in (types or {}).items()
+                   if kind in TYPE_DECODERS},
+    })
+
+
+# Output fields per record type: {qbXML tag: output key}. Values are read from
+# the *Ret element's direct children only, so a ListID or FullName inside a
+# nested ref can never be mistaken for the record's own.
+
+def _fields(*tags) -> Dict[str, str]:
+    return {tag: tag for tag in tags}
+
+
+ADDRESS_FIELDS = _fields('Addr1', 'Addr2', 'City', 'State', 'PostalCode', 'Country')
+REF_FIELDS = _fields('ListID', 'FullName')
+
+CUSTOMER_FIELDS = _fields(
+    'ListID', 'TimeCreated', 'TimeModified', 'EditSequence', 'Name', 'FullName',
+    'IsActive', 'CompanyName', 'FirstName', 'LastName', 'Email', 'Phone',
+    'AltPhone', 'Fax', 'Balance', 'TotalBalance',
+)
+VENDOR_FIELDS = _fields(
+    'ListID', 'TimeCreated', 'TimeModified', 'EditSequence', 'Name', 'IsActive',
+    'CompanyName', 'FirstName', 'LastName', 'Email', 'Phone', 'Balance',
+)
+INVOICE_FIELDS = _fields(
+    'TxnID', 'TimeCreated', 'TimeModified', 'EditSequence', 'TxnNumber', 'RefNumber',
+    'TxnDate', 'DueDate', 'Subtotal', 'SalesTaxTotal', 'AppliedAmount',
+    'BalanceRemaining', 'Memo', 'IsPaid',
+)
+INVOICE_LINE_FIELDS = {
+    'TxnLineID': 'TxnLineID', 'Desc': 'Description', 'Quantity': 'Quantity',
+    'Rate': 'Rate', 'Amount': 'Amount',
+}
+# SalesDesc/SalesPrice sit directly on ItemInventory; other item types keep
+# Desc/Price (or SalesDesc/SalesPrice) inside SalesOrPurchase/SalesAndPurchase
+ITEM_FIELDS = {
+    'ListID': 'ListID', 'TimeCreated': 'TimeCreated', 'TimeModified': 'TimeModified',
+    'EditSequence': 'EditSequence', 'Name': 'Name', 'FullName': 'FullName',
+    'IsActive': 'IsActive', 'SalesDesc': 'Description', 'Desc': 'Description',
+    'SalesPrice': 'Price', 'Price': 'Price', 'QuantityOnHand': 'QuantityOnHand',
+    'AverageCost': 'AverageCost',
+}
+ESTIMATE_FIELDS = _fields(
+    'TxnID', 'TimeCreated', 'TimeModified', 'EditSequence', 'TxnNumber', 'RefNumber',
+    'TxnDate', 'Subtotal', 'Memo', 'IsActive',
+)
+ACCOUNT_FIELDS = _fields(
+    'ListID', 'TimeCreated', 'TimeModified', 'EditSequence', 'Name', 'FullName',
+    'IsActive', 'AccountType', 'AccountNumber', 'Balance', 'TotalBalance',
+)
+CLASS_FIELDS = _fields(
+    'ListID', 'TimeCreated', 'TimeModified', 'EditSequence', 'Name', 'FullName', 'IsActive',
+)
+COMPANY_FIELDS = _fields('CompanyName', 'LegalCompanyName', 'Email', 'Phone', 'Fax', 'Website')
+HOST_FIELDS = _fields('ProductName', 'MajorVersion', 'MinorVersion', 'Country', 'QBFileMode')
+
+
+# Every item type QB_SCHEMA documents (ItemService, ..., ItemSalesTaxGroup)
+ITEM_TYPES = tuple(entity for entity in QB_SCHEMA if entity.startswith('Item'))
+ITEM_RET_TAGS = tuple(f"{item_type}Ret" for item_type in ITEM_TYPES)
+
+
+def _schema_fields(entity: str) -> Dict[str, Dict]:
+    """QB_SCHEMA field specs of an entity, OBJECT groups (SalesOrPurchase, ...) flattened in"""
+    flat = {}
+    for tag, spec in QB_SCHEMA[entity]['fields'].items():
+        if spec['type'] == 'OBJECT':
+            for inner, inner_spec in spec.get('nested', {}).items():
+                flat.setdefault(inner, inner_spec)
+        else:
+            flat.setdefault(tag, spec)
+    return flat
+
+
+def _field_types(fields: Dict[str, str], *schemas: Dict[str, Dict]) -> Dict[str, str]:
+    """{output key: qbXML type} for a field table, from the first schema defining each tag"""
+    types = {}
+    for schema in schemas:
+        for tag, key in fields.items():
+            if tag in schema:
+                types.setdefault(key, schema[tag]['type'])
+    return types
+
+
+_INVOICE_LINE_SCHEMA = QB_SCHEMA['Invoice']['fields']['InvoiceLineRet']['nested']
+_ITEM_SCHEMAS = [_schema_fields(item_type) for item_type in ITEM_TYPES]
+
+# Record classes generated from the field tables above
+AddressRecord = record_type('AddressRecord', ADDRESS_FIELDS.values())
+RefRecord = record_type('RefRecord', REF_FIELDS.values())
+CustomerRecord = record_type('CustomerRecord', [*CUSTOMER_FIELDS.values(), 'BillAddress'],
+                             optional=['BillAddress'],
+                             types=_field_types(CUSTOMER_FIELDS, _schema_fields('Customer')))
+VendorRecord = record_type('VendorRecord', VENDOR_FIELDS.values(),
+                           types=_field_types(VENDOR_FIELDS, _schema_fields('Vendor')))
+InvoiceRecord = record_type('InvoiceRecord', [*INVOICE_FIELDS.values(), 'CustomerRef', 'LineItems'],
+                            optional=['CustomerRef'],
+                            types=_field_types(INVOICE_FIELDS, _schema_fields('Invoice')))
+InvoiceLineRecord = record_type('InvoiceLineRecord', [*INVOICE_LINE_FIELDS.values(), 'ItemRef'],
+                                optional=['ItemRef'],
+                                types=_field_types(INVOICE_LINE_FIELDS, _INVOICE_LINE_SCHEMA))
+ItemRecord = record_type('ItemRecord', [
+    'ListID', 'TimeCreated', 'TimeModified', 'EditSequence', 'Name', 'FullName', 'IsActive',
+    'ItemType', 'Description', 'Price', 'QuantityOnHand', 'AverageCost',
+], types=_field_types(ITEM_FIELDS, *_ITEM_SCHEMAS))
+EstimateRecord = record_type('EstimateRecord', [*ESTIMATE_FIELDS.values(), 'CustomerRef'],
+                             optional=['CustomerRef'],
+                             types=_field_types(ESTIMATE_FIELDS, _schema_fields('Estimate')))
+AccountRecord = record_type('AccountRecord', ACCOUNT_FIELDS.values(),
+                            types=_field_types(ACCOUNT_FIELDS, _schema_fields('Account')))
+ClassRecord = record_type('ClassRecord', CLASS_FIELDS.values(),
+                          types=_field_types(CLASS_FIELDS, _schema_fields('Class')))
+CompanyRecord = record_type('CompanyRecord', [*COMPANY_FIELDS.values(), 'Address'], optional=['Address'],
+                            types=_field_types(COMPANY_FIELDS, _schema_fields('Company')))
+HostRecord = record_type('HostRecord', HOST_FIELDS.values())
+
+# {output key: decoder} across every record type, for decode() on plain dicts
+FIELD_DECODERS = {key: decoder for record_class in reversed(Record.__subclasses__())
+                  for key, decoder in record_class._types.items()}
+
+
+def decode(mapping: Mapping, key: str, default=None):
+    """
+    Value of key in any mapping (a Record or a plain dict) decoded per its
+    QB_SCHEMA type, as Record.typed() does. Values that are not strings are
+    returned as they are; default if the key is missing, empty or doesn't decode.
+    """
+    if isinstance(mapping, Record):
+        return mapping.typed(key, default)
+    value = mapping.get(key)
+    decoder = FIELD_DECODERS.get(key)
+    if isinstance(value, str) and decoder is not None:
+        value = decoder(value)
+    return default if value is None else value
+
+
+def extract_fields(elem, fields: Dict[str, str], nested: Dict = None) -> Dict[str, Any]:
+    """
+    Build a record from one pass over elem's direct children.
+
+    fields maps leaf tags to output keys (missing fields are None; the first
+    occurrence wins). nested maps tags of child elements to handler(record, child).
+    """
+    record = dict.fromkeys(fields.values())
+    for child in elem:
+        tag = child.tag
+        key = fields.get(tag)
+        if key is not None:
+            if record[key] is None:
+                record[key] = child.text
+        elif nested is not None:
+            handler = nested.get(tag)
+            if handler is not None:
+                handler(record, child)
+    return record
+
+
+def _nested_record(key: str, fields: Dict[str, str], record_cls: type):
+    """Handler storing the first such child element as a sub-record under key"""
+    def handler(record, child):
+        if key not in record:
+            record[key] = record_cls.from_dict(extract_fields(child, fields))
+    return handler
+
+
+def _flattened(fields: Dict[str, str]):
+    """Handler merging a wrapper element's leaf children into the record itself"""
+    def handler(record, child):
+        for sub in child:
+            key = fields.get(sub.tag)
+            if key is not None and record[key] is None:
+                record[key] = sub.text
+    return handler
+
+
+_address = _nested_record('BillAddress', ADDRESS_FIELDS, AddressRecord)
+_customer_ref = _nested_record('CustomerRef', REF_FIELDS, RefRecord)
+_item_ref = _nested_record('ItemRef', REF_FIELDS, RefRecord)
+
+LINE_NESTED = {'ItemRef': _item_ref}
+
+
+def _invoice_line(record, child):
+    line = InvoiceLineRecord.from_dict(extract_fields(child, INVOICE_LINE_FIELDS, LINE_NESTED))
+    record.setdefault('LineItems', []).append(line)
+
+
+def _invoice_line_group(record, child):
+    # Lines of an item group are nested one level down
+    for line in child:
+        if line.tag == 'InvoiceLineRet':
+            _invoice_line(record, line)
+
+
+CUSTOMER_NESTED = {'BillAddress': _address}
+INVOICE_NESTED = {
+    'CustomerRef': _customer_ref,
+    'InvoiceLineRet': _invoice_line,
+    'InvoiceLineGroupRet': _invoice_line_group,
+}
+ITEM_NESTED = {
+    'SalesOrPurchase': _flattened(ITEM_FIELDS),
+    'SalesAndPurchase': _flattened(ITEM_FIELDS),
+}
+ESTIMATE_NESTED = {'CustomerRef': _customer_ref}
+COMPANY_NESTED = {'Address': _nested_record('Address', ADDRESS_FIELDS, AddressRecord)}
+
+
+def customer_record(customer_ret) -> Record:
+    return CustomerRecord.from_dict(extract_fields(customer_ret, CUSTOMER_FIELDS, CUSTOMER_NESTED))
+
+
+def vendor_record(vendor_ret) -> Record:
+    return VendorRecord.from_dict(extract_fields(vendor_ret, VENDOR_FIELDS))
+
+
+def invoice_record(invoice_ret) -> Record:
+    invoice = extract_fields(invoice_ret, INVOICE_FIELDS, INVOICE_NESTED)
+    invoice.setdefault('LineItems', [])
+    return InvoiceRecord.from_dict(invoice)
+
+
+# Item types without a sales description (discount, group, subtotal, sales
+# tax) describe themselves in ItemDesc
+ITEM_TYPE_FIELDS = {
+    item_type: {**ITEM_FIELDS, 'ItemDesc': 'Description'}
+    if 'ItemDesc' in QB_SCHEMA[item_type]['fields'] else ITEM_FIELDS
+    for item_type in ITEM_TYPES
+}
+
+
+def item_record(item_ret, item_type: str) -> Record:
+    item = extract_fields(item_ret, ITEM_TYPE_FIELDS.get(item_type, ITEM_FIELDS), ITEM_NESTED)
+    item['ItemType'] = item_type
+    return ItemRecord.from_dict(item)
+
+
+def _item_builder(item_type: str):
+    def build(item_ret) -> Record:
+        return item_record(item_ret, item_type)
+    return build
+
+
+# *Ret tag -> record builder, one per item type
+ITEM_BUILDERS = {f"{item_type}Ret": _item_builder(item_type) for item_type in ITEM_TYPES}
+
+
+def estimate_record(estimate_ret) -> Record:
+    return EstimateRecord.from_dict(extract_fields(estimate_ret, ESTIMATE_FIELDS, ESTIMATE_NESTED))
+
+
+def account_record(account_ret) -> Record:
+    return AccountRecord.from_dict(extract_fields(account_ret, ACCOUNT_FIELDS))
+
+
+def class_record(class_ret) -> Record:
+    return ClassRecord.from_dict(extract_fields(class_ret, CLASS_FIELDS))
+
+
+def company_record(company_ret) -> Record:
+    return CompanyRecord.from_dict(extract_fields(company_ret, COMPANY_FIELDS, COMPANY_NESTED))
+
+
+def host_record(host_ret) -> Record:
+    return HostRecord.from_dict(extract_fields(host_ret, HOST_FIELDS))
+
+
+def _records(response_elem, ret_tag: str, build) -> List[Dict]:
+    """Build a record from every direct *Ret child of a response element"""
+    return [build(child) for child in response_elem if child.tag == ret_tag]
+
+
 def parse_customers(response_elem) -> List[Dict]:
     """Parse CustomerQueryRs / CustomerAddRs / CustomerModRs"""
-    customers = []
-    for customer_ret in response_elem.findall('.//CustomerRet'):
-        customer = {
-            'ListID': get_text(customer_ret, 'ListID'),
-            'TimeCreated': get_text(customer_ret, 'TimeCreated'),
-            'TimeModified': get_text(customer_ret, 'TimeModified'),
-            'EditSequence': get_text(customer_ret, 'EditSequence'),
-            'Name': get_text(customer_ret, 'Name'),
-            'FullName': get_text(customer_ret, 'FullName'),
-            'IsActive': get_text(customer_ret, 'IsActive'),
-            'CompanyName': get_text(customer_ret, 'CompanyName'),
-            'FirstName': get_text(customer_ret, 'FirstName'),
-            'LastName': get_text(customer_ret, 'LastName'),
-            'Email': get_text(customer_ret, 'Email'),
-            'Phone': get_text(customer_ret, 'Phone'),
-            'AltPhone': get_text(customer_ret, 'AltPhone'),
-            'Fax': get_text(customer_ret, 'Fax'),
-            'Balance': get_text(customer_ret, 'Balance'),
-            'TotalBalance': get_text(customer_ret, 'TotalBalance'),
-        }
-
-        # Parse billing address
-        bill_addr = customer_ret.find('.//BillAddress')
-        if bill_addr is not None:
-            customer['BillAddress'] = {
-                'Addr1': get_text(bill_addr, 'Addr1'),
-                'Addr2': get_text(bill_addr, 'Addr2'),
-                'City': get_text(bill_addr, 'City'),
-                'State': get_text(bill_addr, 'State'),
-                'PostalCode': get_text(bill_addr, 'PostalCode'),
-                'Country': get_text(bill_addr, 'Country'),
-            }
-
-        customers.append(customer)
-    return customers
+    return _records(response_elem, 'CustomerRet', customer_record)
 
 
 def parse_vendors(response_elem) -> List[Dict]:
     """Parse VendorQueryRs / VendorAddRs"""
-    vendors = []
-    for vendor_ret in response_elem.findall('.//VendorRet'):
-        vendor = {
-            'ListID': get_text(vendor_ret, 'ListID'),
-            'TimeCreated': get_text(vendor_ret, 'TimeCreated'),
-            'TimeModified': get_text(vendor_ret, 'TimeModified'),
-            'EditSequence': get_text(vendor_ret, 'EditSequence'),
-            'Name': get_text(vendor_ret, 'Name'),
-            'IsActive': get_text(vendor_ret, 'IsActive'),
-            'CompanyName': get_text(vendor_ret, 'CompanyName'),
-            'FirstName': get_text(vendor_ret, 'FirstName'),
-            'LastName': get_text(vendor_ret, 'LastName'),
-            'Email': get_text(vendor_ret, 'Email'),
-            'Phone': get_text(vendor_ret, 'Phone'),
-            'Balance': get_text(vendor_ret, 'Balance'),
-        }
-        vendors.append(vendor)
-    return vendors
+    return _records(response_elem, 'VendorRet', vendor_record)
 
 
 def parse_invoices(response_elem) -> List[Dict]:
     """Parse InvoiceQueryRs / InvoiceAddRs"""
-    invoices = []
-    for invoice_ret in response_elem.findall('.//InvoiceRet'):
-        invoice = {
-            'TxnID': get_text(invoice_ret, 'TxnID'),
-            'TimeCreated': get_text(invoice_ret, 'TimeCreated'),
-            'TimeModified': get_text(invoice_ret, 'TimeModified'),
-            'EditSequence': get_text(invoice_ret, 'EditSequence'),
-            'TxnNumber': get_text(invoice_ret, 'TxnNumber'),
-            'RefNumber': get_text(invoice_ret, 'RefNumber'),
-            'TxnDate': get_text(invoice_ret, 'TxnDate'),
-            'DueDate': get_text(invoice_ret, 'DueDate'),
-            'Subtotal': get_text(invoice_ret, 'Subtotal'),
-            'SalesTaxTotal': get_text(invoice_ret, 'SalesTaxTotal'),
-            'AppliedAmount': get_text(invoice_ret, 'AppliedAmount'),
-            'BalanceRemaining': get_text(invoice_ret, 'BalanceRemaining'),
-            'Memo': get_text(invoice_ret, 'Memo'),
-            'IsPaid': get_text(invoice_ret, 'IsPaid'),
-        }
-
-        # Customer reference
-        customer_ref = invoice_ret.find('.//CustomerRef')
-        if customer_ref is not None:
-            invoice['CustomerRef'] = {
-                'ListID': get_text(customer_ref, 'ListID'),
-                'FullName': get_text(customer_ref, 'FullName'),
-            }
-
-        # Line items
-        invoice['LineItems'] = []
-        for line in invoice_ret.findall('.//InvoiceLineRet'):
-            line_item = {
-                'TxnLineID': get_text(line, 'TxnLineID'),
-                'Description': get_text(line, 'Desc'),
-                'Quantity': get_text(line, 'Quantity'),
-                'Rate': get_text(line, 'Rate'),
-                'Amount': get_text(line, 'Amount'),
-            }
-            item_ref = line.find('.//ItemRef')
-            if item_ref is not None:
-                line_item['ItemRef'] = {
-                    'ListID': get_text(item_ref, 'ListID'),
-                    'FullName': get_text(item_ref, 'FullName'),
-                }
-            invoice['LineItems'].append(line_item)
-
-        invoices.append(invoice)
-    return invoices
+    return _records(response_elem, 'InvoiceRet', invoice_record)
 
 
 def parse_items(response_elem) -> List[Dict]:
-    """Parse ItemQueryRs / ItemInventoryQueryRs"""
+    """Parse ItemQueryRs / ItemInventoryQueryRs: items of every type, in response order"""
     items = []
-
-    # Handle different item types
-    for item_type in ['ItemServiceRet', 'ItemInventoryRet', 'ItemNonInventoryRet',
-                      'ItemOtherChargeRet', 'ItemDiscountRet', 'ItemGroupRet']:
-        for item_ret in response_elem.findall(f'.//{item_type}'):
-            item = {
-                'ListID': get_text(item_ret, 'ListID'),
-                'TimeCreated': get_text(item_ret, 'TimeCreated'),
-                'TimeModified': get_text(item_ret, 'TimeModified'),
-                'EditSequence': get_text(item_ret, 'EditSequence'),
-                'Name': get_text(item_ret, 'Name'),
-                'FullName': get_text(item_ret, 'FullName'),
-                'IsActive': get_text(item_ret, 'IsActive'),
-                'ItemType': item_type.replace('Ret', ''),
-                'Description': get_text(item_ret, 'SalesDesc') or get_text(item_ret, 'Desc'),
-                'Price': get_text(item_ret, 'SalesPrice') or get_text(item_ret, 'Price'),
-                'QuantityOnHand': get_text(item_ret, 'QuantityOnHand'),
-                'AverageCost': get_text(item_ret, 'AverageCost'),
-            }
-            items.append(item)
-
+    for child in response_elem:
+        build = ITEM_BUILDERS.get(child.tag)
+        if build is not None:
+            items.append(build(child))
     return items
 
 
 def parse_estimates(response_elem) -> List[Dict]:
     """Parse EstimateQueryRs / EstimateAddRs"""
-    estimates = []
-    for estimate_ret in response_elem.findall('.//EstimateRet'):
-        estimate = {
-            'TxnID': get_text(estimate_ret, 'TxnID'),
-            'TimeCreated': get_text(estimate_ret, 'TimeCreated'),
-            'TimeModified': get_text(estimate_ret, 'TimeModified'),
-            'EditSequence': get_text(estimate_ret, 'EditSequence'),
-            'TxnNumber': get_text(estimate_ret, 'TxnNumber'),
-            'RefNumber': get_text(estimate_ret, 'RefNumber'),
-            'TxnDate': get_text(estimate_ret, 'TxnDate'),
-            'Subtotal': get_text(estimate_ret, 'Subtotal'),
-            'Memo': get_text(estimate_ret, 'Memo'),
-            'IsActive': get_text(estimate_ret, 'IsActive'),
-        }
-
-        # Customer reference
-        customer_ref = estimate_ret.find('.//CustomerRef')
-        if customer_ref is not None:
-            estimate['CustomerRef'] = {
-                'ListID': get_text(customer_ref, 'ListID'),
-                'FullName': get_text(customer_ref, 'FullName'),
-            }
-
-        estimates.append(estimate)
-    return estimates
+    return _records(response_elem, 'EstimateRet', estimate_record)
 
 
 def parse_accounts(response_elem) -> List[Dict]:
     """Parse AccountQueryRs"""
-    accounts = []
-    for account_ret in response_elem.findall('.//AccountRet'):
-        account = {
-            'ListID': get_text(account_ret, 'ListID'),
-            'TimeCreated': get_text(account_ret, 'TimeCreated'),
-            'TimeModified': get_text(account_ret, 'TimeModified'),
-            'EditSequence': get_text(account_ret, 'EditSequence'),
-            'Name': get_text(account_ret, 'Name'),
-            'FullName': get_text(account_ret, 'FullName'),
-            'IsActive': get_text(account_ret, 'IsActive'),
-            'AccountType': get_text(account_ret, 'AccountType'),
-            'AccountNumber': get_text(account_ret, 'AccountNumber'),
-            'Balance': get_text(account_ret, 'Balance'),
-            'TotalBalance': get_text(account_ret, 'TotalBalance'),
-        }
-        accounts.append(account)
-    return accounts
+    return _records(response_elem, 'AccountRet', account_record)
 
 
 def parse_classes(response_elem) -> List[Dict]:
     """Parse ClassQueryRs"""
-    classes = []
-    for class_ret in response_elem.findall('.//ClassRet'):
-        cls = {
-            'ListID': get_text(class_ret, 'ListID'),
-            'TimeCreated': get_text(class_ret, 'TimeCreated'),
-            'TimeModified': get_text(class_ret, 'TimeModified'),
-            'EditSequence': get_text(class_ret, 'EditSequence'),
-            'Name': get_text(class_ret, 'Name'),
-            'FullName': get_text(class_ret, 'FullName'),
-            'IsActive': get_text(class_ret, 'IsActive'),
-        }
-        classes.append(cls)
-    return classes
+    return _records(response_elem, 'ClassRet', class_record)
 
 
 def parse_company(response_elem) -> List[Dict]:
     """Parse CompanyQueryRs"""
-    companies = []
-    for company_ret in response_elem.findall('.//CompanyRet'):
-        company = {
-            'CompanyName': get_text(company_ret, 'CompanyName'),
-            'LegalCompanyName': get_text(company_ret, 'LegalCompanyName'),
-            'Email': get_text(company_ret, 'Email'),
-            'Phone': get_text(company_ret, 'Phone'),
-            'Fax': get_text(company_ret, 'Fax'),
-            'Website': get_text(company_ret, 'Website'),
-        }
-
-        address = company_ret.find('.//Address')
-        if address is not None:
-            company['Address'] = {
-                'Addr1': get_text(address, 'Addr1'),
-                'Addr2': get_text(address, 'Addr2'),
-                'City': get_text(address, 'City'),
-                'State': get_text(address, 'State'),
-                'PostalCode': get_text(address, 'PostalCode'),
-                'Country': get_text(address, 'Country'),
-            }
-
-        companies.append(company)
-    return companies
+    return _records(response_elem, 'CompanyRet', company_record)
 
 
 def parse_host(response_elem) -> List[Dict]:
     """Parse HostQueryRs"""
-    hosts = []
-    for host_ret in response_elem.findall('.//HostRet'):
-        host = {
-            'ProductName': get_text(host_ret, 'ProductName'),
-            'MajorVersion': get_text(host_ret, 'MajorVersion'),
-            'MinorVersion': get_text(host_ret, 'MinorVersion'),
-            'Country': get_text(host_ret, 'Country'),
-            'QBFileMode': get_text(host_ret, 'QBFileMode'),
-        }
-        hosts.append(host)
-    return hosts
+    return _records(response_elem, 'HostRet', host_record)
+
+
+# Response element tag -> parser(response_elem) returning its records.
+# Tags not listed here go to parse_generic(); add parsers with register_response_parser().
+RESPONSE_PARSERS = {
+    'CustomerQueryRs': parse_customers,
+    'CustomerAddRs': parse_customers,
+    'CustomerModRs': parse_customers,
+    'VendorQueryRs': parse_vendors,
+    'VendorAddRs': parse_vendors,
+    'InvoiceQueryRs': parse_invoices,
+    'InvoiceAddRs': parse_invoices,
+    'ItemQueryRs': parse_items,
+    'ItemInventoryQueryRs': parse_items,
+    'EstimateQueryRs': parse_estimates,
+    'EstimateAddRs': parse_estimates,
+    'AccountQueryRs': parse_accounts,
+    'ClassQueryRs': parse_classes,
+    'CompanyQueryRs': parse_company,
+    'HostQueryRs': parse_host,
+}
+
+
+def register_response_parser(response_tag: str, parse, ret_tags=None, build_record=None):
+    """
+    Plug in a parser for a response element tag (e.g. 'SalesOrderQueryRs').
+
+    parse(response_elem) returns the response's records. To stream the
+    response too, also pass build_record(ret_elem) and the *Ret tags it
+    handles (None: every child); without them QBXMLStream falls back to
+    element_to_dict() records.
+    """
+    RESPONSE_PARSERS[response_tag] = parse
+    if build_record is not None:
+        RECORD_BUILDERS[response_tag] = (tuple(ret_tags) if ret_tags is not None else None, build_record)
+    else:
+        RECORD_BUILDERS.pop(response_tag, None)
 
 
 def parse_generic(response_elem) -> List[Dict]:
@@ -363,7 +798,544 @@ def parse_generic(response_elem) -> List[Dict]:
     return results
 
 
-def get_text(elem, tag) -> Optional[str]:
-    """Get text content of a child element"""
-    child = elem.find(f'.//{tag}')
-    return child.text if child is not None else None
+# Schema-compiled extractors
+#
+# Turn QB_SCHEMA entity definitions into record extractors once, up front,
+# so parsing a record is a single pass over its children against prebuilt
+# lookup tables. Records use the schema's field names; composite fields
+# (REF, ADDRESS, ADDRESSBLOCK, OBJECT) become nested dicts and LIST fields
+# lists of dicts. Missing fields are None (LIST fields []); children the
+# schema doesn't document are ignored.
+
+COMPOSITE_TYPES = ('REF', 'ADDRESS', 'ADDRESSBLOCK', 'OBJECT')
+LIST_TYPE = 'LIST'
+
+# Sub-fields of composite fields the schema leaves undescribed
+_DEFAULT_NESTED = {
+    'REF': {'ListID': {'type': 'IDTYPE'}, 'FullName': {'type': 'STRTYPE'}},
+    'ADDRESS': {tag: {'type': 'STRTYPE'} for tag in (
+        'Addr1', 'Addr2', 'Addr3', 'Addr4', 'Addr5', 'City', 'State', 'PostalCode', 'Country', 'Note')},
+    'ADDRESSBLOCK': {tag: {'type': 'STRTYPE'} for tag in ('Addr1', 'Addr2', 'Addr3', 'Addr4', 'Addr5')},
+}
+
+
+def _field_selection(fields) -> Dict[str, Any]:
+    """
+    ['Name', 'BillAddress.City', 'BillAddress.State'] ->
+    {'Name': None, 'BillAddress': {'City': None, 'State': None}}
+    (None: the whole field)
+    """
+    selection = {}
+    for path in fields:
+        name, _, rest = path.partition('.')
+        if not rest:
+            selection[name] = None
+        elif name not in selection or selection[name] is not None:
+            selection.setdefault(name, {})
+            selection[name].update(_field_selection([rest]))
+    return selection
+
+
+# How _compile_fields' extractors handle each child tag
+_TEXT, _ONE, _MANY = 'text', 'one', 'many'
+
+
+def _compile_fields(schema_fields: Dict[str, Dict], selection: Optional[Dict], path: str):
+    """Build the extractor for one level of a schema (see compile_extractor)"""
+    names = list(selection) if selection is not None else list(schema_fields)
+    kinds = {}
+    extractors = {}
+    for name in names:
+        spec = schema_fields.get(name)
+        if spec is None:
+            raise ValueError(f"{path} has no field {name!r}")
+        kind = spec['type']
+        sub_selection = selection.get(name) if selection is not None else None
+
+        if kind in COMPOSITE_TYPES or kind == LIST_TYPE:
+            nested = spec.get('nested') or _DEFAULT_NESTED.get(kind)
+            if nested:
+                extractors[name] = _compile_fields(nested, sub_selection, f"{path}.{name}")
+            elif sub_selection is not None:
+                raise ValueError(f"{path}.{name} has no documented sub-fields to select")
+            else:
+                extractors[name] = element_to_dict
+            kinds[name] = _MANY if kind == LIST_TYPE else _ONE
+        else:
+            if sub_selection is not None:
+                raise ValueError(f"{path}.{name} is a {kind} value, not a structure")
+            kinds[name] = _TEXT
+
+    template = dict.fromkeys(names)
+    list_names = tuple(name for name in names if kinds[name] is _MANY)
+
+    def extract(elem) -> Dict[str, Any]:
+        record = template.copy()
+        for name in list_names:
+            record[name] = []
+        for child in elem:
+            tag = child.tag
+            kind = kinds.get(tag)
+            if kind is _TEXT:
+                record[tag] = child.text
+            elif kind is _ONE:
+                record[tag] = extractors[tag](child)
+            elif kind is _MANY:
+                record[tag].append(extractors[tag](child))
+        return record
+
+    return extract
+
+
+def compile_extractor(entity: str, fields=None):
+    """
+    Compile an extractor for one QB_SCHEMA entity (e.g. 'Customer').
+
+    fields optionally limits the record to some fields; a dotted path picks
+    sub-fields of a structure ('BillAddress.City'). Raises ValueError for
+    unknown entities or fields. The returned function takes the entity's
+    *Ret element and returns its record.
+    """
+    schema = QB_SCHEMA.get(entity)
+    if schema is None:
+        raise ValueError(f"Unknown QB entity {entity!r}")
+    selection = _field_selection(fields) if fields is not None else None
+    return _compile_fields(schema['fields'], selection, entity)
+
+
+# (entity, field subset or None) -> compiled extractor, filled on first use.
+# Only parse_schema_records() uses these (today just benchmarks.py), so
+# nothing is compiled at import time.
+_schema_extractors = {}
+
+
+def schema_extractor(entity: str, fields=None):
+    """Compiled extractor for an entity or a field subset of it, cached after first use"""
+    key = (entity, None if fields is None else tuple(fields))
+    extract = _schema_extractors.get(key)
+    if extract is None:
+        extract = _schema_extractors[key] = compile_extractor(entity, fields)
+    return extract
+
+
+def parse_schema_records(response_elem, fields: Dict[str, List[str]] = None) -> List[Dict]:
+    """
+    Schema records for every *Ret child of a response element.
+
+    fields optionally maps entity names to field subsets, e.g.
+    {'Invoice': ['TxnID', 'CustomerRef', 'InvoiceLineRet.Amount']}; other
+    entities get every schema field. *Ret elements QB_SCHEMA doesn't
+    describe fall back to element_to_dict(). Extractors are compiled on first
+    use; the sync paths use RESPONSE_PARSERS, so today this serves benchmarks.py.
+    """
+    fields = fields or {}
+    # Extractor per *Ret tag in this response (None: not in the schema)
+    extractors = {}
+    records = []
+    for child in response_elem:
+        tag = child.tag
+        extract = extractors.get(tag, _UNRESOLVED)
+        if extract is _UNRESOLVED:
+            extract = extractors[tag] = _schema_extractor_for(tag, fields)
+        if extract is not None:
+            records.append(extract(child))
+    return records
+
+
+_UNRESOLVED = object()
+
+
+def _schema_extractor_for(tag, fields: Dict[str, List[str]]):
+    """Extractor for a response child tag; None for anything but *Ret elements"""
+    if not isinstance(tag, str) or not tag.endswith('Ret'):
+        return None
+    entity = tag[:-len('Ret')]
+    if entity not in QB_SCHEMA:
+        return element_to_dict
+    return schema_extractor(entity, fields.get(entity))
+
+
+# Characters (or bytes) of an in-memory response fed to the streaming parser at a time
+STREAM_CHUNK_SIZE = 1 << 20
+
+# Sources QBXMLStream can re-read from the start
+IN_MEMORY_TYPES = (str, bytes, bytearray, memoryview)
+
+
+def _iter_chunks(source, chunk_size: int):
+    """Feedable pieces of a str, bytes, memoryview or file-like response"""
+    if isinstance(source, (str, bytes)):
+        for start in range(0, len(source), chunk_size):
+            yield source[start:start + chunk_size]
+    elif isinstance(source, (memoryview, bytearray)):
+        # The pull parser only takes str/bytes: copy one chunk at a time
+        view = memoryview(source)
+        for start in range(0, len(view), chunk_size):
+            yield view[start:start + chunk_size].tobytes()
+    else:
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _item_ret_record(elem) -> Dict:
+    return ITEM_BUILDERS[elem.tag](elem)
+
+
+def _generic_record(elem) -> Optional[Dict]:
+    return element_to_dict(elem) if elem.tag.endswith('Ret') else None
+
+
+# Response element tag -> (*Ret tags to build or None for every child,
+# build(ret_elem) -> record or None); QBXMLStream's counterpart of RESPONSE_PARSERS
+RECORD_BUILDERS = {
+    'CustomerQueryRs': (('CustomerRet',), customer_record),
+    'CustomerAddRs': (('CustomerRet',), customer_record),
+    'CustomerModRs': (('CustomerRet',), customer_record),
+    'VendorQueryRs': (('VendorRet',), vendor_record),
+    'VendorAddRs': (('VendorRet',), vendor_record),
+    'InvoiceQueryRs': (('InvoiceRet',), invoice_record),
+    'InvoiceAddRs': (('InvoiceRet',), invoice_record),
+    'ItemQueryRs': (ITEM_RET_TAGS, _item_ret_record),
+    'ItemInventoryQueryRs': (ITEM_RET_TAGS, _item_ret_record),
+    'EstimateQueryRs': (('EstimateRet',), estimate_record),
+    'EstimateAddRs': (('EstimateRet',), estimate_record),
+    'AccountQueryRs': (('AccountRet',), account_record),
+    'ClassQueryRs': (('ClassRet',), class_record),
+    'CompanyQueryRs': (('CompanyRet',), company_record),
+    'HostQueryRs': (('HostRet',), host_record),
+}
+
+
+def _record_builder(response_type: str):
+    """(tags, build) for the records of a response element; see RECORD_BUILDERS"""
+    return RECORD_BUILDERS.get(response_type, (None, _generic_record))
+
+
+class QBXMLStream:
+    """
+    Incremental parse of a qbXML response with bounded memory.
+
+    Iterating yields the same records as parse_qbxml_response()'s 'data'.
+    Each *Ret element is discarded once its record is built, so peak memory
+    is bounded by the largest single record rather than the whole response.
+
+    status_code, status_message, success and response_type only read as far
+    as the response element's start tag, so a failed request can be handled
+    before any records are parsed. Malformed XML raises etree.XMLSyntaxError
+    from whichever of these runs into it.
+
+    Only the first response element is read, as in parse_qbxml_response().
+    bytes, bytearray or memoryview responses of PARALLEL_PARSE_MIN_BYTES or
+    more are parsed by worker processes a few pieces ahead of the consumer
+    instead (see _parallel_records()), yielding the same records. They are
+    split in place; text would need a full encoded copy, so it always
+    streams in this process.
+    """
+
+    def __init__(self, source, chunk_size: int = STREAM_CHUNK_SIZE):
+        """source: the response as str, bytes or memoryview, or a file object"""
+        self._source = source
+        self._chunk_size = chunk_size
+        self._status = None
+        self._response_type = None
+        # Chunks of a file source read while looking for the status, fed again for the records
+        self._head = []
+        self._iterated = False
+
+    def _read_status(self):
+        """Parse up to the response element's start tag"""
+        if self._status is not None:
+            return
+        source = self._source
+        if isinstance(source, IN_MEMORY_TYPES) and is_blank(source):
+            self._status = ('', 'Empty response')
+            return
+
+        parser = etree.XMLPullParser(events=('start', 'end'), **PARSER_OPTIONS)
+        depth = 0
+        msgs_depth = None
+        for chunk in _iter_chunks(source, self._chunk_size):
+            if not isinstance(source, IN_MEMORY_TYPES):
+                self._head.append(chunk)
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                if event == 'end':
+                    depth -= 1
+                    if msgs_depth is not None and depth < msgs_depth:
+                        self._status = ('', 'No response element found')
+                        return
+                    continue
+                depth += 1
+                if msgs_depth is None:
+                    if elem.tag == 'QBXMLMsgsRs':
+                        msgs_depth = depth
+                elif depth == msgs_depth + 1 and elem.tag.endswith('Rs'):
+                    self._response_type = elem.tag
+                    self._status = (elem.get('statusCode', ''), elem.get('statusMessage', ''))
+                    return
+        parser.close()
+        self._status = ('', 'No QBXMLMsgsRs found' if msgs_depth is None else 'No response element found')
+
+    @property
+    def response_type(self) -> Optional[str]:
+        """Tag of the response element, e.g. 'InvoiceQueryRs'"""
+        self._read_status()
+        return self._response_type
+
+    @property
+    def status_code(self) -> str:
+        self._read_status()
+        return self._status[0]
+
+    @property
+    def status_message(self) -> str:
+        self._read_status()
+        return self._status[1]
+
+    @property
+    def success(self) -> bool:
+        return self.response_type is not None and self.status_code == '0'
+
+    def __iter__(self):
+        """Yield the response's records; a stream can be iterated once"""
+        if self._iterated:
+            raise RuntimeError("QBXMLStream can only be iterated once")
+        self._iterated = True
+
+        response_type = self.response_type
+        if response_type is None:
+            return
+
+        # Records already yielded by a parallel parse that then failed
+        done = 0
+        if not isinstance(self._source, str) and _use_parallel_parse(self._source):
+            split = _split_response(self._source)
+            if split is not None and split[0] == response_type:
+                try:
+                    for record in _parallel_records(*split):
+                        yield record
+                        done += 1
+                    return
+                except Exception as e:
+                    logger.warning(f"Parallel parse of {response_type} failed after {done} records, "
+                                   f"continuing in one process: {e}")
+
+        for record in self._stream_records(response_type):
+            if done:
+                done -= 1
+                continue
+            yield record
+
+    def _stream_records(self, response_type: str):
+        tags, build = _record_builder(response_type)
+
+        # A second pass that only reports the elements we build (and the end of
+        # the response): per-element events would cost more than the parse itself
+        if tags is None:
+            parser = etree.XMLPullParser(events=('end',), **PARSER_OPTIONS)
+        else:
+            parser = etree.XMLPullParser(events=('end',), tag=tags + (response_type,), **PARSER_OPTIONS)
+
+        for elem in self._events(parser):
+            parent = elem.getparent()
+            if parent is None:
+                continue
+            if elem.tag == response_type and parent.tag == 'QBXMLMsgsRs':
+                return
+            if parent.tag != response_type:
+                continue
+            record = build(elem)
+            # Free the element and everything before it
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+            if record is not None:
+                yield record
+
+    def _events(self, parser):
+        chunks = _iter_chunks(self._source, self._chunk_size)
+        if self._head:
+            chunks = itertools.chain(self._head, chunks)
+            self._head = []
+        for chunk in chunks:
+            parser.feed(chunk)
+            for _, elem in parser.read_events():
+                yield elem
+        parser.close()
+        for _, elem in parser.read_events():
+            yield elem
+
+
+# Parallel parsing of very large responses.
+#
+# The *Ret elements of a query response are independent, so the byte range
+# holding them can be cut at *Ret start tags into pieces that each parse as the
+# body of a response element on their own. Worker processes parse the pieces
+# with the normal parser and the records are concatenated in order, which
+# gives exactly the single-process result.
+
+# Response types split this way (their built-in parsers), and the start tags
+# of their *Ret elements, where pieces are cut
+PARALLEL_PARSERS = {tag: RESPONSE_PARSERS[tag] for tag in RECORD_BUILDERS}
+_RET_START_TAGS = {
+    tag: re.compile(b'<(?:' + b'|'.join(t.encode('ascii') for t in ret_tags) + rb')[\s/>]')
+    for tag, (ret_tags, _) in RECORD_BUILDERS.items()
+}
+
+# Pieces per worker, so one slow piece doesn't leave the other workers idle
+PARALLEL_PIECES_PER_WORKER = 4
+PARALLEL_MIN_PIECE_BYTES = 1 << 20
+
+_RESPONSE_START = re.compile(rb'<(?!QBXMLMsgsRs[\s/>])(\w+Rs)[\s/>]')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _parallel_workers() -> int:
+    """Worker processes for parallel parsing: PARALLEL_PARSE_WORKERS, at most one per CPU"""
+    return min(PARALLEL_PARSE_WORKERS, os.cpu_count() or 1)
+
+
+def _use_parallel_parse(xml_string) -> bool:
+    """Whether a response is large enough for the parallel parse mode (and there are CPUs for it)"""
+    return (isinstance(xml_string, IN_MEMORY_TYPES) and len(xml_string) >= PARALLEL_PARSE_MIN_BYTES
+            and _parallel_workers() > 1)
+
+
+def _process_pool() -> ProcessPoolExecutor:
+    """Worker processes shared by all parallel parses, started on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=_parallel_workers())
+        return _pool
+
+
+def _discard_pool(pool: ProcessPoolExecutor):
+    """Drop a pool that failed (e.g. a worker died) so the next parse starts a new one"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _response_bytes(xml_string: XMLInput):
+    """
+    The response as a bytes-like object; text loses its XML declaration and is
+    encoded as UTF-8. Bytes-like input is used in place, not copied.
+    """
+    if isinstance(xml_string, str):
+        if xml_string.startswith('<?xml'):
+            xml_string = xml_string[xml_string.find('?>') + 2:]
+        return xml_string.encode('utf-8')
+    if isinstance(xml_string, memoryview):
+        return xml_string.cast('B')
+    return xml_string
+
+
+def _split_response(xml_string: XMLInput):
+    """
+    Cut the first response's *Ret elements into pieces for parallel parsing.
+
+    Returns (response tag, XML declaration, skeleton, data, bounds): the
+    pieces are data[bounds[i]:bounds[i + 1]] and skeleton is the envelope
+    with the *Ret elements removed. None if the response isn't one
+    PARALLEL_PARSERS handles (or can't be found in the bytes, as in a UTF-16
+    document).
+    """
+    data = _response_bytes(xml_string)
+    match = _RESPONSE_START.search(data)
+    if match is None:
+        return None
+    response_tag = match.group(1).decode('ascii')
+    if response_tag not in PARALLEL_PARSERS or RESPONSE_PARSERS.get(response_tag) is not PARALLEL_PARSERS[response_tag]:
+        # Not splittable, or a parser registered at runtime that workers may not have
+        return None
+
+    ret_start = _RET_START_TAGS[response_tag]
+    first = ret_start.search(data, match.end())
+    if first is None:
+        return None
+    start = first.start()
+    response_end = re.compile(re.escape(f'</{response_tag}>'.encode('ascii'))).search(data, start)
+    if response_end is None:
+        return None
+    end = response_end.start()
+
+    count = _parallel_workers() * PARALLEL_PIECES_PER_WORKER
+    step = max((end - start) // count, PARALLEL_MIN_PIECE_BYTES)
+    bounds = [start]
+    while True:
+        cut = ret_start.search(data, bounds[-1] + step, end)
+        if cut is None:
+            break
+        bounds.append(cut.start())
+    bounds.append(end)
+
+    declaration = bytes(data[:match.start()])
+    declaration = declaration[:declaration.find(b'?>') + 2] if declaration.startswith(b'<?xml') else b''
+    skeleton = bytes(data[:start]) + bytes(data[end:])
+    return response_tag, declaration, skeleton, data, bounds
+
+
+def _parse_piece(response_tag: str, declaration: bytes, piece: bytes) -> List[Dict]:
+    """Records of one piece of *Ret elements (runs in a worker process)"""
+    document = b''.join((declaration, f'<{response_tag}>'.encode('ascii'), piece,
+                         f'</{response_tag}>'.encode('ascii')))
+    try:
+        response_elem = parse_xml(document)
+    except etree.XMLSyntaxError as e:
+        # lxml's exception doesn't pickle back to the parent process
+        raise ValueError(f"Malformed {response_tag} piece: {e}") from None
+    return PARALLEL_PARSERS[response_tag](response_elem)
+
+
+def _parallel_records(response_tag: str, declaration: bytes, skeleton: bytes, data: bytes, bounds: List[int]):
+    """
+    Yield the records of every piece in order, with a bounded number of
+    pieces (copied out of data) in flight. Raises whatever the first failing
+    piece raised.
+    """
+    pool = _process_pool()
+    pieces = deque(zip(bounds, bounds[1:]))
+    in_flight = deque()
+    try:
+        while pieces or in_flight:
+            while pieces and len(in_flight) < 2 * _parallel_workers():
+                start, end = pieces.popleft()
+                in_flight.append(pool.submit(_parse_piece, response_tag, declaration, bytes(data[start:end])))
+            yield from in_flight.popleft().result()
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+def _parse_parallel(xml_string: XMLInput) -> Optional[Dict[str, Any]]:
+    """
+    parse_qbxml_response() across worker processes, or None to parse in this
+    one (response not splittable, or a piece failed to parse).
+    """
+    split = _split_response(xml_string)
+    if split is None:
+        return None
+    response_tag, _, skeleton, _, bounds = split
+    try:
+        msgs_rs = _messages_element(skeleton)
+        response_elem = None if msgs_rs is None else next(_response_elements(msgs_rs), None)
+        if response_elem is None or response_elem.tag != response_tag:
+            return None
+        result = parse_response_element(response_elem)
+        result['data'] = list(_parallel_records(*split))
+    except Exception as e:
+        logger.warning(f"Parallel parse of {response_tag} failed, parsing in one process: {e}")
+        return None
+    logger.debug(f"Parsed {len(result['data'])} records from {response_tag} in {len(bounds) - 1} pieces")
+    return result
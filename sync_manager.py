@@ -4,15 +4,19 @@ Sync Manager - Orchestrates bi-directional sync between QuickBooks and Bitrix24
 This module determines what needs to be synced and coordinates the data flow.
 """
 
+import hashlib
 import json
 import logging
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterable, Optional
+
+from lxml import etree
 
 from database import (
     init_db, get_last_sync_time, update_last_sync_time,
-    get_bitrix_id, get_qb_list_id, save_id_mapping,
-    get_pending_qb_queue, mark_queue_item_processed, log_sync
+    get_bitrix_id, get_qb_list_id, get_id_mapping, save_id_mapping,
+    claim_pending_qb_queue, mark_queue_item_processed, log_sync,
+    archive_queue, unit_of_work, run_maintenance, DEAD_QUEUE_STATUS
 )
 from qbxml_builder import (
     customer_query_all, customer_query_modified_since, customer_add,
@@ -22,7 +26,7 @@ from qbxml_builder import (
     estimate_query_all, estimate_query_modified_since,
     host_query, company_query
 )
-from qbxml_parser import parse_qbxml_response
+from qbxml_parser import ParseCache, QBXMLStream, response_digest
 from bitrix24_client import (
     Bitrix24Client,
     qb_customer_to_bitrix_contact, qb_customer_to_bitrix_company,
@@ -30,10 +34,46 @@ from bitrix24_client import (
     qb_item_to_bitrix_product,
     qb_invoice_to_bitrix_deal
 )
-from config import BITRIX24_WEBHOOK
+from config import (
+    BITRIX24_WEBHOOK, SYNC_WATERMARK_OVERLAP_SECONDS, ARCHIVE_MAX_BATCHES,
+    SYNC_COMMIT_CHUNK_SIZE, MAINTENANCE_INTERVAL_HOURS, MAINTENANCE_WINDOW_HOURS,
+    PARSE_CACHE_MAX_BYTES
+)
 
 logger = logging.getLogger(__name__)
 
+# Item types pushed to Bitrix24 as products. The parser returns every item type
+# in an ItemQueryRs; subtotal and sales tax items are not products.
+PRODUCT_ITEM_TYPES = frozenset({
+    'ItemService', 'ItemInventory', 'ItemNonInventory',
+    'ItemOtherCharge', 'ItemDiscount', 'ItemGroup',
+})
+
+
+def payload_hash(bitrix_data: Dict) -> str:
+    """Stable hash of a mapped Bitrix24 payload, used to detect no-op updates"""
+    encoded = json.dumps(bitrix_data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def parse_qb_datetime(value: Optional[str]) -> Optional[datetime]:
+    """Parse a qbXML DATETIMETYPE (or a stored watermark) into a datetime"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def is_later(candidate: datetime, current: Optional[datetime]) -> bool:
+    """Compare watermarks; a legacy naive timestamp is always superseded by an aware one"""
+    if current is None:
+        return True
+    if (candidate.tzinfo is None) != (current.tzinfo is None):
+        return candidate.tzinfo is not None
+    return candidate > current
+
 
 class SyncManager:
     """Manages synchronization between QuickBooks and Bitrix24"""
@@ -57,6 +97,20 @@ class SyncManager:
             'estimates',
         ]
 
+        # Records skipped because their mapped payload was unchanged, per entity type
+        self.skipped_unchanged = {}
+
+        # Query responses skipped because they were byte-identical to the last
+        # one applied in full for the same request, per entity type
+        self.skipped_responses = {}
+        # Request type -> (request qbXML, response digest) of that last applied response
+        self.applied_responses = {}
+
+        self.parse_cache = ParseCache(PARSE_CACHE_MAX_BYTES)
+
+        # When run_housekeeping() last ran database maintenance
+        self.last_maintenance = None
+
     def get_pending_requests(self) -> List[Dict]:
         """
         Get all pending qbXML requests that need to be sent to QuickBooks.
@@ -75,11 +129,20 @@ class SyncManager:
             'action': 'query'
         })
 
-        # Check for pending Bitrix24 -> QB items first (from webhook queue)
-        pending_queue = get_pending_qb_queue()
+        # Check for pending Bitrix24 -> QB items first (from webhook queue).
+        # Claiming them keeps other connector nodes from sending the same items.
+        pending_queue = claim_pending_qb_queue()
         for item in pending_queue:
             qbxml = self._build_qbxml_for_queue_item(item)
-            if qbxml:
+            if not qbxml:
+                # Nothing can be sent for it, so retrying won't help; dead-letter it
+                # rather than leave the claim in 'processing' blocking its key
+                mark_queue_item_processed(
+                    item['id'],
+                    status=DEAD_QUEUE_STATUS,
+                    error_message=f"Unsupported queue item: {item['entity_type']}/{item['action']}"
+                )
+            else:
                 requests.append({
                     'type': f"{item['entity_type']}_{item['action']}",
                     'qbxml': qbxml,
@@ -95,7 +158,7 @@ class SyncManager:
 
             if last_sync:
                 # Incremental sync - only get modified records
-                qbxml = self._get_modified_query(entity, last_sync)
+                qbxml = self._get_modified_query(entity, self._query_from_date(last_sync))
             else:
                 # Full sync - get all records
                 qbxml = self._get_full_query(entity)
@@ -112,6 +175,49 @@ class SyncManager:
         logger.info(f"Built {len(requests)} requests for Web Connector")
         return requests
 
+    def _query_from_date(self, watermark: str) -> str:
+        """Start an incremental query a short overlap before the stored watermark"""
+        parsed = parse_qb_datetime(watermark)
+        if parsed is None:
+            return watermark
+        from_date = parsed - timedelta(seconds=SYNC_WATERMARK_OVERLAP_SECONDS)
+        return from_date.isoformat(timespec='seconds')
+
+    def run_housekeeping(self):
+        """
+        Periodic database upkeep, run after a Web Connector session closes.
+
+        Moves finished queue rows to the archive in bounded batches, then
+        runs database maintenance if it is due.
+        """
+        try:
+            archived = archive_queue(max_batches=ARCHIVE_MAX_BATCHES)
+            if archived:
+                logger.info(f"Archived {archived} finished queue rows")
+        except Exception as e:
+            logger.error(f"Queue archiving failed: {e}")
+
+        if self._maintenance_due(datetime.now()):
+            self.last_maintenance = datetime.now()
+            try:
+                report = run_maintenance()
+                logger.info(f"Database maintenance reclaimed {report['reclaimed_bytes']} bytes "
+                            f"in {report['seconds']}s ({', '.join(report['steps'])})")
+            except Exception as e:
+                logger.error(f"Database maintenance failed: {e}")
+
+    def _maintenance_due(self, now: datetime) -> bool:
+        """Maintenance runs once per interval, inside the low-traffic window"""
+        start_hour, end_hour = MAINTENANCE_WINDOW_HOURS
+        window_hours = (end_hour - start_hour) % 24
+        if not (now.hour - start_hour) % 24 < window_hours:
+            return False
+        if self.last_maintenance is None:
+            return True
+        # Allow for the previous run having happened later in its window
+        min_gap = timedelta(hours=max(MAINTENANCE_INTERVAL_HOURS - window_hours, 0))
+        return now - self.last_maintenance >= min_gap
+
     def _get_full_query(self, entity: str) -> Optional[str]:
         """Get qbXML for full query of an entity type"""
         query_map = {
@@ -168,18 +274,43 @@ class SyncManager:
         """
         Process a qbXML response from QuickBooks.
 
+        All mapping, log, queue and watermark writes for the response are
+        committed together (in chunks of SYNC_COMMIT_CHUNK_SIZE records)
+        instead of one transaction per write.
+
         Args:
             request_item: The original request item with metadata
             response_xml: The qbXML response string
         """
+        digest = response_digest(response_xml)
+        with unit_of_work():
+            applied = self._process_response(request_item, response_xml, digest)
+        if applied:
+            # Only once committed, so a failed commit doesn't make the retry look unchanged
+            self.applied_responses[request_item.get('type', '')] = (request_item.get('qbxml'), digest)
+
+    def _process_response(self, request_item: Dict, response_xml: str, digest: str) -> bool:
+        """
+        Parse a qbXML response and apply it; see process_response().
+
+        Returns True if it was a query response synced in full.
+        """
         request_type = request_item.get('type', '')
         action = request_item.get('action', '')
         entity_type = request_item.get('entity_type', '')
 
         logger.info(f"Processing response for {request_type}")
 
-        # Parse the response
-        parsed = parse_qbxml_response(response_xml)
+        if action == 'query' and 'queue_id' not in request_item and 'host_query' not in request_type:
+            if self.applied_responses.get(request_type) == (request_item.get('qbxml'), digest):
+                # Same request, same bytes: every record in it is already synced
+                logger.info(f"{request_type} response unchanged since it was last applied, skipping")
+                self.skipped_responses[entity_type] = self.skipped_responses.get(entity_type, 0) + 1
+                return False
+            return self._process_query_response(entity_type, response_xml)
+
+        # Parse the response (a byte-identical repeat, e.g. the host query, comes from the cache)
+        parsed = self.parse_cache.parse(response_xml, digest)
 
         if not parsed['success']:
             logger.error(f"QB Response error: {parsed['status_message']}")
@@ -191,7 +322,7 @@ class SyncManager:
                     status='failed',
                     error_message=parsed['status_message']
                 )
-            return
+            return False
 
         data = parsed['data']
 
@@ -199,17 +330,85 @@ class SyncManager:
         if 'host_query' in request_type:
             if data:
                 logger.info(f"Connected to QuickBooks: {data[0].get('ProductName', 'Unknown')}")
-            return
+            return False
 
         # Handle queue items (Bitrix24 -> QB)
         if 'queue_id' in request_item:
             self._handle_queue_response(request_item, data)
+        return False
+
+    def _process_query_response(self, entity_type: str, response_xml: str) -> bool:
+        """
+        Stream a QB -> Bitrix24 query response into Bitrix24.
+
+        Records are parsed and synced one at a time, so a large response is
+        never held as a whole tree plus a list of records. If the XML turns out
+        to be malformed partway, the records synced so far stay synced but the
+        watermark is not moved, so the next query fetches the rest again. If
+        records fail, the watermark stops short of the earliest failure.
+
+        Returns True if every record was synced without error.
+        """
+        stream = QBXMLStream(response_xml)
+        modified_times = []
+        failed_records = []
+
+        def records():
+            for record in stream:
+                modified_times.append(record.get('TimeModified'))
+                yield record
+
+        try:
+            if not stream.success:
+                logger.error(f"QB Response error: {stream.status_message}")
+                return False
+            synced = self._sync_to_bitrix24(entity_type, records(), failed_records)
+        except etree.XMLSyntaxError as e:
+            logger.error(f"Malformed {entity_type} response, watermark not moved: {e}")
+            return False
+
+        if modified_times:
+            failed_times = [record.get('TimeModified') for record in failed_records]
+            self._advance_watermark(entity_type, modified_times, failed_times)
+        return synced
+
+    def _advance_watermark(self, entity_type: str, modified_times: Iterable[Optional[str]],
+                           failed_times: Iterable[Optional[str]] = ()):
+        """
+        Record the newest QB TimeModified in a processed response as the watermark.
+
+        Using QB's own timestamps (rather than this host's clock) keeps the next
+        incremental query aligned with what QB actually returned. Only times
+        before the earliest failed record count, so the next query fetches
+        the failed records again.
+        """
+        earliest_failure = None
+        for raw in failed_times:
+            failed = parse_qb_datetime(raw)
+            if failed is None:
+                logger.warning(f"Failed {entity_type} record has no TimeModified, watermark not moved")
+                return
+            if earliest_failure is None or is_later(earliest_failure, failed):
+                earliest_failure = failed
+
+        newest = None
+        newest_raw = None
+        for raw in modified_times:
+            modified = parse_qb_datetime(raw)
+            if modified is None:
+                continue
+            if earliest_failure is not None and not is_later(earliest_failure, modified):
+                continue
+            if is_later(modified, newest):
+                newest, newest_raw = modified, raw
+
+        if newest is None:
+            logger.warning(f"No usable TimeModified in {entity_type} response, watermark not moved")
             return
 
-        # Handle query responses (QB -> Bitrix24)
-        if action == 'query' and data:
-            self._sync_to_bitrix24(entity_type, data)
-            update_last_sync_time(entity_type, 'qb_to_bitrix')
+        current = parse_qb_datetime(get_last_sync_time(entity_type, 'qb_to_bitrix'))
+        if is_later(newest, current):
+            update_last_sync_time(entity_type, 'qb_to_bitrix', newest_raw)
 
     def _handle_queue_response(self, request_item: Dict, data: List[Dict]):
         """Handle response for a queued Bitrix24 -> QB item"""
@@ -229,43 +428,85 @@ class SyncManager:
         else:
             mark_queue_item_processed(queue_id, status='failed', error_message='No data returned')
 
-    def _sync_to_bitrix24(self, entity_type: str, data: List[Dict]):
-        """Sync QuickBooks data to Bitrix24"""
+    def _sync_to_bitrix24(self, entity_type: str, data: Iterable[Dict],
+                          failed_records: Optional[List[Dict]] = None) -> bool:
+        """
+        Sync QuickBooks data (a list or a stream of records) to Bitrix24.
+
+        Records that fail are appended to failed_records if given.
+        Returns True if every record synced without error.
+        """
         if not self.bitrix_client:
             logger.warning("Bitrix24 client not configured, skipping sync to Bitrix24")
-            return
-
-        logger.info(f"Syncing {len(data)} {entity_type} records to Bitrix24")
-
-        for record in data:
-            try:
-                self._sync_single_record_to_bitrix24(entity_type, record)
-            except Exception as e:
-                logger.error(f"Error syncing {entity_type} to Bitrix24: {e}")
-                qb_id = record.get('ListID') or record.get('TxnID')
-                log_sync('qb_to_bitrix', entity_type, qb_id, None, 'sync', 'error', str(e))
-
-    def _sync_single_record_to_bitrix24(self, entity_type: str, record: Dict):
-        """Sync a single record to Bitrix24"""
+            return False
+
+        logger.info(f"Syncing {entity_type} records to Bitrix24")
+        skipped_before = self.skipped_unchanged.get(entity_type, 0)
+        if entity_type == 'items':
+            data = (record for record in data if record.get('ItemType') in PRODUCT_ITEM_TYPES)
+
+        index = 0
+        failed = 0
+        with unit_of_work() as uow:
+            for index, record in enumerate(data, 1):
+                try:
+                    ok = self._sync_single_record_to_bitrix24(entity_type, record)
+                except Exception as e:
+                    ok = False
+                    logger.error(f"Error syncing {entity_type} to Bitrix24: {e}")
+                    qb_id = record.get('ListID') or record.get('TxnID')
+                    log_sync('qb_to_bitrix', entity_type, qb_id, None, 'sync', 'error', str(e))
+                if not ok:
+                    failed += 1
+                    if failed_records is not None:
+                        failed_records.append(record)
+
+                # Bound what a crash mid-response can lose to one chunk
+                if index % SYNC_COMMIT_CHUNK_SIZE == 0:
+                    uow.flush()
+
+        logger.info(f"Synced {index} {entity_type} records to Bitrix24")
+        skipped = self.skipped_unchanged.get(entity_type, 0) - skipped_before
+        if skipped:
+            logger.info(f"Skipped {skipped} unchanged {entity_type} records")
+        return failed == 0
+
+    def _sync_single_record_to_bitrix24(self, entity_type: str, record: Dict) -> bool:
+        """Sync a single record to Bitrix24; returns False if Bitrix24 rejected it"""
         qb_id = record.get('ListID') or record.get('TxnID')
-        existing_bitrix_id = get_bitrix_id(entity_type, qb_id)
+        mapping = get_id_mapping(entity_type, qb_id) or {}
+        existing_bitrix_id = mapping.get('bitrix_id')
+        existing_hash = mapping.get('content_hash')
 
         if entity_type == 'customers':
-            self._sync_customer_to_bitrix24(record, existing_bitrix_id)
+            return self._sync_customer_to_bitrix24(record, existing_bitrix_id, existing_hash)
         elif entity_type == 'items':
-            self._sync_item_to_bitrix24(record, existing_bitrix_id)
+            return self._sync_item_to_bitrix24(record, existing_bitrix_id, existing_hash)
         elif entity_type == 'invoices':
-            self._sync_invoice_to_bitrix24(record, existing_bitrix_id)
+            return self._sync_invoice_to_bitrix24(record, existing_bitrix_id, existing_hash)
         # Add more entity types as needed
-
-    def _sync_customer_to_bitrix24(self, qb_customer: Dict, existing_bitrix_id: str = None):
-        """Sync a QuickBooks customer to Bitrix24"""
+        return True
+
+    def _is_unchanged(self, entity_type: str, existing_bitrix_id: Optional[str],
+                      existing_hash: Optional[str], content_hash: str) -> bool:
+        """Check whether a mapped record would be pushed with the same payload as last time"""
+        if not existing_bitrix_id or existing_hash != content_hash:
+            return False
+        self.skipped_unchanged[entity_type] = self.skipped_unchanged.get(entity_type, 0) + 1
+        return True
+
+    def _sync_customer_to_bitrix24(self, qb_customer: Dict, existing_bitrix_id: str = None,
+                                   existing_hash: str = None) -> bool:
+        """Sync a QuickBooks customer to Bitrix24; returns True if synced or unchanged"""
         qb_list_id = qb_customer.get('ListID')
 
         # Determine if this is a company or individual contact
         if qb_customer.get('CompanyName'):
             # Sync as company
             bitrix_data = qb_customer_to_bitrix_company(qb_customer)
+            content_hash = payload_hash(bitrix_data)
+            if self._is_unchanged('customers', existing_bitrix_id, existing_hash, content_hash):
+                return True
 
             if existing_bitrix_id:
                 result = self.bitrix_client.update_company(int(existing_bitrix_id), bitrix_data)
@@ -275,17 +516,22 @@ class SyncManager:
                 action = 'add'
 
             if result.get('success'):
-                bitrix_id = str(result.get('result', existing_bitrix_id))
-                if bitrix_id and not existing_bitrix_id:
-                    save_id_mapping('customers', qb_list_id, bitrix_id)
+                bitrix_id = existing_bitrix_id or str(result.get('result'))
+                save_id_mapping('customers', qb_list_id, bitrix_id, content_hash,
+                                created=not existing_bitrix_id)
                 log_sync('qb_to_bitrix', 'customers', qb_list_id, bitrix_id, action, 'success')
                 logger.info(f"Synced customer {qb_customer.get('Name')} to Bitrix24 company {bitrix_id}")
+                return True
             else:
                 log_sync('qb_to_bitrix', 'customers', qb_list_id, existing_bitrix_id, action, 'error',
                         result.get('error'))
+                return False
         else:
             # Sync as contact
             bitrix_data = qb_customer_to_bitrix_contact(qb_customer)
+            content_hash = payload_hash(bitrix_data)
+            if self._is_unchanged('customers', existing_bitrix_id, existing_hash, content_hash):
+                return True
 
             if existing_bitrix_id:
                 result = self.bitrix_client.update_contact(int(existing_bitrix_id), bitrix_data)
@@ -295,19 +541,25 @@ class SyncManager:
                 action = 'add'
 
             if result.get('success'):
-                bitrix_id = str(result.get('result', existing_bitrix_id))
-                if bitrix_id and not existing_bitrix_id:
-                    save_id_mapping('customers', qb_list_id, bitrix_id)
+                bitrix_id = existing_bitrix_id or str(result.get('result'))
+                save_id_mapping('customers', qb_list_id, bitrix_id, content_hash,
+                                created=not existing_bitrix_id)
                 log_sync('qb_to_bitrix', 'customers', qb_list_id, bitrix_id, action, 'success')
                 logger.info(f"Synced customer {qb_customer.get('Name')} to Bitrix24 contact {bitrix_id}")
+                return True
             else:
                 log_sync('qb_to_bitrix', 'customers', qb_list_id, existing_bitrix_id, action, 'error',
                         result.get('error'))
+                return False
 
-    def _sync_item_to_bitrix24(self, qb_item: Dict, existing_bitrix_id: str = None):
-        """Sync a QuickBooks item to Bitrix24 product"""
+    def _sync_item_to_bitrix24(self, qb_item: Dict, existing_bitrix_id: str = None,
+                               existing_hash: str = None) -> bool:
+        """Sync a QuickBooks item to Bitrix24 product; returns True if synced or unchanged"""
         qb_list_id = qb_item.get('ListID')
         bitrix_data = qb_item_to_bitrix_product(qb_item)
+        content_hash = payload_hash(bitrix_data)
+        if self._is_unchanged('items', existing_bitrix_id, existing_hash, content_hash):
+            return True
 
         if existing_bitrix_id:
             result = self.bitrix_client.update_product(int(existing_bitrix_id), bitrix_data)
@@ -317,17 +569,19 @@ class SyncManager:
             action = 'add'
 
         if result.get('success'):
-            bitrix_id = str(result.get('result', existing_bitrix_id))
-            if bitrix_id and not existing_bitrix_id:
-                save_id_mapping('items', qb_list_id, bitrix_id)
+            bitrix_id = existing_bitrix_id or str(result.get('result'))
+            save_id_mapping('items', qb_list_id, bitrix_id, content_hash, created=not existing_bitrix_id)
             log_sync('qb_to_bitrix', 'items', qb_list_id, bitrix_id, action, 'success')
             logger.info(f"Synced item {qb_item.get('Name')} to Bitrix24 product {bitrix_id}")
+            return True
         else:
             log_sync('qb_to_bitrix', 'items', qb_list_id, existing_bitrix_id, action, 'error',
                     result.get('error'))
+            return False
 
-    def _sync_invoice_to_bitrix24(self, qb_invoice: Dict, existing_bitrix_id: str = None):
-        """Sync a QuickBooks invoice to Bitrix24 deal"""
+    def _sync_invoice_to_bitrix24(self, qb_invoice: Dict, existing_bitrix_id: str = None,
+                                  existing_hash: str = None) -> bool:
+        """Sync a QuickBooks invoice to Bitrix24 deal; returns True if synced or unchanged"""
         qb_txn_id = qb_invoice.get('TxnID')
         bitrix_data = qb_invoice_to_bitrix_deal(qb_invoice)
 
@@ -338,6 +592,10 @@ class SyncManager:
             if customer_bitrix_id:
                 bitrix_data['COMPANY_ID'] = customer_bitrix_id
 
+        content_hash = payload_hash(bitrix_data)
+        if self._is_unchanged('invoices', existing_bitrix_id, existing_hash, content_hash):
+            return True
+
         if existing_bitrix_id:
             result = self.bitrix_client.update_deal(int(existing_bitrix_id), bitrix_data)
             action = 'update'
@@ -346,11 +604,12 @@ class SyncManager:
             action = 'add'
 
         if result.get('success'):
-            bitrix_id = str(result.get('result', existing_bitrix_id))
-            if bitrix_id and not existing_bitrix_id:
-                save_id_mapping('invoices', qb_txn_id, bitrix_id)
+            bitrix_id = existing_bitrix_id or str(result.get('result'))
+            save_id_mapping('invoices', qb_txn_id, bitrix_id, content_hash, created=not existing_bitrix_id)
             log_sync('qb_to_bitrix', 'invoices', qb_txn_id, bitrix_id, action, 'success')
             logger.info(f"Synced invoice {qb_invoice.get('RefNumber')} to Bitrix24 deal {bitrix_id}")
+            return True
         else:
             log_sync('qb_to_bitrix', 'invoices', qb_txn_id, existing_bitrix_id, action, 'error',
                     result.get('error'))
+            return False
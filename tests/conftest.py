@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+@pytest.fixture
+def storage(tmp_path):
+    """A fresh SQLiteStorage on a temp file, installed as the process-wide backend"""
+    storage = database.SQLiteStorage(str(tmp_path / 'sync.db'))
+    storage.init_schema()
+    previous = database._storage
+    database.set_storage(storage)
+    yield storage
+    database.set_storage(previous)
+
+
+class FakeBitrix24Client:
+    """Records Bitrix24 calls; answers with the given result (or one per call from a list)"""
+
+    def __init__(self, result=None):
+        self.result = result if result is not None else {'success': True, 'result': 1}
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args):
+            self.calls.append((name, args))
+            if isinstance(self.result, list):
+                return self.result[len(self.calls) - 1]
+            return self.result
+        return call
+
+
+@pytest.fixture
+def manager(storage):
+    """A SyncManager on the temp storage with a fake Bitrix24 client"""
+    from sync_manager import SyncManager
+    manager = SyncManager()
+    manager.bitrix_client = FakeBitrix24Client()
+    return manager
@@ -0,0 +1,127 @@
+import re
+from decimal import Decimal
+from urllib.parse import parse_qs
+
+import pytest
+import requests
+
+import bitrix24_client
+from bitrix24_client import (
+    BATCH_MAX_COMMANDS, LIST_PAGE_SIZE, Bitrix24Client,
+    qb_invoice_to_bitrix_deal, qb_item_to_bitrix_product,
+)
+from qbxml_parser import InvoiceRecord, decode
+
+INVOICE = {'TxnID': '1-1', 'RefNumber': '42', 'Subtotal': '10.50', 'IsPaid': 'false',
+           'BalanceRemaining': '3.00', 'Memo': None}
+
+
+def test_decode_accepts_records_and_plain_dicts():
+    record = InvoiceRecord.from_dict(INVOICE)
+
+    for mapping in (record, INVOICE):
+        assert decode(mapping, 'Subtotal') == Decimal('10.50')
+        assert decode(mapping, 'IsPaid') is False
+        assert decode(mapping, 'RefNumber') == '42'
+        assert decode(mapping, 'Memo', '') == ''
+
+
+def test_decode_passes_through_values_that_are_not_strings():
+    assert decode({'Price': 2.5}, 'Price') == 2.5
+    assert decode({'Price': 'n/a'}, 'Price', Decimal(0)) == Decimal(0)
+
+
+def test_mapping_functions_take_plain_dicts():
+    deal = qb_invoice_to_bitrix_deal(INVOICE)
+    assert deal['OPPORTUNITY'] == 10.5
+    assert deal['STAGE_ID'] == 'EXECUTING'
+    assert qb_invoice_to_bitrix_deal(dict(INVOICE, IsPaid='true'))['STAGE_ID'] == 'WON'
+
+    assert qb_item_to_bitrix_product({'ListID': '9', 'Name': 'Widget', 'Price': '1.25'})['PRICE'] == 1.25
+
+
+def test_mapping_functions_match_for_records_and_dicts():
+    assert qb_invoice_to_bitrix_deal(InvoiceRecord.from_dict(INVOICE)) == qb_invoice_to_bitrix_deal(INVOICE)
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+
+    def json(self):
+        return self._body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} error")
+
+
+class FakeBitrix24:
+    """Serves crm.contact.list pages through 'batch', resolving $result references like Bitrix24"""
+
+    def __init__(self, record_count, throttle_calls=()):
+        self.records = [{'ID': str(i), 'ORIGIN_ID': f'QB_{i}'} for i in range(1, record_count + 1)]
+        self.throttle_calls = set(throttle_calls)
+        self.calls = 0
+
+    def post(self, url, json=None, timeout=None):
+        self.calls += 1
+        if self.calls in self.throttle_calls:
+            return FakeResponse(503, {'error': 'QUERY_LIMIT_EXCEEDED', 'error_description': 'Too many requests'})
+        assert url.endswith('/batch')
+        results = {}
+        for key, command in json['cmd'].items():
+            method, _, query = command.partition('?')
+            assert method == 'crm.contact.list'
+            query = re.sub(r'\$result\[(\w+)\]\[(\d+)\]\[(\w+)\]', lambda m: self._ref(results, *m.groups()), query)
+            after = int(parse_qs(query).get('filter[>ID]', ['0'])[0] or 0)
+            results[key] = [r for r in self.records if int(r['ID']) > after][:LIST_PAGE_SIZE]
+        return FakeResponse(200, {'result': {'result': results, 'result_error': []}})
+
+    @staticmethod
+    def _ref(results, key, index, field):
+        page = results.get(key) or []
+        return page[int(index)][field] if int(index) < len(page) else ''
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    delays = []
+    monkeypatch.setattr(bitrix24_client.time, 'sleep', delays.append)
+    return delays
+
+
+@pytest.mark.parametrize('record_count', [0, 49, 50, 2600])
+def test_iter_list_batches_pages_chained_on_the_last_id(monkeypatch, no_sleep, record_count):
+    server = FakeBitrix24(record_count)
+    monkeypatch.setattr(bitrix24_client.requests, 'post', server.post)
+    client = Bitrix24Client('https://example.test/rest/1/abc/')
+
+    records = list(client.iter_list('crm.contact.list', select=['ORIGIN_ID']))
+
+    assert records == server.records
+    # 50 pages of 50 per request
+    assert server.calls == record_count // (LIST_PAGE_SIZE * BATCH_MAX_COMMANDS) + 1
+
+
+def test_iter_list_retries_a_throttled_page(monkeypatch, no_sleep):
+    server = FakeBitrix24(2600, throttle_calls={2})
+    monkeypatch.setattr(bitrix24_client.requests, 'post', server.post)
+    client = Bitrix24Client('https://example.test/rest/1/abc/')
+
+    records = list(client.iter_list('crm.contact.list'))
+
+    assert records == server.records
+    assert server.calls == 3
+    assert no_sleep == [1.0]
+
+
+def test_iter_list_gives_up_after_max_retries(monkeypatch, no_sleep):
+    server = FakeBitrix24(10, throttle_calls=range(1, 100))
+    monkeypatch.setattr(bitrix24_client.requests, 'post', server.post)
+    client = Bitrix24Client('https://example.test/rest/1/abc/')
+
+    with pytest.raises(RuntimeError, match='QUERY_LIMIT_EXCEEDED'):
+        list(client.iter_list('crm.contact.list'))
+    assert server.calls == bitrix24_client.BITRIX24_MAX_RETRIES + 1
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+from db_writer import SingleWriterStorage
+
+
+def _finished_rows(storage, count):
+    processed_at = (datetime.now() - timedelta(days=60)).isoformat()
+    with storage.transaction() as cursor:
+        cursor.executemany(
+            "INSERT INTO bitrix_to_qb_queue (entity_type, bitrix_id, action, status, processed_at) "
+            "VALUES ('customer', ?, 'create', 'completed', ?)",
+            [(str(i), processed_at) for i in range(count)])
+
+
+def _count_commits(storage):
+    commits = []
+    begin = storage._begin
+
+    def counting_begin(cursor):
+        commits.append(1)
+        begin(cursor)
+
+    storage._begin = counting_begin
+    return commits
+
+
+def test_archive_queue_commits_each_batch_through_writer(storage):
+    _finished_rows(storage, 2500)
+    commits = _count_commits(storage)
+    writer = SingleWriterStorage(storage)
+    try:
+        moved = writer.archive_queue(datetime.now() - timedelta(days=30), batch_size=500)
+    finally:
+        writer.close()
+
+    assert moved == 2500
+    # A copy and a delete per full batch, plus the empty copy that ends the loop,
+    # as with the bare storage
+    assert len(commits) == 11
+    assert storage.get_pending_qb_queue() == []
+
+
+def test_archive_queue_direct_matches_writer(storage):
+    _finished_rows(storage, 2500)
+    commits = _count_commits(storage)
+
+    assert storage.archive_queue(datetime.now() - timedelta(days=30), batch_size=500) == 2500
+    assert len(commits) == 11
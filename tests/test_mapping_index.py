@@ -0,0 +1,100 @@
+import hashlib
+
+import pytest
+
+import database
+import mapping_index
+from mapping_index import BloomFilter, CompactMappingTable, MappingIndex
+
+HASH = hashlib.sha256(b'payload').hexdigest()
+
+
+def _rows(count):
+    return [(f"{0x80000000 + i * 2:X}-1262304000", str(1000 + i), HASH if i % 2 else None)
+            for i in range(count)]
+
+
+@pytest.mark.parametrize('order', [list, reversed])
+def test_lookup_finds_every_key_by_binary_search(order):
+    rows = _rows(500)
+    table = CompactMappingTable(order(rows))
+
+    assert len(table) == 500
+    for qb_list_id, bitrix_id, content_hash in rows:
+        assert table.get(qb_list_id) == (bitrix_id, content_hash)
+    # Keys between stored ones miss
+    assert table.get(f"{0x80000001:X}-1262304000") is None
+    assert list(table.items()) == rows
+
+
+def test_values_that_dont_pack_are_kept_as_given():
+    table = CompactMappingTable([('A', 'abc', 'not-a-sha256'), ('B', '007', None), ('C', '7', HASH)])
+
+    assert table.get('A') == ('abc', 'not-a-sha256')
+    assert table.get('B') == ('007', None)
+    assert table.get('C') == ('7', HASH)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000)
+    keys = [f"key-{i}".encode() for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+
+    assert all(key in bloom for key in keys)
+    misses = sum(f"other-{i}".encode() in bloom for i in range(10000))
+    assert misses < 300
+
+
+def test_bloom_negative_skips_the_search(monkeypatch):
+    table = CompactMappingTable(_rows(100))
+    absent = next(f"absent-{i}" for i in range(1000) if f"absent-{i}".encode() not in table.bloom)
+    monkeypatch.setattr(table, '_find', lambda key: pytest.fail("searched despite a Bloom negative"))
+
+    assert table.get(absent) is None
+
+
+def test_put_after_build(monkeypatch):
+    monkeypatch.setattr(mapping_index, 'MERGE_MIN', 4)
+    rows = _rows(10)
+    table = CompactMappingTable(rows)
+
+    table.put('NEW-1', '5')
+    table.put(rows[1][0], '99')
+    assert table.get('NEW-1') == ('5', None)
+    # A None content_hash keeps the stored hash
+    assert table.get(rows[1][0]) == ('99', HASH)
+
+    # Past MERGE_MIN the delta is folded into the packed arrays
+    for i in range(3):
+        table.put(f"NEW-{i + 2}", str(i))
+    assert table.delta == {}
+    assert len(table) == 14
+    assert table.get('NEW-1') == ('5', None)
+    assert table.get(rows[1][0]) == ('99', HASH)
+
+
+def test_none_key_is_a_miss_not_an_error():
+    table = CompactMappingTable([('A', '1', None), (None, '2', None)])
+
+    assert len(table) == 1
+    assert table.get(None) is None
+    table.put(None, '3')
+    assert table.get(None) is None
+    assert len(table.delta) == 0
+
+    index = MappingIndex(lambda entity_type: iter([('A', '1', None)]))
+    assert index.get('customers', None) is None
+    index.put('customers', None, '3')
+    assert index.get('customers', 'A') == {'bitrix_id': '1', 'content_hash': None}
+
+
+def test_storage_with_index_handles_records_without_an_id(tmp_path):
+    storage = database.SQLiteStorage(str(tmp_path / 'index.db'), mapping_index=True)
+    storage.init_schema()
+    storage.save_id_mapping('customers', 'A', '1')
+
+    assert storage.get_bitrix_id('customers', None) is None
+    storage.save_id_mapping('customers', None, '2')
+    assert storage.get_bitrix_id('customers', None) is None
+    assert storage.get_bitrix_id('customers', 'A') == '1'
@@ -0,0 +1,54 @@
+import json
+import zlib
+
+import database
+import payload_codec
+from payload_codec import MIN_COMPRESS_BYTES, decode_text, encode_text
+
+PAYLOAD = json.dumps({'name': 'Ann Example', 'company_name': 'Example Co', 'email': 'ann@example.com',
+                      'phone': '555-0100', 'address': {'addr1': '1 Main St', 'city': 'Springfield',
+                                                       'state': 'IL', 'postal_code': '62701'}})
+
+
+def test_long_values_round_trip_compressed_behind_the_magic_prefix():
+    encoded = encode_text(PAYLOAD)
+
+    assert isinstance(encoded, bytes)
+    assert encoded.startswith(payload_codec._MAGIC)
+    assert encoded[len(payload_codec._MAGIC)] == payload_codec._DICTIONARY_VERSION
+    assert len(encoded) < len(PAYLOAD)
+    assert decode_text(encoded) == PAYLOAD
+    assert decode_text(memoryview(encoded)) == PAYLOAD
+
+
+def test_short_and_missing_values_stay_plain():
+    short = 'x' * (MIN_COMPRESS_BYTES - 1)
+
+    assert encode_text(short) is short
+    assert encode_text(None) is None
+    assert decode_text(None) is None
+
+
+def test_legacy_plain_text_rows_decode_unchanged():
+    assert decode_text(PAYLOAD) == PAYLOAD
+    # TEXT read back as a BLOB (no magic prefix) is UTF-8 text
+    assert decode_text('Café'.encode('utf-8')) == 'Café'
+
+
+def test_version_byte_selects_the_preset_dictionary(monkeypatch):
+    dictionary = b'"name": "Ann Example", "company_name": "'
+    monkeypatch.setitem(payload_codec._DICTIONARIES, 9, dictionary)
+    compressor = zlib.compressobj(wbits=-15, zdict=dictionary)
+    blob = payload_codec._MAGIC + bytes([9]) + compressor.compress(PAYLOAD.encode()) + compressor.flush()
+
+    assert decode_text(blob) == PAYLOAD
+
+
+def test_queue_rows_are_plain_dicts_with_the_payload(storage):
+    database.add_to_qb_queue('customer', '7', 'add', PAYLOAD)
+
+    for item in (database.get_pending_qb_queue()[0], database.claim_pending_qb_queue('node-a')[0]):
+        assert type(item) is dict
+        assert item['data'] == PAYLOAD
+        assert json.loads(json.dumps(item))['data'] == PAYLOAD
+        assert set(item) == {'id', 'entity_type', 'bitrix_id', 'action', 'data'}
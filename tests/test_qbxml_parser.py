@@ -0,0 +1,90 @@
+import hashlib
+
+import pytest
+
+import qbxml_parser
+from benchmarks import _sample_customer_response, _sample_invoice_response, _sample_item_response
+from qbxml_parser import QBXMLStream, parse_qbxml_response, response_digest
+
+SAMPLES = {
+    'invoices': lambda: _sample_invoice_response(60),
+    'customers': lambda: _sample_customer_response(120),
+    'items': lambda: _sample_item_response(120),
+}
+
+
+def test_response_digest_hashes_text_as_utf8_chunk_by_chunk(monkeypatch):
+    monkeypatch.setattr(qbxml_parser, 'STREAM_CHUNK_SIZE', 7)
+    text = '<QBXML><Name>Café – Ünïcode €</Name></QBXML>' * 5
+    expected = hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+    assert response_digest(text) == expected
+    assert response_digest(text.encode('utf-8')) == expected
+    assert response_digest(memoryview(text.encode('utf-8'))) == expected
+
+
+@pytest.fixture
+def small_parallel_pieces(monkeypatch):
+    """Parse anything over 1 KiB across two workers, in pieces of a few records"""
+    monkeypatch.setattr(qbxml_parser, 'PARALLEL_PARSE_MIN_BYTES', 1024)
+    monkeypatch.setattr(qbxml_parser, 'PARALLEL_MIN_PIECE_BYTES', 2048)
+    monkeypatch.setattr(qbxml_parser, '_parallel_workers', lambda: 2)
+    pieces = []
+    parallel_records = qbxml_parser._parallel_records
+
+    def counting_parallel_records(*split):
+        pieces.append(len(split[-1]) - 1)
+        return parallel_records(*split)
+
+    monkeypatch.setattr(qbxml_parser, '_parallel_records', counting_parallel_records)
+    yield pieces
+    if qbxml_parser._pool is not None:
+        qbxml_parser._discard_pool(qbxml_parser._pool)
+
+
+def _single_process(response):
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(qbxml_parser, '_parallel_workers', lambda: 1)
+        return parse_qbxml_response(response), list(QBXMLStream(response))
+
+
+@pytest.mark.parametrize('entity', sorted(SAMPLES))
+def test_parallel_parse_matches_single_process(small_parallel_pieces, entity):
+    text = SAMPLES[entity]()
+    expected, expected_stream = _single_process(text)
+    assert expected['data'] == expected_stream
+
+    parsed = parse_qbxml_response(text)
+    stream = QBXMLStream(text.encode('utf-8'))
+    streamed = list(stream)
+
+    streamed_view = list(QBXMLStream(memoryview(text.encode('utf-8'))))
+
+    # Every path really went through the workers, in several pieces each
+    assert len(small_parallel_pieces) == 3 and min(small_parallel_pieces) > 2
+    assert parsed == expected
+    assert streamed == streamed_view == expected['data']
+    assert (stream.success, stream.status_code, stream.status_message) == (
+        expected['success'], expected['status_code'], expected['status_message'])
+
+
+def test_text_stream_is_not_split(small_parallel_pieces):
+    text = SAMPLES['customers']()
+
+    assert len(list(QBXMLStream(text))) == 120
+    assert small_parallel_pieces == []
+
+
+def test_schema_extractors_compile_on_first_use(monkeypatch):
+    monkeypatch.setattr(qbxml_parser, '_schema_extractors', {})
+    response_elem = qbxml_parser.parse_xml(_sample_customer_response(3).encode('utf-8'))[0][0]
+
+    records = qbxml_parser.parse_schema_records(response_elem)
+
+    assert list(qbxml_parser._schema_extractors) == [('Customer', None)]
+    assert [record['Name'] for record in records] == ['Customer 0', 'Customer 1', 'Customer 2']
+    assert records[0]['BillAddress']['City'] == 'Springfield'
+
+    subset = qbxml_parser.parse_schema_records(response_elem, {'Customer': ['ListID', 'BillAddress.City']})
+    assert subset[0] == {'ListID': records[0]['ListID'], 'BillAddress': {'City': 'Springfield'}}
+    assert len(qbxml_parser._schema_extractors) == 2
@@ -0,0 +1,183 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from database import QUEUE_MAX_ATTEMPTS
+
+
+def _row(storage, item_id):
+    with storage.transaction() as cursor:
+        cursor.execute('SELECT status, attempts, claimed_by, next_attempt_at '
+                       'FROM bitrix_to_qb_queue WHERE id = ?', (item_id,))
+        return cursor.fetchone()
+
+
+def test_claim_moves_items_to_processing_once(storage):
+    first = database.add_to_qb_queue('customer', '1', 'add', '{}')
+    second = database.add_to_qb_queue('customer', '2', 'add', '{}')
+
+    claimed = database.claim_pending_qb_queue('node-a')
+
+    assert [item['id'] for item in claimed] == [first, second]
+    assert _row(storage, first)[:3] == ('processing', 0, 'node-a')
+    # Another node sees nothing to claim
+    assert database.claim_pending_qb_queue('node-b') == []
+
+
+def test_claim_respects_limit(storage):
+    for bitrix_id in '123':
+        database.add_to_qb_queue('customer', bitrix_id, 'add', '{}')
+
+    assert len(database.claim_pending_qb_queue('node-a', limit=2)) == 2
+    assert len(database.claim_pending_qb_queue('node-b')) == 1
+
+
+def test_stale_claim_is_taken_over(storage):
+    item_id = database.add_to_qb_queue('customer', '1', 'add', '{}')
+    database.claim_pending_qb_queue('node-a')
+    with storage.transaction() as cursor:
+        cursor.execute('UPDATE bitrix_to_qb_queue SET claimed_at = ? WHERE id = ?',
+                       ((datetime.now() - timedelta(days=1)).isoformat(), item_id))
+
+    assert [item['id'] for item in database.claim_pending_qb_queue('node-b')] == [item_id]
+    assert _row(storage, item_id)[2] == 'node-b'
+
+
+def test_complete_finishes_claimed_item(storage):
+    item_id = database.add_to_qb_queue('customer', '1', 'add', '{}')
+    database.claim_pending_qb_queue('node-a')
+
+    database.mark_queue_item_processed(item_id)
+
+    assert _row(storage, item_id)[0] == 'completed'
+    assert database.claim_pending_qb_queue('node-a') == []
+    # A later change for the same key is a new row, not merged into the finished one
+    assert database.add_to_qb_queue('customer', '1', 'update', '{}') != item_id
+
+
+def test_fail_releases_claim_with_backoff(storage):
+    item_id = database.add_to_qb_queue('customer', '1', 'add', '{}')
+    database.claim_pending_qb_queue('node-a')
+
+    database.mark_queue_item_processed(item_id, status='failed', error_message='QB said no')
+
+    status, attempts, claimed_by, next_attempt_at = _row(storage, item_id)
+    assert (status, attempts, claimed_by) == ('pending', 1, None)
+    assert next_attempt_at > datetime.now().isoformat()
+    # Not retried before the backoff expires
+    assert database.claim_pending_qb_queue('node-a') == []
+
+
+def test_repeated_failures_dead_letter_the_item(storage):
+    item_id = database.add_to_qb_queue('customer', '1', 'add', '{}')
+
+    for _ in range(QUEUE_MAX_ATTEMPTS):
+        database.mark_queue_item_processed(item_id, status='failed', error_message='QB said no')
+
+    assert _row(storage, item_id)[:2] == ('dead', QUEUE_MAX_ATTEMPTS)
+    assert [row['id'] for row in database.get_dead_qb_queue()] == [item_id]
+
+    database.requeue_dead_queue_item(item_id)
+    assert [item['id'] for item in database.claim_pending_qb_queue('node-a')] == [item_id]
+
+
+def _finished(storage, count):
+    processed_at = (datetime.now() - timedelta(days=60)).isoformat()
+    with storage.transaction() as cursor:
+        cursor.executemany(
+            "INSERT INTO bitrix_to_qb_queue (entity_type, bitrix_id, action, status, processed_at) "
+            "VALUES ('customer', ?, 'create', 'completed', ?)",
+            [(str(i), processed_at) for i in range(count)])
+
+
+def _live_ids(storage):
+    with storage.transaction() as cursor:
+        cursor.execute('SELECT id FROM bitrix_to_qb_queue ORDER BY id')
+        return [row[0] for row in cursor.fetchall()]
+
+
+@pytest.fixture
+def archive_storage(tmp_path):
+    """SQLiteStorage with the archive in a separate attached file"""
+    storage = database.SQLiteStorage(str(tmp_path / 'sync.db'), archive_path=str(tmp_path / 'archive.db'))
+    storage.init_schema()
+    return storage
+
+
+def test_archive_to_attached_file(archive_storage):
+    _finished(archive_storage, 7)
+
+    assert archive_storage.archive_queue(datetime.now() - timedelta(days=30), batch_size=3) == 7
+    assert _live_ids(archive_storage) == []
+    assert len(archive_storage.query_queue_archive(limit=100)) == 7
+
+
+def test_delete_only_removes_rows_already_in_the_archive(archive_storage):
+    _finished(archive_storage, 4)
+    ids = _live_ids(archive_storage)
+
+    assert archive_storage.delete_archived_queue_rows(ids) == 0
+    assert _live_ids(archive_storage) == ids
+
+
+def test_archive_resumes_after_a_crash_between_copy_and_delete(archive_storage):
+    _finished(archive_storage, 4)
+    older_than = datetime.now() - timedelta(days=30)
+    # Copied and committed, then the process died before the delete
+    assert len(archive_storage.copy_queue_to_archive(older_than, 10)) == 4
+
+    assert archive_storage.archive_queue(older_than) == 4
+    assert _live_ids(archive_storage) == []
+    assert len(archive_storage.query_queue_archive(limit=100)) == 4
+
+
+@pytest.mark.parametrize('pending, new, merged', [
+    ('add', 'update', 'add'),
+    ('add', 'delete', None),
+    ('update', 'update', 'update'),
+    ('update', 'delete', 'delete'),
+])
+def test_coalesce_queue_actions(pending, new, merged):
+    assert database.coalesce_queue_actions(pending, new) == merged
+
+
+def _queue_rows(storage):
+    with storage.transaction() as cursor:
+        cursor.execute('SELECT id, action, status FROM bitrix_to_qb_queue ORDER BY id')
+        return cursor.fetchall()
+
+
+def test_add_then_update_stays_an_add_with_the_new_payload(storage):
+    item_id = database.add_to_qb_queue('customer', '1', 'add', '{"name": "Ann"}')
+
+    assert database.add_to_qb_queue('customer', '1', 'update', '{"name": "Anne"}') == item_id
+    assert _queue_rows(storage) == [(item_id, 'add', 'pending')]
+    assert database.claim_pending_qb_queue('node-a')[0]['data'] == '{"name": "Anne"}'
+
+
+def test_update_then_delete_becomes_a_delete(storage):
+    item_id = database.add_to_qb_queue('customer', '1', 'update', '{"name": "Ann"}')
+
+    assert database.add_to_qb_queue('customer', '1', 'delete', '{}') == item_id
+    assert _queue_rows(storage) == [(item_id, 'delete', 'pending')]
+
+
+def test_add_then_delete_cancels_out(manager, storage):
+    database.add_to_qb_queue('customer', '1', 'add', '{"name": "Ann"}')
+
+    assert database.add_to_qb_queue('customer', '1', 'delete', '{}') is None
+    assert _queue_rows(storage) == []
+    assert storage.get_status_counts()['pending_queue'] == 0
+    # Nothing is claimed or sent to QB for the key
+    assert [r for r in manager.get_pending_requests() if 'queue_id' in r] == []
+
+
+def test_changes_to_a_claimed_row_queue_separately(storage):
+    item_id = database.add_to_qb_queue('customer', '1', 'add', '{"name": "Ann"}')
+    database.claim_pending_qb_queue('node-a')
+
+    # The add may already be in QB, so the delete can't cancel it
+    delete_id = database.add_to_qb_queue('customer', '1', 'delete', '{}')
+    assert delete_id != item_id
+    assert _queue_rows(storage) == [(item_id, 'add', 'processing'), (delete_id, 'delete', 'pending')]
@@ -0,0 +1,156 @@
+import os
+import subprocess
+import sys
+
+import database
+
+QUERY = {'type': 'customers_query', 'action': 'query', 'entity_type': 'customers',
+         'qbxml': '<CustomerQueryRq/>'}
+
+
+def customer_response(*modified_times):
+    customers = ''.join(
+        f'<CustomerRet><ListID>8000000{i}-1</ListID><TimeModified>{modified}</TimeModified>'
+        f'<Name>C{i}</Name><FirstName>F{i}</FirstName><LastName>L</LastName></CustomerRet>'
+        for i, modified in enumerate(modified_times))
+    return ('<?xml version="1.0" ?><QBXML><QBXMLMsgsRs>'
+            '<CustomerQueryRs statusCode="0" statusSeverity="Info" statusMessage="OK">'
+            f'{customers}</CustomerQueryRs></QBXMLMsgsRs></QBXML>')
+
+
+def test_soft_bitrix_failure_is_not_applied(manager):
+    manager.bitrix_client.result = {'success': False, 'error': 'rejected'}
+    response = customer_response('2024-01-01T00:00:00')
+
+    manager.process_response(QUERY, response)
+    manager.process_response(QUERY, response)
+
+    # Not marked applied, so the identical retry is synced again rather than skipped
+    assert 'customers_query' not in manager.applied_responses
+    assert manager.skipped_responses == {}
+    assert len(manager.bitrix_client.calls) == 2
+    assert database.get_bitrix_id('customers', '80000000-1') is None
+
+
+def test_successful_response_is_skipped_when_repeated(manager):
+    response = customer_response('2024-01-01T00:00:00')
+
+    manager.process_response(QUERY, response)
+    manager.process_response(QUERY, response)
+
+    assert manager.skipped_responses == {'customers': 1}
+    assert len(manager.bitrix_client.calls) == 1
+
+
+def test_unbuildable_queue_items_are_dead_lettered(manager):
+    database.add_to_qb_queue('customer', '7', 'add', '{"name": "Ann"}')
+    update_id = database.add_to_qb_queue('customer', '8', 'update', '{"name": "Bob"}')
+
+    requests = manager.get_pending_requests()
+
+    queued = [r for r in requests if 'queue_id' in r]
+    assert [r['bitrix_id'] for r in queued] == ['7']
+    dead = database.get_dead_qb_queue()
+    assert [(row['id'], row['status']) for row in dead] == [(update_id, 'dead')]
+    assert 'customer/update' in dead[0]['error_message']
+    # Nothing is left claimed, so a new change for the key queues normally
+    assert database.add_to_qb_queue('customer', '8', 'update', '{"name": "Bo"}') != update_id
+
+
+def _watermark():
+    return database.get_last_sync_time('customers', 'qb_to_bitrix')
+
+
+def test_watermark_not_moved_when_every_record_fails(manager):
+    manager.bitrix_client.result = {'success': False, 'error': 'rejected'}
+
+    manager.process_response(QUERY, customer_response('2024-01-01T00:00:00', '2024-01-02T00:00:00'))
+
+    assert _watermark() is None
+
+
+def test_watermark_stops_before_earliest_failure(manager):
+    ok = {'success': True, 'result': 1}
+    manager.bitrix_client.result = [ok, {'success': False, 'error': 'rejected'}, ok]
+
+    manager.process_response(QUERY, customer_response(
+        '2024-01-01T00:00:00', '2024-01-02T00:00:00', '2024-01-03T00:00:00'))
+
+    assert _watermark() == '2024-01-01T00:00:00'
+
+
+def test_watermark_advances_over_a_fully_synced_response(manager):
+    manager.process_response(QUERY, customer_response('2024-01-02T00:00:00', '2024-01-01T00:00:00'))
+
+    assert _watermark() == '2024-01-02T00:00:00'
+
+
+def test_only_product_item_types_are_pushed(manager):
+    items = ''.join(
+        f'<{item_type}Ret><ListID>{i}-1</ListID><TimeModified>2024-01-0{i + 1}T00:00:00</TimeModified>'
+        f'<Name>{item_type}</Name></{item_type}Ret>'
+        for i, item_type in enumerate(['ItemService', 'ItemSubtotal', 'ItemSalesTax',
+                                       'ItemSalesTaxGroup', 'ItemDiscount']))
+    response = ('<?xml version="1.0" ?><QBXML><QBXMLMsgsRs>'
+                f'<ItemQueryRs statusCode="0" statusMessage="OK">{items}</ItemQueryRs>'
+                '</QBXMLMsgsRs></QBXML>')
+
+    manager.process_response({'type': 'items_query', 'action': 'query', 'entity_type': 'items',
+                              'qbxml': '<ItemQueryRq/>'}, response)
+
+    pushed = [args[0]['NAME'] for name, args in manager.bitrix_client.calls]
+    assert pushed == ['ItemService', 'ItemDiscount']
+    # Skipped item types still count as handled for the watermark
+    assert database.get_last_sync_time('items', 'qb_to_bitrix') == '2024-01-05T00:00:00'
+
+
+def test_process_response_returns_a_bool_on_every_path(manager):
+    host = ('<?xml version="1.0" ?><QBXML><QBXMLMsgsRs><HostQueryRs statusCode="0" statusMessage="OK">'
+            '<HostRet><ProductName>QuickBooks</ProductName></HostRet></HostQueryRs></QBXMLMsgsRs></QBXML>')
+    error = ('<?xml version="1.0" ?><QBXML><QBXMLMsgsRs><CustomerAddRs statusCode="3100" '
+             'statusMessage="Name in use"/></QBXMLMsgsRs></QBXML>')
+    item_id = database.add_to_qb_queue('customer', '7', 'add', '{"name": "Ann"}')
+    queued = {'type': 'customer_add', 'action': 'add', 'queue_id': item_id, 'entity_type': 'customer',
+              'bitrix_id': '7'}
+
+    assert manager._process_response({'type': 'host_query', 'action': 'query'}, host, 'h') is False
+    assert manager._process_response(queued, error, 'e') is False
+    assert manager._process_response(QUERY, customer_response('2024-01-01T00:00:00'), 'c') is True
+
+
+CRASH_MID_CHUNK = r'''
+import os
+import sys
+
+sys.path[:0] = [{repo!r}, {tests!r}]
+import database
+from conftest import FakeBitrix24Client
+from test_sync_manager import QUERY, customer_response
+
+database.set_storage(database.SQLiteStorage({db!r}))
+from sync_manager import SyncManager
+
+
+class CrashingClient(FakeBitrix24Client):
+    def add_contact(self, data):
+        if len(self.calls) == 3:
+            os._exit(1)  # killed mid-chunk: no exception handler or flush runs
+        self.calls.append(('add_contact', (data,)))
+        return {{'success': True, 'result': 100 + len(self.calls)}}
+
+
+manager = SyncManager()
+manager.bitrix_client = CrashingClient()
+manager.process_response(QUERY, customer_response(*['2024-01-01T00:00:00'] * 5))
+'''
+
+
+def test_created_entities_stay_mapped_after_a_crash_mid_chunk(tmp_path):
+    tests = os.path.dirname(os.path.abspath(__file__))
+    db = str(tmp_path / 'crash.db')
+    script = CRASH_MID_CHUNK.format(repo=os.path.dirname(tests), tests=tests, db=db)
+    assert subprocess.run([sys.executable, '-c', script], cwd=tmp_path).returncode == 1
+
+    storage = database.SQLiteStorage(db)
+    # The three contacts created in Bitrix24 before the crash are all mapped
+    assert [storage.get_bitrix_id('customers', f'8000000{i}-1') for i in range(4)] == ['101', '102', '103', None]
@@ -13,6 +13,7 @@ Reference: https://developer.intuit.com/app/developer/qbdesktop/docs/develop/web
 """
 
 import logging
+import threading
 import uuid
 from datetime import datetime
 from typing import Optional
@@ -208,6 +209,10 @@ class QuickBooksWebConnectorService(Service):
             total = len(session['request_queue'])
             del QuickBooksWebConnectorService.sessions[ticket]
             logger.info(f"Connection closed. Processed {completed}/{total} requests")
+
+            # Quiet moment between polls: do database upkeep off the SOAP thread
+            sync_mgr = QuickBooksWebConnectorService.get_sync_manager()
+            threading.Thread(target=sync_mgr.run_housekeeping, daemon=True).start()
             return f"OK - Processed {completed} requests"
 
         return "OK"